@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Benchmark payload optimisation settings on a sample set of images.
+For each combination of long edge, format and quality this script reports:
+1. Average upload size and the share saved against the original file
+2. Time spent resizing and re-encoding
+3. With --ocr, Vision API latency and character accuracy, measured against
+   <stem>.gt.txt transcriptions when present, otherwise against the OCR
+   text of the original full-resolution upload
+"""
+
+import os
+import time
+import argparse
+from statistics import mean
+
+from dotenv import load_dotenv
+
+from benchmark_utils import list_images, load_ground_truth, character_accuracy, format_table, run_ocr
+from http_utils import create_session
+from payload import PayloadOptions, FORMATS, optimize_payload
+
+# Load environment variables from .env file
+load_dotenv()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark image payload optimisation settings.')
+    parser.add_argument('sample_dir', help='Directory containing sample images')
+    parser.add_argument('--max_edges', default='0,2048,1568,1024', help='Comma-separated long edges to try (0 = original size)')
+    parser.add_argument('--formats', default='jpeg,webp', help='Comma-separated formats to try')
+    parser.add_argument('--qualities', default='95,85,70', help='Comma-separated encoder qualities to try')
+    parser.add_argument('--ocr', action='store_true', help='Also measure OCR latency and accuracy (needs GOOGLE_API_KEY)')
+    args = parser.parse_args()
+    
+    images = list_images(args.sample_dir)
+    if not images:
+        print(f"No image files found in {args.sample_dir}")
+        return
+    
+    api_key = os.getenv('GOOGLE_API_KEY')
+    if args.ocr and not api_key:
+        print("Error: --ocr needs GOOGLE_API_KEY in the environment or .env file")
+        return
+    session = create_session()
+    
+    settings = [
+        PayloadOptions(int(edge), fmt, int(quality))
+        for edge in args.max_edges.split(',')
+        for fmt in args.formats.split(',') if fmt in FORMATS
+        for quality in args.qualities.split(',')
+    ]
+    
+    originals = [image.read_bytes() for image in images]
+    references = [load_ground_truth(image) for image in images]
+    if args.ocr:
+        # Without a transcription, the full-resolution OCR output is the reference
+        for i, data in enumerate(originals):
+            if references[i] is None:
+                references[i], _ = run_ocr(session, api_key, data)
+    
+    print(f"Benchmarking {len(settings)} settings on {len(images)} images")
+    rows = []
+    for options in settings:
+        sizes, encode_times, ocr_times, accuracies = [], [], [], []
+        for data, reference in zip(originals, references):
+            start = time.perf_counter()
+            optimized, _ = optimize_payload(data, 'image/jpeg', options)
+            encode_times.append(time.perf_counter() - start)
+            sizes.append(len(optimized))
+            
+            if args.ocr:
+                text, elapsed = run_ocr(session, api_key, optimized)
+                ocr_times.append(elapsed)
+                accuracies.append(character_accuracy(reference, text))
+        
+        original_size = sum(len(data) for data in originals)
+        rows.append([
+            options.max_edge or 'orig', options.format, options.quality,
+            f"{mean(sizes) / 1024:.0f}",
+            f"{1 - sum(sizes) / original_size:.0%}",
+            f"{mean(encode_times) * 1000:.0f}",
+            f"{mean(ocr_times) * 1000:.0f}" if ocr_times else '-',
+            f"{mean(accuracies):.3f}" if accuracies else '-'
+        ])
+    
+    print(format_table(['max_edge', 'format', 'quality', 'avg KB', 'saved', 'encode ms', 'OCR ms', 'char acc'], rows))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Benchmark the image preparation pipeline.
+By default the benchmark runs offline on synthetic notebook photos
+(perspective skew, blur and sensor noise) rendered deterministically at
+several resolutions, so results are reproducible across machines and runs
+without sample data or API keys. Pass a sample directory to benchmark real
+photos instead.
+
+This script reports, per resolution:
+1. Mean time of every pipeline stage (decode, edge detection with the
+   downscaled proxy and at full resolution, each enhance_image quality tier,
+   enhance_visual and JPEG encoding)
+2. End-to-end throughput in images/sec for each quality tier
+3. Peak resident memory of the run, and the cold-start time and memory of
+   importing prepare_images in a fresh interpreter
+4. With --ocr, OCR latency per backend (--ocr_backends, e.g. the Vision
+   API against local easyocr) and character accuracy of each tier's output,
+   measured against the rendered text for synthetic pages, <stem>.gt.txt
+   transcriptions when present, otherwise against the output of the 'best' tier
+
+Results can be saved with --save_baseline and later compared against with
+--baseline; the script exits non-zero if any stage regressed by more than
+--tolerance.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import importlib.util
+from statistics import mean
+
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+
+from benchmark_utils import (
+    list_images, load_ground_truth, character_accuracy, format_table, run_ocr,
+    synthetic_notebook_photo, peak_rss_mb, measure_cold_start
+)
+from http_utils import create_session
+from ocr_backends import OCROptions, BACKENDS, get_backend
+from prepare_images import detect_and_crop_edges, enhance_image, enhance_visual, QUALITY_TIERS, EDGE_PROXY_MAX_EDGE
+
+# Load environment variables from .env file
+load_dotenv()
+
+DEFAULT_RESOLUTIONS = '1600x1200,3264x2448,4032x3024'
+
+def best_time(function, *args, repeat=1):
+    """Run function repeat times, returning (result, fastest run in seconds).
+
+    function is first run once untimed, so one-off setup (OpenCV's thread
+    pool and kernels, first-touch allocations) isn't charged to whichever
+    stage happens to run first.
+    """
+    function(*args)
+    fastest = None
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        fastest = elapsed if fastest is None else min(fastest, elapsed)
+    return result, fastest
+
+def encode_jpeg(image):
+    """Encode image as JPEG bytes the way prepare_images writes it."""
+    success, encoded = cv2.imencode('.jpg', image)
+    return encoded.tobytes()
+
+def decode_image(image_bytes):
+    """Decode encoded image bytes to a BGR array."""
+    return cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def make_recognizer(backend, session, api_key):
+    """Return a function OCRing image bytes with backend, returning (text, seconds)."""
+    if backend == 'vision':
+        # run_ocr retries throttled requests, which the benchmark shouldn't count as OCR time
+        return lambda image_bytes: run_ocr(session, api_key, image_bytes)
+
+    ocr = get_backend(OCROptions(backend, ('en',), 8))
+    def recognize(image_bytes):
+        start = time.perf_counter()
+        text, _ = ocr.recognize(image_bytes)
+        return text, time.perf_counter() - start
+    return recognize
+
+def parse_resolutions(value):
+    """Parse 'WxH,WxH' into a list of (width, height) tuples."""
+    resolutions = []
+    for item in value.split(','):
+        width, height = item.lower().split('x')
+        resolutions.append((int(width), int(height)))
+    return resolutions
+
+def synthetic_samples(resolutions, count):
+    """Yield (group, name, jpeg bytes, reference text) for synthetic photos."""
+    for width, height in resolutions:
+        group = f"{width}x{height}"
+        for seed in range(count):
+            image, text = synthetic_notebook_photo(width, height, seed)
+            yield group, f"{group}-{seed}", encode_jpeg(image), text
+
+def directory_samples(sample_dir):
+    """Yield (group, name, file bytes, reference text) for images in sample_dir."""
+    for image_path in list_images(sample_dir):
+        with open(image_path, 'rb') as f:
+            yield 'samples', image_path.name, f.read(), load_ground_truth(image_path)
+
+def benchmark_sample(image_bytes, tiers, repeat=1):
+    """Time every pipeline stage on one encoded image.
+
+    Returns ({stage: seconds}, {tier: enhanced image}), or None if the
+    image can't be decoded.
+    """
+    image, elapsed = best_time(decode_image, image_bytes, repeat=repeat)
+    if image is None:
+        return None
+    stages = {'decode': elapsed}
+
+    _, stages['crop_full'] = best_time(detect_and_crop_edges, image, 0, repeat=repeat)
+    cropped, stages['crop'] = best_time(detect_and_crop_edges, image, EDGE_PROXY_MAX_EDGE, repeat=repeat)
+    _, stages['enhance_visual'] = best_time(enhance_visual, cropped, repeat=repeat)
+
+    enhanced = {}
+    for tier in tiers:
+        enhanced[tier], stages[f'enhance_{tier}'] = best_time(enhance_image, cropped, tier, repeat=repeat)
+    _, stages['jpeg_encode'] = best_time(encode_jpeg, enhanced[tiers[-1]], repeat=repeat)
+    return stages, enhanced
+
+def summarize(stage_times, tiers):
+    """Reduce per-image stage times to mean stage seconds and per-tier images/sec."""
+    stages = {stage: mean(times) for stage, times in stage_times.items()}
+    throughput = {}
+    for tier in tiers:
+        # What prepare_images does per image: decode, crop, enhance, encode
+        per_image = stages['decode'] + stages['crop'] + stages[f'enhance_{tier}'] + stages['jpeg_encode']
+        throughput[tier] = 1 / per_image
+    return {'images': len(next(iter(stage_times.values()))), 'stages': stages, 'throughput': throughput}
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Print stage times against a baseline, returning the regressed (group, stage) pairs."""
+    rows, regressions = [], []
+    for group, summary in results['groups'].items():
+        previous = baseline.get('groups', {}).get(group)
+        if previous is None:
+            continue
+        for stage, seconds in summary['stages'].items():
+            before = previous['stages'].get(stage)
+            if not before:
+                continue
+            change = seconds / before - 1
+            regressed = change > tolerance
+            if regressed:
+                regressions.append((group, stage))
+            rows.append([group, stage, f"{before * 1000:.1f}", f"{seconds * 1000:.1f}",
+                         f"{change:+.0%}", 'REGRESSED' if regressed else ''])
+
+    if rows:
+        print(format_table(['resolution', 'stage', 'baseline ms', 'now ms', 'change', ''], rows))
+    else:
+        print("No resolutions in common with the baseline")
+
+    before_startup, now_startup = baseline.get('startup'), results.get('startup')
+    if before_startup and now_startup:
+        change = now_startup['wall_s'] / before_startup['wall_s'] - 1
+        if change > tolerance:
+            regressions.append(('startup', 'cold_start'))
+        print(f"Cold start: {before_startup['wall_s'] * 1000:.0f} ms -> {now_startup['wall_s'] * 1000:.0f} ms "
+              f"({change:+.0%}), {before_startup['rss_mb']:.0f} MB -> {now_startup['rss_mb']:.0f} MB")
+
+    before_rss, now_rss = baseline.get('peak_rss_mb'), results['peak_rss_mb']
+    if before_rss:
+        print(f"Peak RSS: {before_rss:.0f} MB -> {now_rss:.0f} MB ({now_rss / before_rss - 1:+.0%})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the image preparation pipeline.')
+    parser.add_argument('sample_dir', nargs='?', help='Directory of sample images (default: synthetic photos)')
+    parser.add_argument('--resolutions', default=DEFAULT_RESOLUTIONS,
+                        help='Comma-separated WxH resolutions of the synthetic photos')
+    parser.add_argument('--count', type=int, default=3, help='Synthetic photos per resolution')
+    parser.add_argument('--tiers', default=','.join(QUALITY_TIERS), help='Comma-separated quality tiers to compare')
+    parser.add_argument('--repeat', type=int, default=1, help='Times to run each stage per image (the fastest run is kept)')
+    parser.add_argument('--ocr', action='store_true', help='Also measure OCR latency and character accuracy')
+    parser.add_argument('--ocr_backends', default='vision',
+                        help='Comma-separated OCR backends to compare with --ocr (vision needs GOOGLE_API_KEY)')
+    parser.add_argument('--startup_runs', type=int, default=5,
+                        help='Fresh interpreters used to measure cold-start time (0 to skip)')
+    parser.add_argument('--save_baseline', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare the results against this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='Allowed slowdown per stage against the baseline before failing (0.15 = 15%%)')
+    args = parser.parse_args()
+
+    backends = [backend for backend in args.ocr_backends.split(',') if backend in BACKENDS] if args.ocr else []
+    api_key = os.getenv('GOOGLE_API_KEY')
+    if 'vision' in backends and not api_key:
+        print("Error: the vision OCR backend needs GOOGLE_API_KEY in the environment or .env file")
+        return
+    if 'easyocr' in backends and importlib.util.find_spec('easyocr') is None:
+        print("Warning: easyocr is not installed (pip install easyocr); skipping the easyocr backend")
+        backends.remove('easyocr')
+    session = create_session()
+    # Load local models before timing anything
+    recognizers = {backend: make_recognizer(backend, session, api_key) for backend in backends}
+
+    tiers = [tier for tier in args.tiers.split(',') if tier in QUALITY_TIERS]
+    if not tiers:
+        print(f"No valid tiers in {args.tiers}; choose from {', '.join(QUALITY_TIERS)}")
+        return
+
+    if args.sample_dir:
+        samples = directory_samples(args.sample_dir)
+    else:
+        samples = synthetic_samples(parse_resolutions(args.resolutions), args.count)
+
+    # group -> stage -> per-image seconds; group -> (backend, tier) -> accuracies;
+    # group -> backend -> per-image OCR seconds
+    stage_times, accuracies, ocr_times = {}, {}, {}
+    for group, name, image_bytes, reference in samples:
+        measured = benchmark_sample(image_bytes, tiers, repeat=args.repeat)
+        if measured is None:
+            print(f"Skipping {name}: could not read image")
+            continue
+        stages, enhanced = measured
+        for stage, seconds in stages.items():
+            stage_times.setdefault(group, {}).setdefault(stage, []).append(seconds)
+
+        texts = {}
+        for tier, image in enhanced.items():
+            image_bytes = encode_jpeg(image)
+            for backend, recognize in recognizers.items():
+                texts[backend, tier], elapsed = recognize(image_bytes)
+                ocr_times.setdefault(group, {}).setdefault(backend, []).append(elapsed)
+        # Without a transcription, the first backend's output on the best tier is the reference
+        if reference is None and backends:
+            reference = texts.get((backends[0], 'best'))
+        if reference is not None:
+            for key, text in texts.items():
+                accuracies.setdefault(group, {}).setdefault(key, []).append(character_accuracy(reference, text))
+
+    if not stage_times:
+        print("No images to benchmark")
+        return
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'source': args.sample_dir or 'synthetic',
+            'repeat': args.repeat
+        },
+        'groups': {group: summarize(times, tiers) for group, times in stage_times.items()},
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+    for group, summary in results['groups'].items():
+        print(f"\n{group}: {summary['images']} images")
+        print(format_table(['stage', 'mean ms'], [
+            [stage, f"{seconds * 1000:.1f}"] for stage, seconds in summary['stages'].items()
+        ]))
+        print()
+        best_rate = summary['throughput'].get('best')
+        group_accuracies = accuracies.get(group, {})
+        print(format_table(['tier', 'images/sec', 'speedup'] + [f'{backend} acc' for backend in backends], [
+            [
+                tier,
+                f"{rate:.2f}",
+                f"{rate / best_rate:.1f}x" if best_rate else '-'
+            ] + [
+                f"{mean(group_accuracies[backend, tier]):.3f}" if group_accuracies.get((backend, tier)) else '-'
+                for backend in backends
+            ]
+            for tier, rate in summary['throughput'].items()
+        ]))
+        if group in ocr_times:
+            summary['ocr'] = {backend: mean(times) for backend, times in ocr_times[group].items()}
+            print()
+            print(format_table(['ocr backend', 'mean ms', 'images/sec'], [
+                [backend, f"{seconds * 1000:.0f}", f"{1 / seconds:.2f}"]
+                for backend, seconds in summary['ocr'].items()
+            ]))
+
+    print(f"\nPeak RSS: {results['peak_rss_mb']:.0f} MB")
+
+    if args.startup_runs > 0:
+        wall, import_time, rss = measure_cold_start('prepare_images', args.startup_runs)
+        results['startup'] = {'wall_s': wall, 'import_s': import_time, 'rss_mb': rss}
+        print(f"Cold start (python -c 'import prepare_images'): {wall * 1000:.0f} ms total, "
+              f"{import_time * 1000:.0f} ms importing, {rss:.0f} MB RSS")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline written to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"\nComparing against {args.baseline} (tolerance {args.tolerance:.0%})")
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stage(s) regressed")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Helpers shared by the benchmark scripts: image discovery, timed OCR calls,
+OCR accuracy scoring, synthetic test photos, memory and cold-start
+measurement and plain-text result tables.
+"""
+
+import time
+from pathlib import Path
+
+from http_utils import RETRY_STATUS_CODES, backoff_delay
+from ingest import is_source_image, scan_files
+from vision_client import VISION_API_URL, build_annotate_request, parse_annotate_response
+
+def list_images(directory):
+    """Return the original images in directory, sorted, skipping pipeline outputs."""
+    return sorted(scan_files(directory, is_source_image))
+
+def load_ground_truth(image_path):
+    """Return the reference transcription stored next to an image as <stem>.gt.txt, if any."""
+    gt_path = image_path.with_name(f"{image_path.stem}.gt.txt")
+    if gt_path.exists():
+        return gt_path.read_text(encoding='utf-8')
+    return None
+
+def edit_distance(a, b):
+    """Levenshtein distance between two strings."""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b)
+            ))
+        previous = current
+    return previous[-1]
+
+def character_accuracy(reference, hypothesis):
+    """Character accuracy of hypothesis against reference (1 - CER, floored at 0)."""
+    reference = ' '.join(reference.split())
+    hypothesis = ' '.join(hypothesis.split())
+    if not reference:
+        return 1.0 if not hypothesis else 0.0
+    return max(0.0, 1 - edit_distance(reference, hypothesis) / len(reference))
+
+def format_table(headers, rows):
+    """Format rows as a left-aligned plain-text table."""
+    rows = [[str(cell) for cell in row] for row in rows]
+    widths = [max(len(str(h)), *(len(row[i]) for row in rows)) if rows else len(str(h))
+              for i, h in enumerate(headers)]
+    lines = ['  '.join(str(h).ljust(w) for h, w in zip(headers, widths)),
+             '  '.join('-' * w for w in widths)]
+    lines += ['  '.join(cell.ljust(w) for cell, w in zip(row, widths)) for row in rows]
+    return '\n'.join(lines)
+
+def run_ocr(session, api_key, image_bytes, max_retries=5):
+    """OCR one image synchronously, returning (text, seconds of the successful attempt)."""
+    body = build_annotate_request([image_bytes])
+    for attempt in range(max_retries + 1):
+        start = time.perf_counter()
+        response = session.post(VISION_API_URL, params={'key': api_key}, json=body)
+        elapsed = time.perf_counter() - start
+        if response.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+            break
+        time.sleep(backoff_delay(attempt, retry_after=response.headers.get('Retry-After')))
+    response.raise_for_status()
+    text, _ = parse_annotate_response(response.json()['responses'][0])
+    return text, elapsed
+
+SYNTHETIC_LINES = [
+    "Solve for x: 3x + 7 = 22",
+    "3x = 22 - 7 = 15, so x = 5",
+    "Check: 3(5) + 7 = 22",
+    "Area of a circle: A = pi r^2",
+    "r = 4 cm -> A = 16 pi cm^2",
+    "Photosynthesis: CO2 + H2O -> sugar + O2",
+    "Newton's 2nd law: F = m a",
+    "Homework due Friday, chapter 6"
+]
+
+def synthetic_notebook_photo(width, height, seed=0):
+    """Render a deterministic fake phone photo of a notebook page.
+
+    The page carries ruled lines and handwriting-like text, is warped with a
+    random perspective onto a darker desk background, then blurred and
+    noised. Returns (BGR image, text written on the page).
+    """
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+
+    # Flat page at roughly the size it will occupy in the photo
+    page_w, page_h = int(width * 0.7), int(height * 0.8)
+    page = np.full((page_h, page_w, 3), (235, 240, 242), dtype=np.uint8)
+    line_gap = max(12, page_h // 18)
+    for y in range(line_gap * 2, page_h, line_gap):
+        cv2.line(page, (0, y), (page_w, y), (220, 200, 170), max(1, page_h // 800))
+
+    scale = line_gap / 40
+    thickness = max(1, int(scale * 2))
+    lines = [SYNTHETIC_LINES[(seed + i) % len(SYNTHETIC_LINES)] for i in range(12)]
+    for i, text in enumerate(lines):
+        y = line_gap * (i + 2) - line_gap // 6
+        cv2.putText(page, text, (line_gap, y), cv2.FONT_HERSHEY_SCRIPT_SIMPLEX, scale,
+                    (110, 50, 30), thickness, cv2.LINE_AA)
+
+    # Desk background with some texture
+    photo = rng.integers(40, 80, size=(height, width, 3), dtype=np.uint8)
+    photo = cv2.GaussianBlur(photo, (0, 0), 3)
+
+    # Place the page with perspective skew
+    margin_x, margin_y = width * 0.15, height * 0.1
+    jitter = min(width, height) * 0.05
+    corners = np.array([
+        [margin_x, margin_y],
+        [width - margin_x, margin_y],
+        [width - margin_x, height - margin_y],
+        [margin_x, height - margin_y]
+    ], dtype=np.float32) + rng.uniform(-jitter, jitter, size=(4, 2)).astype(np.float32)
+    source = np.array([[0, 0], [page_w - 1, 0], [page_w - 1, page_h - 1], [0, page_h - 1]], dtype=np.float32)
+    M = cv2.getPerspectiveTransform(source, corners)
+    cv2.warpPerspective(page, M, (width, height), dst=photo, borderMode=cv2.BORDER_TRANSPARENT)
+
+    # Camera blur and sensor noise
+    photo = cv2.GaussianBlur(photo, (0, 0), max(0.5, min(width, height) / 2000))
+    noise = rng.normal(0, 6, size=photo.shape)
+    photo = np.clip(photo.astype(np.float32) + noise, 0, 255).astype(np.uint8)
+
+    return photo, '\n'.join(lines)
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    import resource
+    import sys
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def measure_cold_start(module, runs=5):
+    """Time `python -c "import module"` in fresh interpreters.
+
+    Returns (fastest wall time in seconds, fastest import time in seconds,
+    peak RSS in MB of that run). Run from the scripts directory so module
+    resolves the same way it does for the CLI.
+    """
+    import json
+    import subprocess
+    import sys
+
+    # ru_maxrss can still include the benchmark process itself when the child
+    # was forked from it, so prefer the child's own high-water mark on Linux
+    code = (
+        "import time, json, resource; start = time.perf_counter(); "
+        f"import {module}; "
+        "elapsed = time.perf_counter() - start\n"
+        "try:\n"
+        "    peak = [int(line.split()[1]) for line in open('/proc/self/status') if line.startswith('VmHWM:')][0]\n"
+        "except (OSError, IndexError):\n"
+        "    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+        "print(json.dumps([elapsed, peak]))"
+    )
+    scripts_dir = Path(__file__).resolve().parent
+    fastest = None
+    for _ in range(max(1, runs)):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', code], cwd=scripts_dir, check=True,
+                                capture_output=True, text=True).stdout
+        wall = time.perf_counter() - start
+        import_time, peak = json.loads(output.strip().splitlines()[-1])
+        peak_mb = peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+        if fastest is None or wall < fastest[0]:
+            fastest = (wall, import_time, peak_mb)
+    return fastest
@@ -0,0 +1,146 @@
+"""
+Change-region detection between consecutive desk camera frames.
+Usually only a few lines of handwriting change from one frame to the next.
+Both frames' pages are rectified with detect_and_crop_edges, aligned, and
+differenced to find the bounding boxes of what changed. generate_guidances.py
+can then send a tight crop of that area instead of the whole previous frame.
+"""
+
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from prepare_images import detect_and_crop_edges
+from metrics import timer, count
+
+# Pages are compared at this long edge; fine enough for pen strokes
+COMPARE_MAX_EDGE = 800
+# Grey-level difference that counts as a change after blurring away noise
+DIFF_THRESHOLD = 40
+# Changed blobs smaller than this fraction of the page are treated as noise
+MIN_REGION_FRACTION = 0.0005
+# Above this fraction the page changed too much (page turn, new sheet) for a crop to help
+MAX_CHANGED_FRACTION = 0.5
+# Margin around the changed area, as a fraction of the page's long edge
+CROP_PADDING = 0.03
+# The outline is never found at exactly the same spot twice, so differences
+# this close to the page edge (as a fraction of each side) are ignored
+EDGE_MARGIN = 0.02
+
+class PageCache:
+    """The last few rectified pages of one sequence of frames.
+    
+    The current frame's page is the next frame's previous page, so a few
+    entries are enough. Each session keeps its own, so concurrent sessions
+    don't evict each other's pages.
+    """
+    
+    def __init__(self, max_entries=3):
+        self.max_entries = max_entries
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def load(self, image_path):
+        """Read image_path and return its rectified page, reusing recent results."""
+        key = (str(image_path), image_path.stat().st_mtime_ns)
+        with self._lock:
+            page = self._pages.get(key)
+        if page is None:
+            image = cv2.imread(str(image_path))
+            if image is None:
+                return None
+            page = detect_and_crop_edges(image)
+            with self._lock:
+                self._pages[key] = page
+                while len(self._pages) > self.max_entries:
+                    self._pages.popitem(last=False)
+        return page
+
+def _compare_size(page):
+    """(width, height) to compare page at."""
+    height, width = page.shape[:2]
+    scale = min(1.0, COMPARE_MAX_EDGE / max(height, width))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def find_changed_regions(previous_page, current_page):
+    """Bounding boxes (x, y, w, h) in current_page pixels of what differs from previous_page.
+
+    Returns (boxes, changed fraction of the page). The rectified pages are
+    resized to a common size and a residual shift is removed with ECC
+    before differencing, since the page outline is never found at exactly
+    the same spot twice.
+    """
+    size = _compare_size(current_page)
+    current = cv2.cvtColor(cv2.resize(current_page, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    previous = cv2.cvtColor(cv2.resize(previous_page, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    current = cv2.GaussianBlur(current, (5, 5), 0)
+    previous = cv2.GaussianBlur(previous, (5, 5), 0)
+
+    warp = np.eye(2, 3, dtype=np.float32)
+    try:
+        _, warp = cv2.findTransformECC(current, previous, warp, cv2.MOTION_TRANSLATION,
+                                       (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 50, 1e-4), None, 5)
+        previous = cv2.warpAffine(previous, warp, size, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                                  borderMode=cv2.BORDER_REPLICATE)
+    except cv2.error:
+        # ECC didn't converge; compare the rectified pages as they are
+        pass
+
+    diff = cv2.absdiff(current, previous)
+    _, mask = cv2.threshold(diff, DIFF_THRESHOLD, 255, cv2.THRESH_BINARY)
+    margin_x, margin_y = int(size[0] * EDGE_MARGIN), int(size[1] * EDGE_MARGIN)
+    mask[:margin_y] = 0
+    mask[mask.shape[0] - margin_y:] = 0
+    mask[:, :margin_x] = 0
+    mask[:, mask.shape[1] - margin_x:] = 0
+    # Join the strokes of a line of writing into one region
+    mask = cv2.dilate(mask, cv2.getStructuringElement(cv2.MORPH_RECT, (15, 9)))
+    changed_fraction = cv2.countNonZero(mask) / mask.size
+
+    scale_x = current_page.shape[1] / size[0]
+    scale_y = current_page.shape[0] / size[1]
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if w * h < MIN_REGION_FRACTION * mask.size:
+            continue
+        boxes.append((int(x * scale_x), int(y * scale_y), int(w * scale_x), int(h * scale_y)))
+    return boxes, changed_fraction
+
+def changed_region_crop(previous_path, current_path, pages=None):
+    """Find what changed on the page from previous_path to current_path.
+
+    Returns ('changed', tight crop of current_path's page around the change),
+    ('unchanged', None), or ('fallback', None) when too much changed or
+    either page can't be read, in which case callers should send the whole
+    previous frame. pages (a PageCache) keeps the rectified pages of the
+    sequence between calls.
+    """
+    if pages is None:
+        pages = PageCache()
+    with timer('change_detect'):
+        previous_page = pages.load(previous_path)
+        current_page = pages.load(current_path)
+        if previous_page is None or current_page is None:
+            count('change_crop_fallbacks')
+            return 'fallback', None
+        boxes, changed_fraction = find_changed_regions(previous_page, current_page)
+
+    if changed_fraction > MAX_CHANGED_FRACTION:
+        count('change_crop_fallbacks')
+        return 'fallback', None
+    if not boxes:
+        count('change_unchanged')
+        return 'unchanged', None
+
+    height, width = current_page.shape[:2]
+    padding = int(max(height, width) * CROP_PADDING)
+    left = max(0, min(x for x, _, _, _ in boxes) - padding)
+    top = max(0, min(y for _, y, _, _ in boxes) - padding)
+    right = min(width, max(x + w for x, _, w, _ in boxes) + padding)
+    bottom = min(height, max(y + h for _, y, _, h in boxes) + padding)
+    count('change_crops')
+    return 'changed', current_page[top:bottom, left:right]
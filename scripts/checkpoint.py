@@ -0,0 +1,142 @@
+"""
+Checkpoint manifests that make batch runs resumable.
+A manifest is an append-only JSONL file with one line per finished item:
+its name, size, mtime and SHA-256, the settings it was produced with and
+the outputs it produced. Each line is flushed to disk as soon as the item
+is done, so a crash loses at most the items in flight. On --resume, a
+finished item is recognised with a dict lookup and a stat; its contents
+are only hashed again if its size or mtime changed.
+"""
+
+import os
+import json
+import hashlib
+from pathlib import Path
+
+from result_cache import file_signature, atomic_write_bytes
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """SHA-256 of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Checkpoint:
+    """Append-only record of the items a run has finished.
+
+    config identifies the settings that determine an item's outputs (e.g. a
+    make_key of the pipeline version and options); items recorded under a
+    different config don't count as done. Output paths are stored relative
+    to the manifest's folder, and an item whose outputs have since been
+    deleted doesn't count as done either.
+
+    A read_only checkpoint is only consulted (e.g. another script's manifest,
+    which that script may still be appending to) and never rewrites the file.
+    """
+
+    def __init__(self, path, config=None, read_only=False):
+        self.path = Path(path)
+        self.config = config
+        self.read_only = read_only
+        self.entries = {}
+        self._file = None
+        self.load()
+
+    def load(self):
+        """Read the manifest, keeping the latest line for each item."""
+        self.entries.clear()
+        lines = 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash
+                        continue
+                    self.entries[record['item']] = record
+                    lines += 1
+        except OSError:
+            return
+
+        # Re-runs append a new line per item; drop the superseded ones now and then
+        if lines > 2 * len(self.entries) + 100 and not self.read_only:
+            self._rewrite()
+
+    def _rewrite(self):
+        """Replace the manifest with one line per current entry."""
+        self.close()
+        data = ''.join(json.dumps(record) + '\n' for record in self.entries.values())
+        atomic_write_bytes(self.path, data.encode('utf-8'))
+
+    def is_done(self, path):
+        """Whether path was finished with the current config and is unchanged since."""
+        record = self.entries.get(Path(path).name)
+        if record is None or record.get('config') != self.config:
+            return False
+        return self.finished(path) is not None
+
+    def finished(self, path):
+        """The record of path if it was finished, with any config, and is unchanged since; None otherwise."""
+        path = Path(path)
+        record = self.entries.get(path.name)
+        if record is None:
+            return None
+        if any(not output.exists() for output in self.outputs(record)):
+            return None
+        try:
+            if [record['size'], record['mtime_ns']] == file_signature(path):
+                return record
+            # Touched or copied; only a change in contents means it must be redone
+            return record if record['sha256'] == file_sha256(path) else None
+        except OSError:
+            return None
+
+    def outputs(self, record):
+        """Paths of the outputs listed in a record."""
+        return [self.path.parent / output for output in record.get('outputs', [])]
+
+    def mark_done(self, path, outputs=(), **extra):
+        """Record path as finished, producing outputs (paths), plus any extra fields."""
+        path = Path(path)
+        size, mtime_ns = file_signature(path)
+        record = {
+            'item': path.name,
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'sha256': file_sha256(path),
+            'config': self.config,
+            'outputs': [os.path.relpath(output, self.path.parent) for output in outputs],
+            **extra
+        }
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.entries[path.name] = record
+
+    def forget(self, names):
+        """Drop items from the checkpoint so they are redone."""
+        names = [name for name in names if name in self.entries]
+        if not names:
+            return
+        for name in names:
+            del self.entries[name]
+        self._rewrite()
+
+    def clear(self):
+        """Forget every item."""
+        self.close()
+        self.entries.clear()
+        if self.path.exists():
+            self.path.unlink()
+
+    def close(self):
+        """Close the manifest file; it is reopened on the next mark_done."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,120 @@
+"""
+Token-budget-aware request context for generate_guidances.py.
+Each request carries the system prompt, the reference image, recent
+guidances and the latest frames. Left alone, that grows with every long
+guidance until it hits the --max_previous cap. build_context() estimates
+tokens locally and fits the context into a budget. The newest guidances
+are sent verbatim, older ones as one-line summaries. When that is still
+too much, the oldest summaries are dropped first, then the previous frame,
+then the remaining guidances are shortened and dropped, oldest first.
+Guidances are summarised, and summaries dropped, a chunk at a time rather
+than one per frame, so the history sent with a request is usually the
+previous request's history plus one guidance, and its prefix stays cached.
+"""
+
+import re
+import base64
+import math
+from collections import namedtuple
+
+from payload import image_dimensions
+
+# budget: maximum estimated input tokens per request (0 = unlimited);
+# verbatim: newest guidances sent in full; summary_chars: length limit of
+# the summaries of older ones
+ContextOptions = namedtuple('ContextOptions', ['budget', 'verbatim', 'summary_chars'])
+
+DEFAULT_CONTEXT = ContextOptions(8000, 3, 160)
+
+# guidances: texts to send, oldest first; keep_previous: whether the previous
+# frame still fits; tokens: estimated input tokens; verbatim, summarised,
+# dropped: how many guidances were sent in full, shortened or left out
+Context = namedtuple('Context', ['guidances', 'keep_previous', 'tokens', 'verbatim', 'summarised', 'dropped'])
+
+# English prose averages a little under four characters per token; erring
+# low keeps the estimate on the safe side of the budget
+CHARS_PER_TOKEN = 3.5
+# Claude bills images at about width * height / 750 tokens, after scaling
+# them to fit within these limits
+IMAGE_PIXELS_PER_TOKEN = 750
+IMAGE_MAX_EDGE = 1568
+IMAGE_MAX_PIXELS = 1_150_000
+# Charged for an image whose size can't be read
+IMAGE_FALLBACK_TOKENS = 1600
+# Guidances summarised at once, and summaries dropped at once when over
+# budget; between verbatim and verbatim + DROP_CHUNK - 1 are sent in full
+DROP_CHUNK = 4
+
+def estimate_text_tokens(text):
+    """Rough token count of text."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+def estimate_image_tokens(image):
+    """Rough token count of an EncodedImage, or 0 for None.
+
+    Uses the size recorded when the image was encoded; the data is only
+    decoded for an image encoded without one.
+    """
+    if image is None:
+        return 0
+    size = image.size
+    if size is None:
+        size = image_dimensions(base64.b64decode(image.data))
+    if size is None:
+        return IMAGE_FALLBACK_TOKENS
+    width, height = size
+    scale = min(1.0, IMAGE_MAX_EDGE / max(width, height), math.sqrt(IMAGE_MAX_PIXELS / (width * height)))
+    return math.ceil(width * height * scale * scale / IMAGE_PIXELS_PER_TOKEN)
+
+def summarise_guidance(entry, max_chars=DEFAULT_CONTEXT.summary_chars):
+    """One-line summary of a guidance entry ("Image: name\\n\\ntext"): the image and its first sentence."""
+    header, _, text = entry.partition('\n\n')
+    if not text:
+        header, text = '', entry
+    text = ' '.join(text.split())
+    match = re.search(r'[.!?](\s|$)', text)
+    if match:
+        text = text[:match.end()].strip()
+    if len(text) > max_chars:
+        text = text[:max_chars - 1].rstrip() + '…'
+    name = header.replace('Image: ', '').strip()
+    return f"{name}: {text}" if name else text
+
+def build_context(guidances, fixed_tokens, previous_tokens=0, options=DEFAULT_CONTEXT):
+    """Choose which guidances (oldest first) and whether the previous frame fit into the budget.
+
+    fixed_tokens is the estimate for everything always sent (system prompt,
+    instructions, reference and current images) and previous_tokens the
+    estimate for the previous frame, 0 if there is none.
+    """
+    total_guidances = len(guidances)
+    first_verbatim = max(0, total_guidances - max(0, options.verbatim)) // DROP_CHUNK * DROP_CHUNK
+    shortened = [i < first_verbatim for i in range(total_guidances)]
+    texts = [summarise_guidance(g, options.summary_chars) if short else g
+             for g, short in zip(guidances, shortened)]
+    costs = [estimate_text_tokens(text) for text in texts]
+    keep_previous = previous_tokens > 0
+    start = 0
+
+    def total():
+        return fixed_tokens + sum(costs[start:]) + (previous_tokens if keep_previous else 0)
+
+    if options.budget:
+        # The oldest summaries go first...
+        while total() > options.budget and start < first_verbatim:
+            start = min(first_verbatim, start + DROP_CHUNK)
+        # ...then the previous frame...
+        if total() > options.budget and keep_previous:
+            keep_previous = False
+        # ...then the full guidances are shortened and finally dropped, oldest first
+        for i in range(max(start, first_verbatim), total_guidances):
+            if total() <= options.budget:
+                break
+            texts[i] = summarise_guidance(guidances[i], options.summary_chars)
+            costs[i] = estimate_text_tokens(texts[i])
+            shortened[i] = True
+        while total() > options.budget and start < total_guidances:
+            start += 1
+
+    summarised = sum(shortened[start:])
+    return Context(texts[start:], keep_previous, total(), total_guidances - start - summarised, summarised, start)
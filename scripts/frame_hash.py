@@ -0,0 +1,118 @@
+"""
+Perceptual hashing of desk camera frames for generate_guidances.py.
+While the student is thinking the camera keeps producing near-identical
+frames. Each frame's page is cropped and reduced to a small perceptual hash
+(dHash or pHash); frames whose hash is within a Hamming-distance threshold
+of the last frame that got a guidance are skipped instead of being sent to
+Claude again. Hashes are kept in an on-disk index keyed by file size and
+mtime, so re-runs don't decode the images again.
+"""
+
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from prepare_images import detect_and_crop_edges
+from result_cache import file_signature, load_run_state, save_run_state
+from metrics import timer, count
+
+# Side of the hash grid; 16 gives 256-bit hashes
+HASH_SIZE = 16
+HASH_METHODS = ['phash', 'dhash']
+
+# Maximum Hamming distance for a frame to count as unchanged, per method.
+# Measured on 12MP synthetic notebook photos: re-shots of an unchanged page
+# (new sensor noise, a few pixels of hand-held shift, +-8% exposure) moved
+# pHash by up to 12 bits (95% within 10), while writing "x = 7" or "ok" on
+# the next line moved it by 13 to 40. The threshold sits below the smallest
+# added-content distance, so a frame that gained writing is never skipped;
+# some re-shots are sent again instead. dHash moved as much on re-shots (up
+# to 14 bits) as on added writing (as little as 3), so its default only
+# skips frames that are practically identical.
+DEFAULT_DEDUP_THRESHOLDS = {'phash': 10, 'dhash': 2}
+
+# method: one of HASH_METHODS; threshold: maximum Hamming distance (in bits)
+# for a frame to count as unchanged, normally DEFAULT_DEDUP_THRESHOLDS[method]
+DedupOptions = namedtuple('DedupOptions', ['method', 'threshold'])
+
+def dhash(gray, hash_size=HASH_SIZE):
+    """Difference hash: sign of the horizontal gradient on a (hash_size + 1) x hash_size thumbnail."""
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def phash(gray, hash_size=HASH_SIZE):
+    """Perceptual hash: low-frequency DCT coefficients of a thumbnail compared with their median."""
+    small = cv2.resize(gray, (hash_size * 4, hash_size * 4), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(np.float32(small))[:hash_size, :hash_size]
+    bits = low > np.median(low[1:, 1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming(a, b):
+    """Number of differing bits between two hashes."""
+    return bin(a ^ b).count('1')
+
+def page_hash(image_path, method='phash'):
+    """Hash the page in an image file, or return None if it can't be read.
+
+    The image is decoded at quarter resolution, which is plenty for both the
+    page outline and a 16x16 hash.
+    """
+    image = cv2.imread(str(image_path), cv2.IMREAD_REDUCED_COLOR_4)
+    if image is None:
+        return None
+    page = cv2.cvtColor(detect_and_crop_edges(image), cv2.COLOR_BGR2GRAY)
+    return dhash(page) if method == 'dhash' else phash(page)
+
+class FrameDeduplicator:
+    """Decides whether a frame differs enough from the last one that got a guidance.
+
+    Hashes are stored in a JSON index ({name: [size, mtime_ns, method, hex]})
+    next to the guidance file and reused while the file is unchanged.
+    """
+
+    def __init__(self, index_path, options=DedupOptions('phash', DEFAULT_DEDUP_THRESHOLDS['phash'])):
+        self.index_path = index_path
+        self.index = load_run_state(index_path)
+        self.method = options.method
+        self.threshold = options.threshold
+        self.last_hash = None
+
+    @classmethod
+    def for_output(cls, output_file, options):
+        """Deduplicator whose index sits next to output_file, or None if options is None."""
+        if options is None:
+            return None
+        return cls(output_file.parent / f".{output_file.name}.hashes.json", options)
+
+    def frame_hash(self, image_path):
+        """Hash of the page in image_path, from the index when it is still valid."""
+        signature = file_signature(image_path)
+        entry = self.index.get(image_path.name)
+        if entry and entry[:2] == signature and entry[2] == self.method:
+            return int(entry[3], 16)
+
+        with timer('frame_hash'):
+            value = page_hash(image_path, self.method)
+        if value is not None:
+            self.index[image_path.name] = signature + [self.method, f"{value:x}"]
+        return value
+
+    def is_duplicate(self, image_path):
+        """True if image_path is within the threshold of the last frame that got a guidance."""
+        value = self.frame_hash(image_path)
+        if value is None or self.last_hash is None:
+            return False
+        if hamming(value, self.last_hash) <= self.threshold:
+            count('frames_deduplicated')
+            return True
+        return False
+
+    def accept(self, image_path):
+        """Record image_path as the last frame that got a guidance."""
+        self.last_hash = self.frame_hash(image_path)
+
+    def save(self):
+        """Write the hash index to disk."""
+        save_run_state(self.index_path, self.index)
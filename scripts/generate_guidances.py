@@ -14,15 +14,97 @@ import os
 import argparse
 import base64
 import json
-import requests
+import re
 import time
+import threading
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 from pathlib import Path
+import requests
 from dotenv import load_dotenv
 from tqdm import tqdm
+from result_cache import (ResultCache, make_key, DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_MB,
+                          file_signature, load_run_state, save_run_state, is_unchanged)
+from checkpoint import Checkpoint
+from http_utils import RETRY_STATUS_CODES, create_session, backoff_delay
+from payload import PayloadOptions, DEFAULT_LLM_PAYLOAD, FORMATS, encode_payload, optimize_payload, image_dimensions
+from metrics import timer, observe, count, report as report_metrics
+from watch import watch_directory, DEFAULT_POLL_INTERVAL
+from ingest import is_source_image, scan_files
+from frame_hash import FrameDeduplicator, DedupOptions, HASH_METHODS, DEFAULT_DEDUP_THRESHOLDS
+from change_regions import PageCache, changed_region_crop
+from prepared import (PreparedFrames, PreparedOptions, PREPARED_MODES, DEFAULT_PREPARED_MAX_EDGE,
+                      DEFAULT_PREPARED_WAIT)
+from context_budget import (ContextOptions, DEFAULT_CONTEXT, DROP_CHUNK, build_context, estimate_text_tokens,
+                            estimate_image_tokens)
 
 # Load environment variables from .env file
 load_dotenv()
 
+CLAUDE_MODEL = "claude-3-7-sonnet-latest"
+# Overridable so the script can be pointed at a local mock server
+CLAUDE_API_URL = os.getenv('ANTHROPIC_API_URL', "https://api.anthropic.com/v1/messages")
+CLAUDE_MAX_RETRIES = 5
+
+# Shared by every thread; connections to the API are kept alive between calls
+_http_session = create_session(pool_size=16)
+
+class AdaptiveRateLimiter:
+    """Paces Claude API calls using the rate-limit headers of earlier responses.
+    
+    Instead of sleeping a fixed time after every call, each response's
+    anthropic-ratelimit-* headers spread the remaining request budget evenly
+    over the time left until the limit resets, and retry-after is honoured
+    outright. One limiter is shared by all sessions processed concurrently.
+    """
+    
+    LIMIT_HEADERS = ('requests', 'tokens', 'input-tokens', 'output-tokens')
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_allowed = 0.0
+    
+    def wait(self):
+        """Block until the next request is allowed."""
+        with self._lock:
+            delay = self._next_allowed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    
+    def update(self, headers):
+        """Schedule the next request from a response's rate-limit headers."""
+        delay = 0.0
+        retry_after = headers.get('retry-after')
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                pass
+        
+        for limit in self.LIMIT_HEADERS:
+            remaining = headers.get(f'anthropic-ratelimit-{limit}-remaining')
+            reset = headers.get(f'anthropic-ratelimit-{limit}-reset')
+            if remaining is None or not reset:
+                continue
+            try:
+                remaining = int(remaining)
+                reset_at = datetime.fromisoformat(reset.replace('Z', '+00:00'))
+            except ValueError:
+                continue
+            until_reset = (reset_at - datetime.now(timezone.utc)).total_seconds()
+            if until_reset <= 0:
+                continue
+            if limit == 'requests':
+                # Spread the remaining requests evenly over the window
+                delay = max(delay, until_reset / (remaining + 1))
+            elif remaining <= 0:
+                delay = max(delay, until_reset)
+        
+        if delay > 0:
+            with self._lock:
+                self._next_allowed = max(self._next_allowed, time.monotonic() + delay)
+
 def read_system_prompt(prompt_path):
     """Read the system prompt from a file."""
     try:
@@ -32,55 +114,414 @@ def read_system_prompt(prompt_path):
         print(f"Error reading system prompt: {e}")
         return "You are DeskMate, an educational AI assistant. Provide guidance for the student's work."
 
-def encode_image_to_base64(image_path):
-    """Encode an image to base64."""
+# A base64-encoded image ready to drop into an API request; size is its
+# (width, height), read when it is encoded so budgeting needn't decode it
+EncodedImage = namedtuple('EncodedImage', ['media_type', 'data', 'size'], defaults=(None,))
+
+MEDIA_TYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg'
+}
+
+class EncodedImageCache:
+    """Small LRU of encoded images keyed by path and modification time.
+    
+    Each frame is sent twice, first as the current image and then as the
+    previous one, so keeping the last few encodings avoids reading and
+    encoding the same file again.
+    """
+    
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+            return encoded
+    
+    def put(self, key, encoded):
+        with self._lock:
+            self._entries[key] = encoded
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+_encoded_images = EncodedImageCache()
+
+def encode_image_to_base64(image_path, payload_options=None):
+    """Encode an image to base64, returning an EncodedImage.
+    
+    With payload_options the image is downscaled and re-encoded first.
+    """
     try:
-        with open(image_path, 'rb') as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
+        image_path = Path(image_path)
+        key = (str(image_path), image_path.stat().st_mtime_ns, payload_options)
+        encoded = _encoded_images.get(key)
+        if encoded is not None:
+            return encoded
+        
+        with timer('encode_image'):
+            with open(image_path, 'rb') as image_file:
+                image_bytes = image_file.read()
             
-            # Add the appropriate data URL prefix based on file extension
-            ext = image_path.suffix.lower()
-            if ext == '.png':
-                return f"data:image/png;base64,{encoded_string}"
-            elif ext in ['.jpg', '.jpeg']:
-                return f"data:image/jpeg;base64,{encoded_string}"
-            else:
-                # Default to JPEG if unknown
-                return f"data:image/jpeg;base64,{encoded_string}"
+            # Default to JPEG if the extension is unknown
+            media_type = MEDIA_TYPES.get(image_path.suffix.lower(), 'image/jpeg')
+            image_bytes, media_type = optimize_payload(image_bytes, media_type, payload_options, image_path.name)
+            
+            encoded = EncodedImage(media_type, base64.b64encode(image_bytes).decode('ascii'),
+                                   image_dimensions(image_bytes))
+        _encoded_images.put(key, encoded)
+        return encoded
     except Exception as e:
         print(f"Error encoding image {image_path}: {e}")
         return None
 
-def read_previous_guidances(guidance_file, max_guidances=10):
-    """Read previous guidances from a file."""
-    try:
-        if not os.path.exists(guidance_file):
+# What is sent for one frame: an EncodedImage and/or its OCR text, either may be None
+FrameInput = namedtuple('FrameInput', ['image', 'text'])
+NO_FRAME = FrameInput(None, None)
+
+def load_frame(image_path, payload_options=None, prepared=None, wait=0):
+    """Encode a frame for a request, returning a FrameInput.
+    
+    Without prepared (PreparedFrames), or if prepare_images.py hasn't handled
+    image_path, that is the encoded photo. Otherwise it is the OCR text of
+    the prepared page along with, in image_text mode or when the page has no
+    text (none was found, or OCR failed), its crop downscaled to the prepared
+    max_edge. wait is passed on to PreparedFrames.get.
+    """
+    frame = prepared.get(image_path, wait) if prepared is not None else None
+    if frame is None:
+        return FrameInput(encode_image_to_base64(image_path, payload_options), None)
+    
+    text = None
+    if frame.text is not None:
+        try:
+            text = frame.text.read_text(encoding='utf-8').strip() or None
+        except OSError as e:
+            print(f"Error reading {frame.text}: {e}")
+    if text is not None and prepared.options.mode == 'text':
+        return FrameInput(None, text)
+    
+    crop_payload = payload_options
+    if prepared.options.max_edge > 0:
+        crop_payload = (payload_options or DEFAULT_LLM_PAYLOAD)._replace(max_edge=prepared.options.max_edge)
+    return FrameInput(encode_image_to_base64(frame.image, crop_payload), text)
+
+GUIDANCE_SEPARATOR = '\n\n---\n\n'
+
+class GuidanceError(RuntimeError):
+    """Raised when the request for a frame failed and would fail again if repeated."""
+
+class TransientGuidanceError(GuidanceError):
+    """Raised when the request for a frame failed but may succeed later.
+    
+    Throttling, overload, server and network errors (including a stream
+    that was cut off) are transient once call_claude_api's retries are used up.
+    """
+
+# Stream error events that mean the API is busy rather than the request is bad
+TRANSIENT_STREAM_ERRORS = {'overloaded_error', 'api_error', 'rate_limit_error'}
+
+def tail_lines(path, count, chunk_size=8192):
+    """Read the last count lines of a file without reading the whole file."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b''
+        while position > 0 and data.count(b'\n') <= count:
+            read_size = min(chunk_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+    return [line for line in data.splitlines() if line.strip()][-count:]
+
+class GuidanceHistory:
+    """Rolling window of the most recent guidances written to a guidance file.
+    
+    The guidance file is only ever appended to. The window is loaded once at
+    startup and then updated in memory, so each frame no longer re-reads the
+    whole file. With use_index, every entry's byte offset and length are
+    also appended to a JSONL sidecar (<output_file>.index.jsonl), so resuming
+    a long session only reads the tail of the sidecar and seeks straight to
+    the last few entries.
+    
+    Once the window is full, the oldest guidances are dropped a chunk at a
+    time rather than one per frame, so the start of the history sent with
+    each request (and so its cached prefix, see call_claude_api) only moves
+    every few frames.
+    
+    A guidance that is being streamed is written as it arrives to
+    <output_file>.live, which is replaced by each new guidance, so readers
+    can follow it; the guidance file only ever receives complete entries.
+    Failed requests are not guidances: they are left out of the file and
+    the window and recorded in <output_file>.errors.jsonl instead.
+    """
+    
+    def __init__(self, output_file, max_guidances=10, use_index=True):
+        self.output_file = Path(output_file)
+        self.index_file = self.output_file.with_name(self.output_file.name + '.index.jsonl')
+        self.live_file = self.output_file.with_name(self.output_file.name + '.live')
+        self.errors_file = self.output_file.with_name(self.output_file.name + '.errors.jsonl')
+        self._live = None
+        self.use_index = use_index
+        self.recent = deque()
+        self.max_guidances = max_guidances
+        self.window = max(1, max_guidances)
+        self.load()
+    
+    def load(self):
+        """Load the most recent guidances from disk."""
+        self.recent.clear()
+        if not self.output_file.exists():
+            if self.index_file.exists():
+                self.index_file.unlink()
+            return
+        
+        try:
+            if not (self.use_index and self._load_from_index()):
+                self._load_from_file()
+        except Exception as e:
+            print(f"Error reading previous guidances: {e}")
+        while len(self.recent) > self.window:
+            self.recent.popleft()
+    
+    def _load_from_index(self):
+        """Seek to the entries listed at the tail of the sidecar; False if it is stale."""
+        if not self.index_file.exists():
+            return False
+        
+        records = [json.loads(line) for line in tail_lines(self.index_file, self.window)]
+        if not records:
+            return self.output_file.stat().st_size == 0
+        
+        # The sidecar is only trusted if it accounts for the whole guidance file
+        last = records[-1]
+        if last['offset'] + last['length'] != self.output_file.stat().st_size:
+            return False
+        
+        with open(self.output_file, 'rb') as f:
+            for record in records:
+                f.seek(record['offset'])
+                self.recent.append(f.read(record['length']).decode('utf-8'))
+        return True
+    
+    def _load_from_file(self):
+        """Parse the whole guidance file once, rebuilding the sidecar if enabled."""
+        data = self.output_file.read_bytes()
+        separator = GUIDANCE_SEPARATOR.encode('utf-8')
+        records = []
+        offset = 0
+        for block in data.split(separator):
+            if block.strip():
+                records.append({
+                    'image': block.split(b'\n', 1)[0].decode('utf-8').replace('Image: ', '').strip(),
+                    'offset': offset,
+                    'length': len(block)
+                })
+                self.recent.append(block.decode('utf-8').strip())
+            offset += len(block) + len(separator)
+        
+        if self.use_index:
+            with open(self.index_file, 'w', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+    
+    def guidances(self):
+        """Return the recent guidances, oldest first."""
+        if self.max_guidances <= 0:
             return []
+        return list(self.recent)
+    
+    def begin_live(self, image_name):
+        """Start the live file over for the guidance of image_name."""
+        self.end_live()
+        self._live = open(self.live_file, 'w', encoding='utf-8')
+        self._live.write(f"Image: {image_name}\n\n")
+        self._live.flush()
+    
+    def write_live(self, text):
+        """Add streamed text to the live file."""
+        if self._live is not None:
+            self._live.write(text)
+            self._live.flush()
+    
+    def end_live(self):
+        """Close the live file, if one is open."""
+        if self._live is not None:
+            self._live.close()
+            self._live = None
+    
+    def record_error(self, image_name, error):
+        """Record the GuidanceError of image_name's request, leaving the guidance file untouched."""
+        self.end_live()
+        with open(self.errors_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'time': datetime.now(timezone.utc).isoformat(), 'image': image_name,
+                                'error': str(error),
+                                'transient': isinstance(error, TransientGuidanceError)}) + '\n')
+    
+    def append(self, image_name, guidance):
+        """Append a guidance to the file (and sidecar) and to the in-memory window."""
+        self.end_live()
+        entry = f"Image: {image_name}\n\n{guidance}"
+        data = entry.encode('utf-8')
         
-        with open(guidance_file, 'r', encoding='utf-8') as f:
-            guidances = f.read().strip().split('\n\n---\n\n')
-            # Return the most recent guidances (up to max_guidances)
-            return guidances[-max_guidances:] if guidances else []
-    except Exception as e:
-        print(f"Error reading previous guidances: {e}")
-        return []
+        with open(self.output_file, 'ab') as f:
+            if f.tell() > 0:
+                f.write(GUIDANCE_SEPARATOR.encode('utf-8'))
+            offset = f.tell()
+            f.write(data)
+        
+        if self.use_index:
+            with open(self.index_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'image': image_name, 'offset': offset, 'length': len(data)}) + '\n')
+        
+        self.recent.append(entry)
+        if len(self.recent) > self.window:
+            for _ in range(max(1, min(DROP_CHUNK, self.window // 2))):
+                self.recent.popleft()
 
-def call_claude_api(system_prompt, images, previous_guidances):
-    """Call Claude API with the given prompt, images, and previous guidances."""
+def image_block(image, cache_point=False):
+    """Message content block for an EncodedImage."""
+    block = {
+        "type": "image",
+        "source": {
+            "type": "base64",
+            "media_type": image.media_type,
+            "data": image.data
+        }
+    }
+    if cache_point:
+        block["cache_control"] = {"type": "ephemeral"}
+    return block
+
+def iter_sse_events(response):
+    """Yield the JSON payload of each server-sent event in a streamed response."""
+    response.encoding = 'utf-8'
+    data = []
+    for line in response.iter_lines(decode_unicode=True):
+        if line:
+            # event: lines repeat the payload's type, and : lines are comments
+            if line.startswith('data:'):
+                data.append(line[5:].strip())
+        elif data:
+            yield json.loads('\n'.join(data))
+            data = []
+    if data:
+        yield json.loads('\n'.join(data))
+
+def read_message_stream(response, started, on_text=None, stats=None):
+    """Collect a streamed Messages API response, returning (text, usage).
+    
+    Each text delta is passed to on_text as soon as it arrives. The time from
+    started (a time.perf_counter() value) to the first delta is recorded as
+    claude_ttft, and as stats['ttft'] if a stats dict is given.
+    
+    Raises TransientGuidanceError if the stream ends before message_stop,
+    e.g. when the connection drops mid-answer, so a partial guidance is
+    never kept, and GuidanceError for an error event the API won't recover from.
+    """
+    parts = []
+    usage = {}
+    stop_reason = None
+    stopped = False
+    for event in iter_sse_events(response):
+        kind = event.get('type')
+        if kind == 'message_start':
+            usage.update(event['message'].get('usage', {}))
+        elif kind == 'content_block_delta' and event['delta'].get('type') == 'text_delta':
+            if not parts:
+                ttft = time.perf_counter() - started
+                observe('claude_ttft', ttft)
+                if stats is not None:
+                    stats['ttft'] = ttft
+            parts.append(event['delta']['text'])
+            if on_text is not None:
+                on_text(event['delta']['text'])
+        elif kind == 'message_delta':
+            usage.update(event.get('usage', {}))
+            stop_reason = event.get('delta', {}).get('stop_reason') or stop_reason
+        elif kind == 'message_stop':
+            stopped = True
+        elif kind == 'error':
+            error = event['error']
+            error_class = TransientGuidanceError if error.get('type') in TRANSIENT_STREAM_ERRORS else GuidanceError
+            raise error_class(f"Stream error: {error.get('message', error)}")
+    if not stopped or stop_reason is None:
+        raise TransientGuidanceError(f"Stream ended before the message was complete "
+                            f"({len(parts)} text deltas, stop_reason {stop_reason})")
+    return ''.join(parts), usage
+
+# Closes every request, after the images
+GUIDANCE_INSTRUCTIONS = ("Here are the latest images of the student's work. Please provide guidance. "
+                         "Respond ONLY with the guidance itself, no additional text or explanations about "
+                         "what you're doing.")
+
+def call_claude_api(system_prompt, images, previous_guidances, *, cache=None, rate_limiter=None, image_note=None,
+                    reference_image=None, prompt_cache=True, stream=False, on_text=None, stats=None,
+                    frame_texts=None, summarised=0):
+    """Call Claude API with the given prompt, images, and previous guidances, returning the guidance.
+    
+    image_note is added to the instructions, frame_texts (e.g. OCR text) are
+    sent after the images, and the first summarised previous_guidances are
+    summaries (see context_budget.build_context). With prompt_cache, the
+    stable start of the request is marked for API-side prompt caching. With
+    stream, each piece of text is passed to on_text(text) as it arrives. A
+    stats dict, if given, gets 'cached', 'usage', 'bytes_sent' and 'ttft'.
+    
+    A failed request raises TransientGuidanceError if it may succeed later,
+    otherwise GuidanceError.
+    """
     api_key = os.getenv('ANTHROPIC_API_KEY')
     if not api_key:
         raise ValueError("ANTHROPIC_API_KEY not found in environment variables or .env file")
     
+    # Identical prompt, images and history always map to the same cache entry
+    image_parts = [part for image in [reference_image] + list(images) if image
+                   for part in (image.media_type, image.data)]
+    cache_key = make_key('call_claude_api', CLAUDE_MODEL, system_prompt, previous_guidances, image_note or '',
+                         *image_parts, *([frame_texts] if frame_texts else []))
+    if cache is not None:
+        cached_guidance = cache.get_text(cache_key)
+        if stats is not None:
+            stats['cached'] = cached_guidance is not None
+        if cached_guidance is not None:
+            count('claude_cache_hits')
+            return cached_guidance
+        count('claude_cache_misses')
+    
     # Prepare the messages
     messages = []
     
-    # Add previous guidances as context
+    # What stays the same from one frame to the next comes first, and the end
+    # of each stable part gets one of the API's four cache breakpoints: the
+    # system prompt, the reference image, the end of the summaries and the
+    # end of the history. History is summarised and dropped a chunk at a time
+    # (see context_budget.build_context), so most frames the history is the
+    # previous one plus a guidance and is read from the cache; right after a
+    # chunk was summarised the summaries still are, and when the history's
+    # start moves only the system prompt and reference image are.
+    context_content = [image_block(reference_image, prompt_cache)] if reference_image else []
+    
+    # Add previous guidances as context, one block each so that an unchanged
+    # run of older guidances still matches the cached prefix
     if previous_guidances:
-        context_message = "Previous guidances:\n\n" + "\n\n---\n\n".join(previous_guidances)
+        for position, guidance in enumerate(previous_guidances):
+            prefix = "Previous guidances:\n\n" if position == 0 else "---\n\n"
+            context_content.append({"type": "text", "text": prefix + guidance})
+            if prompt_cache and position == summarised - 1:
+                context_content[-1]["cache_control"] = {"type": "ephemeral"}
+        if prompt_cache:
+            context_content[-1]["cache_control"] = {"type": "ephemeral"}
         messages.append({
             "role": "user",
-            "content": [{"type": "text", "text": context_message}]
+            "content": context_content
         })
+        context_content = []
         
         # Add a system message to acknowledge the context
         messages.append({
@@ -89,33 +530,23 @@ def call_claude_api(system_prompt, images, previous_guidances):
         })
     
     # Create the user message with images
-    user_content = []
+    user_content = context_content
     
     # Add text prompt with explicit instruction to only provide guidance
+    instructions = GUIDANCE_INSTRUCTIONS
+    if image_note:
+        instructions += " " + image_note
     user_content.append({
         "type": "text", 
-        "text": "Here are the latest images of the student's work. Please provide guidance. Respond ONLY with the guidance itself, no additional text or explanations about what you're doing."
+        "text": instructions
     })
     
     # Add images
-    for image_base64 in images:
-        if image_base64:
-            # Determine media type from base64 string
-            media_type = "image/jpeg"  # Default
-            if "data:image/png;base64," in image_base64:
-                media_type = "image/png"
-            
-            # Clean the base64 string
-            clean_base64 = image_base64.replace("data:image/png;base64,", "").replace("data:image/jpeg;base64,", "")
-            
-            user_content.append({
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": media_type,
-                    "data": clean_base64
-                }
-            })
+    for image in images:
+        if image:
+            user_content.append(image_block(image))
+    for text in frame_texts or []:
+        user_content.append({"type": "text", "text": text})
     
     # Add the user message with images
     messages.append({
@@ -124,46 +555,419 @@ def call_claude_api(system_prompt, images, previous_guidances):
     })
     
     # Prepare the API request
-    url = "https://api.anthropic.com/v1/messages"
+    url = CLAUDE_API_URL
     headers = {
         "Content-Type": "application/json",
         "x-api-key": api_key,
         "anthropic-version": "2023-06-01"
     }
     
+    system = system_prompt
+    if system_prompt and prompt_cache:
+        system = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+    
     data = {
-        "model": "claude-3-7-sonnet-latest",  # Updated to use Claude 3.7 Sonnet
+        "model": CLAUDE_MODEL,
         "max_tokens": 1024,
         "temperature": 0.7,
-        "system": system_prompt,
+        "system": system,
         "messages": messages
     }
+    if stream:
+        data["stream"] = True
     
-    # Make the API request
+    # Make the API request, retrying when throttled or overloaded
+    response = None
     try:
-        response = requests.post(url, headers=headers, json=data)
+        for attempt in range(CLAUDE_MAX_RETRIES + 1):
+            if rate_limiter is not None:
+                rate_limiter.wait()
+            started = time.perf_counter()
+            with timer('claude_request'):
+                response = _http_session.post(url, headers=headers, json=data, stream=stream)
+            count('claude_requests')
+            count('claude_bytes_sent', len(response.request.body or b''))
+            if stats is not None:
+                stats['bytes_sent'] = len(response.request.body or b'')
+            if rate_limiter is not None:
+                rate_limiter.update(response.headers)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == CLAUDE_MAX_RETRIES:
+                break
+            response.close()
+            count('claude_retries')
+            delay = backoff_delay(attempt, retry_after=response.headers.get('retry-after'))
+            print(f"Claude API returned {response.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
         response.raise_for_status()  # Raise an exception for HTTP errors
         
-        result = response.json()
-        return result["content"][0]["text"]
+        if stream:
+            with timer('claude_stream'), response:
+                guidance, usage = read_message_stream(response, started, on_text, stats)
+        else:
+            count('claude_bytes_received', len(response.content))
+            result = response.json()
+            usage = result.get("usage", {})
+            guidance = result["content"][0]["text"]
+        record_usage(usage)
+        if stats is not None:
+            stats['usage'] = usage
+        if cache is not None:
+            cache.put_text(cache_key, guidance)
+        return guidance
     except Exception as e:
         print(f"Error calling Claude API: {e}")
-        if response:
+        if response is not None:
             print(f"Response status: {response.status_code}")
-            print(f"Response body: {response.text}")
-        return f"Error generating guidance: {str(e)}"
+            if not stream or not response.ok:
+                print(f"Response body: {response.text}")
+        if isinstance(e, GuidanceError):
+            raise
+        transient = (isinstance(e, (requests.ConnectionError, requests.Timeout,
+                                    requests.exceptions.ChunkedEncodingError))
+                     or (response is not None and response.status_code in RETRY_STATUS_CODES))
+        error_class = TransientGuidanceError if transient else GuidanceError
+        raise error_class(f"Error generating guidance: {e}") from e
+
+def record_usage(usage):
+    """Add a response's token usage, including prompt cache reads and writes, to the metrics."""
+    count('claude_input_tokens', usage.get('input_tokens') or 0)
+    count('claude_output_tokens', usage.get('output_tokens') or 0)
+    count('claude_cache_read_tokens', usage.get('cache_read_input_tokens') or 0)
+    count('claude_cache_creation_tokens', usage.get('cache_creation_input_tokens') or 0)
+
+class CallLog:
+    """Optional JSONL file with one record per guidance request."""
+    
+    def __init__(self):
+        self.path = None
+        self._lock = threading.Lock()
+    
+    def open(self, path):
+        """Start appending records to path."""
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+    
+    def record(self, **fields):
+        """Append one record, if a log file is open."""
+        if self.path is None:
+            return
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(fields) + '\n')
+
+CALL_LOG = CallLog()
+
+def log_call(image_name, context, had_previous, stats, latency, ok=True):
+    """Report the size and latency of a guidance request, and add it to CALL_LOG.
+    
+    ok is False if the request failed.
+    """
+    usage = stats.get('usage', {})
+    input_tokens = ((usage.get('input_tokens') or 0) + (usage.get('cache_read_input_tokens') or 0)
+                    + (usage.get('cache_creation_input_tokens') or 0))
+    history = f"{context.verbatim} full + {context.summarised} summarised guidances"
+    if context.dropped:
+        history += f", {context.dropped} dropped"
+    if had_previous and not context.keep_previous:
+        history += ", previous frame dropped"
+    if stats.get('cached'):
+        size = "from result cache"
+    else:
+        size = f"~{context.tokens} input tokens estimated, {input_tokens} sent"
+        if usage.get('cache_read_input_tokens'):
+            size += f" ({usage['cache_read_input_tokens']} cached)"
+    if ok:
+        print(f"Guidance saved for {image_name} ({size}; {history}; {latency:.2f}s)")
+    else:
+        print(f"Guidance request failed for {image_name} after {latency:.2f}s "
+              f"(~{context.tokens} input tokens estimated; {history})")
+    
+    CALL_LOG.record(
+        time=datetime.now(timezone.utc).isoformat(),
+        image=image_name,
+        ok=ok,
+        result_cache=bool(stats.get('cached')),
+        estimated_input_tokens=context.tokens,
+        input_tokens=input_tokens,
+        cache_read_tokens=usage.get('cache_read_input_tokens') or 0,
+        output_tokens=usage.get('output_tokens') or 0,
+        bytes_sent=stats.get('bytes_sent', 0),
+        guidances_verbatim=context.verbatim,
+        guidances_summarised=context.summarised,
+        guidances_dropped=context.dropped,
+        previous_frame=had_previous and context.keep_previous,
+        latency_s=round(latency, 3),
+        ttft_s=round(stats['ttft'], 3) if 'ttft' in stats else None
+    )
+
+REFERENCE_IMAGE_PATH = Path("deskmate-website/public/homeworks/subject.png")
+
+def load_reference_image(payload_options=None):
+    """Encode the homework reference image, or return None if it is missing."""
+    if not REFERENCE_IMAGE_PATH.exists():
+        print(f"Warning: Reference image {REFERENCE_IMAGE_PATH} not found")
+        return None
+    print(f"Using reference image: {REFERENCE_IMAGE_PATH}")
+    return encode_image_to_base64(REFERENCE_IMAGE_PATH, payload_options)
+
+CHANGE_NOTES = {
+    'changed': "The last image is a close-up of the part of the page that changed since the previous frame.",
+    'unchanged': "The page has not visibly changed since the previous frame."
+}
+
+# Added to the instructions when frames come from prepare_images.py
+PREPARED_NOTES = {
+    'image_text': "The images are cropped, enhanced scans of the page, and the OCR text of the page follows them.",
+    'text': "The page is given as its OCR text instead of as an image."
+}
+
+def describe_change(previous_path, image_path, payload_options=None, pages=None):
+    """Describe what changed on the page since previous_path for the request.
+    
+    Returns (close-up EncodedImage or None, note), or None when the whole
+    previous frame should be sent instead. pages is the PageCache of the
+    sequence of frames.
+    """
+    status, crop = changed_region_crop(previous_path, image_path, pages)
+    if status == 'fallback':
+        return None
+    if crop is None:
+        return None, CHANGE_NOTES[status]
+    image_bytes, media_type = encode_payload(crop, payload_options or DEFAULT_LLM_PAYLOAD)
+    encoded = EncodedImage(media_type, base64.b64encode(image_bytes).decode('ascii'), image_dimensions(image_bytes))
+    return encoded, CHANGE_NOTES[status]
+
+def guidance_checkpoint(output_file, resume=False):
+    """Open the checkpoint manifest of a guidance file.
+    
+    Each manifest line records the size of the guidance file once that
+    frame's entry was appended. With resume, the two are reconciled after an
+    interrupted run: anything after the last recorded entry (written just
+    before a crash, before it could be recorded) is cut off, and frames whose
+    entries are no longer in the file are forgotten, so resuming neither
+    duplicates nor loses a guidance.
+    """
+    checkpoint = Checkpoint(output_file.parent / f".{output_file.name}.checkpoint.jsonl")
+    if not output_file.exists():
+        checkpoint.clear()
+        return checkpoint
+    if resume:
+        size = output_file.stat().st_size
+        checkpoint.forget([name for name, record in checkpoint.entries.items() if record['end'] > size])
+        committed = max((record['end'] for record in checkpoint.entries.values()), default=0)
+        if checkpoint.entries and committed < size:
+            print(f"Removing {size - committed} bytes of unrecorded guidance from {output_file.name}")
+            os.truncate(output_file, committed)
+    return checkpoint
+
+# What stays the same for every frame of a run: the system prompt and
+# reference image (EncodedImage or None) sent with each request, the
+# ResultCache and AdaptiveRateLimiter (either may be None), whether to mark
+# prompt cache breakpoints and stream responses, and the ContextOptions
+GuidanceSettings = namedtuple('GuidanceSettings', ['system_prompt', 'reference_image', 'cache', 'rate_limiter',
+                                                   'prompt_cache', 'stream', 'context_options'])
+
+def generate_frame_guidance(image_path, current, previous, history, settings, change=None, on_text=None):
+    """Generate and save the guidance for one frame, returning it (None if skipped).
+    
+    current and previous are the FrameInputs of the frame and the one before
+    it (NO_FRAME if there is none), settings its run's GuidanceSettings. If
+    the request fails, the failure is recorded (see
+    GuidanceHistory.record_error) and the GuidanceError from call_claude_api
+    is raised again.
+    
+    The latest images are sent in order: previous frame, current frame,
+    leaving out any that are missing. With change (from describe_change) the
+    previous frame is replaced by the close-up of what changed, if any, sent
+    after the current frame. With settings.stream, the guidance is written
+    to the history's live file as it is generated and each piece is also
+    passed to on_text(text), if given.
+    
+    The OCR texts of frames prepared by prepare_images.py (see load_frame)
+    are sent after the images; either image of a prepared frame may then be
+    None.
+    
+    The history and previous frame are fitted into settings.context_options'
+    token budget (see context_budget.build_context), and the estimated and
+    billed input size and latency of the call are logged.
+    """
+    current_image, current_text = current
+    previous_image, previous_text = previous
+    if current_image is None and current_text is None:
+        print(f"Skipping {image_path.name}: Could not encode image")
+        return None
+    
+    change_image, note = change if change is not None else (None, None)
+    if change is not None:
+        previous_image = previous_text = None
+    if current_text is not None:
+        note = ' '.join(filter(None, [PREPARED_NOTES['image_text' if current_image else 'text'], note]))
+    previous_block = f"OCR text of the previous frame:\n\n{previous_text}" if previous_text else None
+    current_block = f"OCR text of the latest frame:\n\n{current_text}" if current_text else None
+    
+    fixed_tokens = (estimate_text_tokens(settings.system_prompt) + estimate_text_tokens(GUIDANCE_INSTRUCTIONS)
+                    + estimate_text_tokens(note) + estimate_image_tokens(settings.reference_image)
+                    + estimate_image_tokens(current_image) + estimate_image_tokens(change_image)
+                    + estimate_text_tokens(current_block))
+    previous_tokens = estimate_image_tokens(previous_image) + estimate_text_tokens(previous_block)
+    context = build_context(history.guidances(), fixed_tokens, previous_tokens, settings.context_options)
+    if not context.keep_previous:
+        previous_image = previous_block = None
+    if change is not None:
+        images = [image for image in (current_image, change_image) if image]
+    else:
+        images = [image for image in (previous_image, current_image) if image]
+    frame_texts = [text for text in (previous_block, current_block) if text]
+    
+    callback = None
+    if settings.stream:
+        history.begin_live(image_path.name)
+        def callback(text):
+            history.write_live(text)
+            if on_text is not None:
+                on_text(text)
+    
+    print(f"Generating guidance for {image_path.name}...")
+    stats = {}
+    started = time.perf_counter()
+    try:
+        guidance = call_claude_api(settings.system_prompt, images, context.guidances, cache=settings.cache,
+                                   rate_limiter=settings.rate_limiter, image_note=note,
+                                   reference_image=settings.reference_image, prompt_cache=settings.prompt_cache,
+                                   stream=settings.stream, on_text=callback, stats=stats, frame_texts=frame_texts,
+                                   summarised=context.summarised)
+    except GuidanceError as e:
+        # A failure is kept out of the guidance file, so a resumed or later
+        # run can retry the frame without leaving a stale entry behind
+        history.record_error(image_path.name, e)
+        log_call(image_path.name, context, previous_tokens > 0, stats, time.perf_counter() - started, False)
+        raise
+    history.append(image_path.name, guidance)
+    log_call(image_path.name, context, previous_tokens > 0, stats, time.perf_counter() - started)
+    return guidance
+
+class GuidanceRun:
+    """Guidances for a sequence of frames, written to one output file.
+    
+    Holds what outlives a frame: the guidance history, the checkpoint
+    manifest, the run state (signatures of the finished frames) and the
+    deduplicator. process_images and watch_images hand each frame to
+    guide(), so frames are skipped, sent, recorded and failed the same way
+    in both. With save_every_frame, the run state and hash index are written
+    after every frame instead of only by save().
+    """
+    
+    def __init__(self, output_file, settings, max_previous=10, use_index=True, dedup=None, resume=False,
+                 save_every_frame=False):
+        self.output_file = Path(output_file)
+        self.output_file.parent.mkdir(parents=True, exist_ok=True)
+        self.settings = settings
+        self.state_path = self.output_file.parent / f".{self.output_file.name}.state.json"
+        self.run_state = load_run_state(self.state_path)
+        self.checkpoint = guidance_checkpoint(self.output_file, resume)
+        # Load the recent guidances once; they are kept up to date in memory
+        self.history = GuidanceHistory(self.output_file, max_previous, use_index)
+        self.deduplicator = FrameDeduplicator.for_output(self.output_file, dedup)
+        self.save_every_frame = save_every_frame
+    
+    def is_finished(self, image_path, since_last_run=True, resume=True):
+        """Whether image_path is unchanged since the last run or recorded in the checkpoint manifest."""
+        return ((since_last_run and is_unchanged(image_path, self.run_state))
+                or (resume and self.checkpoint.is_done(image_path)))
+    
+    def mark_finished(self, image_path, **extra):
+        """Record image_path as finished, after whatever the guidance file holds now."""
+        self.run_state[image_path.name] = file_signature(image_path)
+        end = self.output_file.stat().st_size if self.output_file.exists() else 0
+        self.checkpoint.mark_done(image_path, end=end, **extra)
+        if self.save_every_frame:
+            self.save()
+    
+    def guide(self, image_path, previous_path, current, previous, change=None, on_text=None):
+        """Generate and record the guidance of image_path, returning it (None if skipped).
+        
+        previous_path is the frame sent as the previous one, or None. current
+        and previous return the FrameInputs of the two frames, and change, if
+        given, what changed between them (see describe_change); they are
+        only called once the frame is known not to be a duplicate. A frame
+        whose request was rejected is recorded as finished without a
+        guidance; TransientGuidanceError is left to the caller.
+        """
+        deduplicator = self.deduplicator
+        try:
+            if deduplicator is not None and previous_path is not None and deduplicator.is_duplicate(image_path):
+                print(f"Skipping {image_path.name}: no change since {previous_path.name}")
+                self.mark_finished(image_path)
+                return None
+            
+            with timer('frame_latency'):
+                frame_change = change() if change is not None and previous_path is not None else None
+                previous_frame = previous() if previous_path is not None and frame_change is None else NO_FRAME
+                guidance = generate_frame_guidance(image_path, current(), previous_frame, self.history,
+                                                   self.settings, change=frame_change, on_text=on_text)
+        except TransientGuidanceError:
+            raise
+        except GuidanceError:
+            # Retrying would be rejected again, so the frame is recorded as
+            # finished without a guidance rather than blocking every later run
+            print(f"Skipping {image_path.name} because its request was rejected; "
+                  f"see {self.history.errors_file.name}")
+            self.mark_finished(image_path, failed=True)
+            return None
+        except Exception as e:
+            print(f"Error processing {image_path.name}: {e}")
+            return None
+        
+        if guidance is not None:
+            if deduplicator is not None:
+                deduplicator.accept(image_path)
+            self.mark_finished(image_path)
+        return guidance
+    
+    def save(self):
+        """Write the run state and the hash index to disk."""
+        save_run_state(self.state_path, self.run_state)
+        if self.deduplicator is not None:
+            self.deduplicator.save()
+    
+    def close(self):
+        """Save everything and close the checkpoint manifest."""
+        self.checkpoint.close()
+        self.save()
 
-def process_images(input_dir, output_file, system_prompt_path, max_previous=10):
-    """Process images in a directory and generate guidances."""
+def process_images(input_dir, output_file, system_prompt_path, max_previous=10, cache=None,
+                   since_last_run=False, rate_limiter=None, prefetch=2, use_index=True,
+                   payload_options=DEFAULT_LLM_PAYLOAD, dedup=None, send_changes=False, prompt_cache=True,
+                   stream=False, resume=False, context_options=DEFAULT_CONTEXT, prepared=None):
+    """Process images in a directory and generate guidances.
+    
+    Guidances are generated strictly in order, since each one depends on the
+    previous ones, but the next prefetch frames are read and encoded on a
+    background thread while the current request is in flight. With dedup
+    (DedupOptions), frames whose page looks the same as the last frame that
+    got a guidance are skipped, and that frame is sent as the previous one.
+    With send_changes, a close-up of what changed since the previous frame
+    is sent instead of the whole previous frame whenever one can be found.
+    With prompt_cache, the stable start of each request is marked for
+    API-side prompt caching (see call_claude_api). With stream, responses
+    are streamed into <output_file>.live as they are generated. The history
+    sent with each request is fitted into context_options (ContextOptions).
+    With prepared (PreparedOptions), frames that prepare_images.py has
+    handled are sent as their crop and/or OCR text (see load_frame).
+    
+    Every finished frame is recorded in a checkpoint manifest next to
+    output_file as soon as its guidance is written; with resume, recorded
+    frames are skipped (see guidance_checkpoint). A request that failed but
+    may succeed later (TransientGuidanceError) stops the run at that frame,
+    so resuming carries on from it in order; one that would fail again is
+    recorded in <output_file>.errors.jsonl and its frame skipped.
+    """
     # Read system prompt
     system_prompt = read_system_prompt(system_prompt_path)
     
-    # Get all image files and sort them
-    image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']
-    image_files = sorted([
-        f for f in Path(input_dir).iterdir() 
-        if f.suffix.lower() in image_extensions and not f.name.endswith('_processed.jpg')
-    ])
+    # Frames depend on the ones before them, so they are handled in name
+    # order, which needs the whole listing; the images themselves are only
+    # read a few frames ahead (see encoded_frame)
+    image_files = sorted(scan_files(input_dir, is_source_image))
     
     if not image_files:
         print(f"No image files found in {input_dir}")
@@ -171,76 +975,237 @@ def process_images(input_dir, output_file, system_prompt_path, max_previous=10):
     
     print(f"Found {len(image_files)} images to process")
     
-    # Create output directory if it doesn't exist
-    output_file = Path(output_file)
-    output_file.parent.mkdir(parents=True, exist_ok=True)
+    prepared_frames = PreparedFrames(prepared.directory or input_dir, prepared) if prepared else None
     
-    # Get the reference image path
-    reference_image_path = Path("deskmate-website/public/homeworks/subject.png")
-    if not reference_image_path.exists():
-        print(f"Warning: Reference image {reference_image_path} not found")
-        reference_image = None
-    else:
-        reference_image = encode_image_to_base64(reference_image_path)
-        print(f"Using reference image: {reference_image_path}")
+    if rate_limiter is None:
+        rate_limiter = AdaptiveRateLimiter()
+    settings = GuidanceSettings(system_prompt, load_reference_image(payload_options), cache, rate_limiter,
+                                prompt_cache, stream, context_options)
+    run = GuidanceRun(output_file, settings, max_previous, use_index, dedup, resume)
+    
+    # Images unchanged since the last run already have guidance in output_file
+    if since_last_run:
+        skipped = sum(1 for f in image_files if run.is_finished(f, resume=False))
+        print(f"Skipping {skipped} images unchanged since the last run")
+    if resume:
+        finished = sum(1 for f in image_files if run.is_finished(f, since_last_run=False))
+        print(f"Resuming: skipping {finished} images that already have a guidance")
+    
+    # Indices of the frames that still need a guidance
+    todo = [i for i, f in enumerate(image_files) if not run.is_finished(f, since_last_run, resume)]
+    
+    deduplicator = run.deduplicator
+    # Index of the last frame that got a guidance, if it is still relevant
+    last_guided = None
+    if deduplicator is not None and todo and todo[0] > 0:
+        last_guided = todo[0] - 1
+        deduplicator.accept(image_files[last_guided])
+    
+    encoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='encode')
+    encoded = {}
+    # Close-ups of what changed, keyed by (previous, current) frame index
+    changes = {}
+    pages = PageCache(max_entries=prefetch + 3) if send_changes else None
+    
+    def encoded_frame(index):
+        # Each frame is needed as "current" and then as "previous"; encode it once
+        if index not in encoded:
+            encoded[index] = encoder.submit(load_frame, image_files[index], payload_options, prepared_frames)
+        return encoded[index]
+    
+    def frame_change(previous, index):
+        # Detected on the encoder thread too, so it is usually ready before it is needed
+        if (previous, index) not in changes:
+            changes[previous, index] = encoder.submit(describe_change, image_files[previous], image_files[index],
+                                                      payload_options, pages)
+        return changes[previous, index]
     
     # Process each image
-    for i, image_path in enumerate(tqdm(image_files, desc="Processing images")):
+    for position, i in enumerate(tqdm(todo, desc=f"Processing {Path(input_dir).name}")):
+        image_path = image_files[i]
+        
+        # Queue the upcoming frames so they are encoded while this request is in flight
+        for upcoming in todo[position:position + prefetch + 1]:
+            if upcoming > 0:
+                encoded_frame(upcoming - 1)
+            encoded_frame(upcoming)
+            if deduplicator is not None:
+                encoder.submit(deduplicator.frame_hash, image_files[upcoming])
+            # Guess the frame just before is the previous one; with dedup it may not be
+            if send_changes and upcoming > 0:
+                frame_change(upcoming - 1, upcoming)
+        
+        # Without dedup the previous frame is always the one just before
+        previous = last_guided if deduplicator is not None and last_guided is not None else i - 1
+        for index in [k for k in encoded if k < i - 1 and k != previous]:
+            del encoded[index]
+        for key in [key for key in changes if key[1] < i]:
+            del changes[key]
+        
         try:
-            # Read previous guidances
-            previous_guidances = read_previous_guidances(output_file, max_previous)
-            
-            # Get the current image and the previous image (if available)
-            current_images = []
-            
-            # Always add the reference image first if available
-            if reference_image:
-                current_images.append(reference_image)
-            
-            # Add the previous image if available
-            if i > 0:
-                prev_image = encode_image_to_base64(image_files[i-1])
-                if prev_image:
-                    current_images.append(prev_image)
-            
-            # Add the current image
-            current_image = encode_image_to_base64(image_path)
-            if current_image:
-                current_images.append(current_image)
-            
-            # Skip if no images are available
-            if not current_images:
-                print(f"Skipping {image_path.name}: Could not encode image")
+            guidance = run.guide(image_path, image_files[previous] if previous >= 0 else None,
+                                 encoded_frame(i).result, lambda: encoded_frame(previous).result(),
+                                 (lambda: frame_change(previous, i).result()) if send_changes else None)
+        except TransientGuidanceError:
+            # Each guidance builds on the ones before it, so carrying on would
+            # leave a gap that can only be filled out of order
+            print(f"Stopping at {image_path.name} because its request failed; "
+                  f"rerun with --resume to continue from it")
+            break
+        if guidance is not None:
+            last_guided = i
+    
+    encoder.shutdown(wait=False, cancel_futures=True)
+    run.close()
+    if cache is not None:
+        cache.evict()
+    
+    print("Processing complete!")
+
+def watch_images(input_dir, output_file, system_prompt_path, max_previous=10, cache=None, rate_limiter=None,
+                 use_index=True, payload_options=DEFAULT_LLM_PAYLOAD, poll_interval=DEFAULT_POLL_INTERVAL,
+                 idle_timeout=0, on_guidance=None, dedup=None, send_changes=False, prompt_cache=True,
+                 stream=False, on_text=None, context_options=DEFAULT_CONTEXT, prepared=None):
+    """Generate guidances for frames as they are added to input_dir, until interrupted.
+    
+    The system prompt, reference image, guidance history, rate limiter and
+    HTTP pool are set up once and kept warm between frames. Frames already in
+    the directory are handled first; ones that already got a guidance (per
+    the run state, saved after every frame) are skipped, so restarting the
+    watcher picks up where it left off; frames are also recorded in the
+    checkpoint manifest, as with process_images(resume=True). A frame whose
+    request fails, even transiently, is skipped rather than retried later.
+    on_guidance(image_path, guidance) is
+    called after each guidance is saved. dedup, send_changes, prompt_cache,
+    stream, context_options and prepared work as in process_images; a new
+    frame is waited for until prepare_images.py has recorded it, for up to
+    prepared.wait seconds, and then sent as the photo.
+    While a guidance is streamed, on_text(image_path, text) is called with
+    each piece of it.
+    """
+    system_prompt = read_system_prompt(system_prompt_path)
+    
+    prepared_frames = PreparedFrames(prepared.directory or input_dir, prepared) if prepared else None
+    if rate_limiter is None:
+        rate_limiter = AdaptiveRateLimiter()
+    settings = GuidanceSettings(system_prompt, load_reference_image(payload_options), cache, rate_limiter,
+                                prompt_cache, stream, context_options)
+    run = GuidanceRun(output_file, settings, max_previous, use_index, dedup, resume=True, save_every_frame=True)
+    pages = PageCache() if send_changes else None
+    wait = prepared.wait if prepared else 0
+    
+    previous_path = None
+    try:
+        for image_path in watch_directory(input_dir, is_source_image, include_existing=True,
+                                          poll_interval=poll_interval, idle_timeout=idle_timeout):
+            if run.is_finished(image_path):
+                previous_path = image_path
+                if run.deduplicator is not None:
+                    run.deduplicator.accept(image_path)
                 continue
             
-            # Call Claude API
-            print(f"Generating guidance for {image_path.name}...")
-            guidance = call_claude_api(system_prompt, current_images, previous_guidances)
-            
-            # Save the guidance
-            with open(output_file, 'a', encoding='utf-8') as f:
-                if os.path.getsize(output_file) > 0:
-                    f.write("\n\n---\n\n")
-                f.write(f"Image: {image_path.name}\n\n{guidance}")
-            
-            print(f"Guidance saved for {image_path.name}")
-            
-            # Add a small delay to avoid rate limiting
-            time.sleep(1)
-            
-        except Exception as e:
-            print(f"Error processing {image_path.name}: {e}")
+            def current():
+                return load_frame(image_path, payload_options, prepared_frames, wait)
+            def previous():
+                # Encoded as the current frame last time, so this is a cache hit
+                return load_frame(previous_path, payload_options, prepared_frames)
+            def change():
+                return describe_change(previous_path, image_path, payload_options, pages)
+            frame_text = None
+            if on_text is not None:
+                frame_text = lambda text, image_path=image_path: on_text(image_path, text)
+            try:
+                guidance = run.guide(image_path, previous_path, current, previous,
+                                     change if send_changes else None, frame_text)
+            except TransientGuidanceError:
+                # By the time it could be retried, the student has moved on
+                print(f"Skipping {image_path.name} because its request failed")
+                run.mark_finished(image_path, failed=True)
+                guidance = None
+            if guidance is not None and on_guidance is not None:
+                on_guidance(image_path, guidance)
+            # As in process_images: with dedup the previous frame is the last
+            # one that got a guidance, otherwise the one just before
+            if guidance is not None or run.deduplicator is None:
+                previous_path = image_path
+    except KeyboardInterrupt:
+        print("\nStopped watching")
     
-    print("Processing complete!")
+    run.close()
+    if cache is not None:
+        cache.evict()
+
+def find_sessions(input_dir):
+    """Return the sub-folders of input_dir, each holding one study session's images."""
+    return sorted(d for d in Path(input_dir).iterdir() if d.is_dir() and not d.name.startswith('.'))
+
+def session_prepared(prepared, session):
+    """The PreparedOptions of one session folder."""
+    if prepared is None or prepared.directory is None:
+        return prepared
+    return prepared._replace(directory=Path(prepared.directory) / session.name)
+
+def process_sessions(input_dir, output_file, system_prompt_path, max_previous=10, cache=None,
+                     since_last_run=False, session_workers=4, use_index=True,
+                     payload_options=DEFAULT_LLM_PAYLOAD, dedup=None, send_changes=False,
+                     prompt_cache=True, stream=False, resume=False, context_options=DEFAULT_CONTEXT,
+                     prepared=None):
+    """Generate guidances for every session sub-folder of input_dir concurrently.
+    
+    Sessions are independent of each other, so they run in parallel; within a
+    session, frames are still processed in order. Each session writes to its
+    own output file, named like output_file inside a folder named after the
+    session. With prepared, a prepared.directory holds one folder per
+    session, like input_dir. Returns the list of (session_dir, output_file) pairs.
+    """
+    sessions = find_sessions(input_dir)
+    if not sessions:
+        print(f"No session folders found in {input_dir}")
+        return []
+    
+    print(f"Found {len(sessions)} sessions to process")
+    output_file = Path(output_file)
+    outputs = [(session, output_file.parent / session.name / output_file.name) for session in sessions]
+    
+    # All sessions share one API key, so they share one rate limiter too
+    rate_limiter = AdaptiveRateLimiter()
+    
+    with ThreadPoolExecutor(max_workers=max(1, session_workers), thread_name_prefix='session') as executor:
+        futures = {
+            executor.submit(process_images, session, session_output, system_prompt_path, max_previous,
+                            cache, since_last_run, rate_limiter, use_index=use_index,
+                            payload_options=payload_options, dedup=dedup,
+                            send_changes=send_changes, prompt_cache=prompt_cache, stream=stream,
+                            resume=resume, context_options=context_options,
+                            prepared=session_prepared(prepared, session)): session
+            for session, session_output in outputs
+        }
+        for future, session in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error processing session {session.name}: {e}")
+    
+    return outputs
+
+TTS_API_URL = os.getenv('ELEVENLABS_API_URL', "https://api.elevenlabs.io/v1/text-to-speech")
+TTS_MAX_RETRIES = 3
+TTS_CHUNK_SIZE = 64 * 1024
+TTS_HASH_FILE = '.speech_hashes.json'
 
 def text_to_speech(text, output_file, voice_id="JBFqnCBsd6RMkjVDRZzb", model_id="eleven_multilingual_v2"):
-    """Convert text to speech using ElevenLabs API and save to file."""
+    """Convert text to speech using ElevenLabs API and save to file.
+    
+    The audio is streamed to a temporary file in chunks and renamed into
+    place once complete, so it is never held in memory as a whole and an
+    interrupted download never leaves a truncated MP3 behind.
+    """
     api_key = os.getenv('ELEVENLABS_API_KEY')
     if not api_key:
         print("Error: ELEVENLABS_API_KEY not found in environment variables or .env file")
         return False
     
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
+    url = f"{TTS_API_URL}/{voice_id}"
     
     headers = {
         "xi-api-key": api_key,
@@ -256,25 +1221,90 @@ def text_to_speech(text, output_file, voice_id="JBFqnCBsd6RMkjVDRZzb", model_id=
         }
     }
     
+    output_file = Path(output_file)
+    tmp_file = output_file.with_name(f".{output_file.name}.tmp")
     try:
         print(f"Converting text to speech...")
-        response = requests.post(url, json=data, headers=headers)
+        for attempt in range(TTS_MAX_RETRIES + 1):
+            with timer('tts_request'):
+                response = _http_session.post(url, json=data, headers=headers, stream=True)
+            count('tts_requests')
+            count('tts_bytes_sent', len(response.request.body or b''))
+            if response.status_code not in RETRY_STATUS_CODES or attempt == TTS_MAX_RETRIES:
+                break
+            response.close()
+            count('tts_retries')
+            delay = backoff_delay(attempt, retry_after=response.headers.get('retry-after'))
+            print(f"Text-to-speech returned {response.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
         
-        if response.status_code == 200:
-            # Save the audio content to a file
-            with open(output_file, 'wb') as f:
-                f.write(response.content)
-            print(f"Speech saved to {output_file}")
-            return True
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
-            return False
+        with response:
+            if response.status_code == 200:
+                # Stream the audio content to disk
+                with timer('tts_download'), open(tmp_file, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=TTS_CHUNK_SIZE):
+                        f.write(chunk)
+                        count('tts_bytes_received', len(chunk))
+                os.replace(tmp_file, output_file)
+                print(f"Speech saved to {output_file}")
+                return True
+            else:
+                print(f"Error: {response.status_code} - {response.text}")
+                return False
     except Exception as e:
         print(f"Error in text-to-speech conversion: {e}")
+        if tmp_file.exists():
+            tmp_file.unlink()
         return False
 
-def process_guidances_to_speech(guidance_file, output_dir):
-    """Process all guidances in a file and convert them to speech."""
+# End of a sentence: terminal punctuation (and any closing quotes or
+# brackets) followed by whitespace, so "3.5" or "e.g." mid-stream don't count
+SENTENCE_END = re.compile(r'[.!?]["\')\]]*\s')
+
+class FirstSentence:
+    """Picks the first sentence out of streamed text as soon as it is complete.
+    
+    feed() returns the sentence once, when the text so far contains it;
+    sentences shorter than min_chars are joined with the next one so a bare
+    "Good." isn't synthesised on its own.
+    """
+    
+    def __init__(self, min_chars=20):
+        self.text = ''
+        self.sentence = None
+        self.min_chars = min_chars
+    
+    def feed(self, text):
+        """Add streamed text, returning the first sentence if it just completed."""
+        if self.sentence is not None:
+            return None
+        self.text += text
+        stripped = self.text.lstrip()
+        match = SENTENCE_END.search(stripped, min(self.min_chars, len(stripped)))
+        if match is None:
+            return None
+        self.sentence = stripped[:match.end()].strip()
+        return self.sentence
+    
+    def rest(self, guidance):
+        """The part of the full guidance after the first sentence."""
+        guidance = guidance.strip()
+        if not guidance.startswith(self.sentence):
+            # The stream failed after the first sentence
+            return guidance
+        return guidance[len(self.sentence):].strip()
+
+def speech_hash(text, voice_id="JBFqnCBsd6RMkjVDRZzb", model_id="eleven_multilingual_v2"):
+    """Hash identifying the speech synthesised for a guidance text."""
+    return make_key('text_to_speech', voice_id, model_id, text)
+
+def process_guidances_to_speech(guidance_file, output_dir, workers=4):
+    """Process all guidances in a file and convert them to speech.
+    
+    Guidances are synthesised concurrently by up to workers threads.
+    Guidances whose _speech.mp3 was already generated from the same text
+    (tracked in .speech_hashes.json in output_dir) are skipped.
+    """
     try:
         # Create output directory if it doesn't exist
         output_dir = Path(output_dir)
@@ -285,12 +1315,18 @@ def process_guidances_to_speech(guidance_file, output_dir):
             content = f.read()
         
         # Split into individual guidances
-        guidances = content.split('\n\n---\n\n')
+        guidances = content.split(GUIDANCE_SEPARATOR)
         
         print(f"Found {len(guidances)} guidances to process")
         
-        # Process each guidance
-        for i, guidance in enumerate(tqdm(guidances, desc="Converting to speech")):
+        hash_path = output_dir / TTS_HASH_FILE
+        hashes = load_run_state(hash_path)
+        
+        # The latest guidance of each image; an image listed more than once
+        # (e.g. after a rerun appended to the file) gets one speech file, so
+        # two workers never write the same output
+        latest = {}
+        for i, guidance in enumerate(guidances):
             # Extract the image name and guidance text
             parts = guidance.split('\n\n', 1)
             if len(parts) < 2:
@@ -306,9 +1342,32 @@ def process_guidances_to_speech(guidance_file, output_dir):
             # Create output filename based on the image name
             output_file = output_dir / f"{Path(image_name).stem}_speech.mp3"
             
-            # Convert to speech
-            text_to_speech(guidance_text, output_file)
-            
+            latest.pop(output_file, None)
+            latest[output_file] = guidance_text
+        
+        # Collect the guidances that still need speech
+        jobs = []
+        for output_file, guidance_text in latest.items():
+            text_hash = speech_hash(guidance_text)
+            if output_file.exists() and hashes.get(output_file.name) == text_hash:
+                continue
+            jobs.append((guidance_text, output_file, text_hash))
+        
+        if len(jobs) < len(latest):
+            print(f"Skipping {len(latest) - len(jobs)} guidances with up-to-date speech")
+        
+        # Convert to speech
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='tts') as executor:
+            futures = {
+                executor.submit(text_to_speech, guidance_text, output_file): (output_file, text_hash)
+                for guidance_text, output_file, text_hash in jobs
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Converting to speech"):
+                output_file, text_hash = futures[future]
+                if future.result():
+                    hashes[output_file.name] = text_hash
+        
+        save_run_state(hash_path, hashes)
         print("Speech conversion complete!")
         return True
     except Exception as e:
@@ -324,14 +1383,78 @@ def main():
     parser.add_argument('--tts', action='store_true', help='Convert guidances to speech using ElevenLabs')
     parser.add_argument('--tts_only', action='store_true', help='Only convert existing guidances to speech, skip image processing')
     parser.add_argument('--tts_output_dir', default='speech', help='Directory to save speech files (defaults to "speech")')
+    parser.add_argument('--tts_workers', type=int, default=4, help='Number of guidances converted to speech at once')
+    parser.add_argument('--cache_dir', default=str(DEFAULT_CACHE_DIR), help='Directory for the persistent result cache')
+    parser.add_argument('--cache_max_mb', type=int, default=DEFAULT_CACHE_MAX_MB, help='Maximum size of the result cache in MB')
+    parser.add_argument('--no-cache', action='store_true', help='Disable the persistent result cache')
+    parser.add_argument('--since-last-run', action='store_true', help='Only generate guidances for images that are new or changed since the last run')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run: skip images whose guidance is recorded in the checkpoint '
+                             'manifest and drop any guidance written after the last recorded one')
+    parser.add_argument('--sessions', action='store_true',
+                        help='Treat each sub-folder of input_dir as a separate session and process them concurrently')
+    parser.add_argument('--session_workers', type=int, default=4, help='Number of sessions processed at once (with --sessions)')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and generate guidances for new images as they are added to input_dir (Ctrl+C to stop)')
+    parser.add_argument('--poll_interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help='Seconds between directory scans with --watch when watchdog is not installed')
+    parser.add_argument('--watch_idle_exit', type=float, default=0,
+                        help='With --watch, stop after this many seconds without new images (0 = run until interrupted)')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Skip frames whose page has not visibly changed since the last frame that got a guidance')
+    parser.add_argument('--dedup_hash', choices=HASH_METHODS, default=HASH_METHODS[0],
+                        help='Perceptual hash used to compare frames (with --dedup)')
+    parser.add_argument('--dedup_threshold', type=int,
+                        help='Maximum Hamming distance, out of 256 bits, for a frame to count as unchanged '
+                             '(with --dedup; defaults to ' +
+                             ', '.join(f'{t} for {m}' for m, t in DEFAULT_DEDUP_THRESHOLDS.items()) + ')')
+    parser.add_argument('--send_changes', action='store_true',
+                        help='Send a close-up of what changed on the page instead of the whole previous frame')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream responses into <output_file>.live as they are generated; with --watch --tts the '
+                             'first sentence is sent to speech (_speech_1.mp3) before the rest (_speech_2.mp3) is generated')
+    parser.add_argument('--context_budget', type=int, default=DEFAULT_CONTEXT.budget,
+                        help='Estimated input tokens allowed per request; older guidances are summarised or dropped, '
+                             'and then the previous frame, to stay within it (0 = unlimited)')
+    parser.add_argument('--verbatim_guidances', type=int, default=DEFAULT_CONTEXT.verbatim,
+                        help='Number of most recent guidances sent in full; older ones are sent as one-line summaries')
+    parser.add_argument('--call_log', help='Append the estimated and billed input tokens and the latency of every request to this JSONL file')
+    parser.add_argument('--prepared', choices=PREPARED_MODES,
+                        help='Send the crop and OCR text written by prepare_images.py instead of the original photo: '
+                             'a small copy of the crop plus its text (image_text), or the text alone (text)')
+    parser.add_argument('--prepared_dir',
+                        help='Output folder of prepare_images.py (defaults to input_dir; with --sessions, '
+                             'holds one folder per session)')
+    parser.add_argument('--prepared_max_edge', type=int, default=DEFAULT_PREPARED_MAX_EDGE,
+                        help='Downscale prepared crops to this long edge in pixels (0 = as for photos, with --prepared)')
+    parser.add_argument('--prepared_wait', type=float, default=DEFAULT_PREPARED_WAIT,
+                        help='With --watch --prepared, seconds to wait for prepare_images.py to finish a new image '
+                             'before sending the original photo')
+    parser.add_argument('--no-prompt-cache', action='store_true',
+                        help='Do not mark the system prompt, reference image and older guidances for API-side prompt caching')
+    parser.add_argument('--no-guidance-index', action='store_true',
+                        help='Do not keep the JSONL offset index next to the guidance file')
+    parser.add_argument('--payload_max_edge', type=int, default=DEFAULT_LLM_PAYLOAD.max_edge,
+                        help='Downscale uploaded images to this long edge in pixels (0 = send originals untouched)')
+    parser.add_argument('--payload_format', choices=sorted(FORMATS), default=DEFAULT_LLM_PAYLOAD.format,
+                        help='Encoding for downscaled uploads')
+    parser.add_argument('--payload_quality', type=int, default=DEFAULT_LLM_PAYLOAD.quality,
+                        help='Encoder quality for downscaled uploads')
+    parser.add_argument('--profile', action='store_true', help='Print a per-stage timing summary at the end of the run')
+    parser.add_argument('--metrics_file', help='Write stage timings and counters to this file (.prom for Prometheus text format, JSONL otherwise)')
     args = parser.parse_args()
     
+    run(args)
+    report_metrics(args.profile, args.metrics_file)
+
+def run(args):
+    """Generate guidances and/or speech as requested by the parsed command-line arguments."""
     # If only converting to speech, skip the image processing
     if args.tts_only:
         if not os.path.exists(args.output_file):
             print(f"Error: Guidance file {args.output_file} not found")
             return
-        process_guidances_to_speech(args.output_file, args.tts_output_dir)
+        process_guidances_to_speech(args.output_file, args.tts_output_dir, args.tts_workers)
         return
     
     # Check if ANTHROPIC_API_KEY is set
@@ -341,7 +1464,47 @@ def main():
         return
     
     # Process images
-    process_images(args.input_dir, args.output_file, args.system_prompt, args.max_previous)
+    cache = None if args.no_cache else ResultCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+    payload_options = None
+    if args.payload_max_edge > 0:
+        payload_options = PayloadOptions(args.payload_max_edge, args.payload_format, args.payload_quality)
+    dedup = None
+    if args.dedup:
+        threshold = args.dedup_threshold
+        if threshold is None:
+            threshold = DEFAULT_DEDUP_THRESHOLDS[args.dedup_hash]
+        dedup = DedupOptions(args.dedup_hash, threshold)
+    context_options = ContextOptions(args.context_budget, args.verbatim_guidances, DEFAULT_CONTEXT.summary_chars)
+    if args.call_log:
+        CALL_LOG.open(args.call_log)
+    prepared = None
+    if args.prepared:
+        prepared = PreparedOptions(args.prepared, args.prepared_dir, args.prepared_max_edge, args.prepared_wait)
+        if args.prepared == 'text' and args.send_changes:
+            print("Note: --send_changes sends close-ups of the photos and doesn't apply with --prepared text")
+            args.send_changes = False
+    
+    if args.watch:
+        if args.sessions:
+            print("Error: --watch watches a single session folder and can't be combined with --sessions")
+            return
+        watch_with_speech(args, cache, payload_options, dedup, context_options, prepared)
+        return
+    
+    if args.sessions:
+        outputs = process_sessions(args.input_dir, args.output_file, args.system_prompt, args.max_previous,
+                                   cache, args.since_last_run, args.session_workers,
+                                   not args.no_guidance_index, payload_options, dedup, args.send_changes,
+                                   not args.no_prompt_cache, args.stream, args.resume, context_options,
+                                   prepared)
+        speech_jobs = [(output_file, Path(args.tts_output_dir) / session.name) for session, output_file in outputs]
+    else:
+        process_images(args.input_dir, args.output_file, args.system_prompt, args.max_previous,
+                       cache, args.since_last_run, use_index=not args.no_guidance_index,
+                       payload_options=payload_options, dedup=dedup, send_changes=args.send_changes,
+                       prompt_cache=not args.no_prompt_cache, stream=args.stream, resume=args.resume,
+                       context_options=context_options, prepared=prepared)
+        speech_jobs = [(args.output_file, args.tts_output_dir)]
     
     # Convert to speech if requested
     if args.tts:
@@ -349,7 +1512,64 @@ def main():
             print("Error: ELEVENLABS_API_KEY not found in environment variables or .env file")
             print("Please set the ELEVENLABS_API_KEY environment variable or add it to your .env file")
             return
-        process_guidances_to_speech(args.output_file, args.tts_output_dir)
+        for guidance_file, speech_dir in speech_jobs:
+            if os.path.exists(guidance_file):
+                process_guidances_to_speech(guidance_file, speech_dir, args.tts_workers)
+
+def watch_with_speech(args, cache, payload_options, dedup=None, context_options=DEFAULT_CONTEXT, prepared=None):
+    """Run watch_images, synthesising each new guidance in the background with --tts.
+    
+    With --stream, the first sentence of each guidance is synthesised while
+    the rest is still being generated, into <frame>_speech_1.mp3, followed
+    by the remainder in <frame>_speech_2.mp3.
+    """
+    watch_args = dict(use_index=not args.no_guidance_index, payload_options=payload_options,
+                      poll_interval=args.poll_interval, idle_timeout=args.watch_idle_exit, dedup=dedup,
+                      send_changes=args.send_changes, prompt_cache=not args.no_prompt_cache, stream=args.stream,
+                      context_options=context_options, prepared=prepared)
+    if not args.tts:
+        watch_images(args.input_dir, args.output_file, args.system_prompt, args.max_previous, cache, **watch_args)
+        return
+    
+    if not os.getenv('ELEVENLABS_API_KEY'):
+        print("Error: ELEVENLABS_API_KEY not found in environment variables or .env file")
+        print("Please set the ELEVENLABS_API_KEY environment variable or add it to your .env file")
+        return
+    
+    speech_dir = Path(args.tts_output_dir)
+    speech_dir.mkdir(parents=True, exist_ok=True)
+    hash_path = speech_dir / TTS_HASH_FILE
+    hashes = load_run_state(hash_path)
+    lock = threading.Lock()
+    
+    def speak(guidance_text, output_file):
+        if text_to_speech(guidance_text, output_file):
+            with lock:
+                hashes[output_file.name] = speech_hash(guidance_text)
+                save_run_state(hash_path, hashes)
+    
+    # Frames whose guidance is being streamed -> their FirstSentence
+    first_sentences = {}
+    
+    with ThreadPoolExecutor(max_workers=max(1, args.tts_workers), thread_name_prefix='tts') as executor:
+        def on_text(image_path, text):
+            splitter = first_sentences.setdefault(image_path, FirstSentence())
+            sentence = splitter.feed(text)
+            if sentence:
+                executor.submit(speak, sentence, speech_dir / f"{image_path.stem}_speech_1.mp3")
+        
+        def on_guidance(image_path, guidance):
+            splitter = first_sentences.pop(image_path, None)
+            if splitter is None or splitter.sentence is None:
+                # Cached, not streamed, or a single short sentence
+                executor.submit(speak, guidance, speech_dir / f"{image_path.stem}_speech.mp3")
+                return
+            rest = splitter.rest(guidance)
+            if rest:
+                executor.submit(speak, rest, speech_dir / f"{image_path.stem}_speech_2.mp3")
+        
+        watch_images(args.input_dir, args.output_file, args.system_prompt, args.max_previous, cache,
+                     on_guidance=on_guidance, on_text=on_text if args.stream else None, **watch_args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,29 @@
+"""
+HTTP helpers shared by the DeskMate scripts: pooled sessions and retry
+backoff for the external APIs (Vision, Claude, ElevenLabs).
+"""
+
+import random
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Status codes worth retrying: throttling, overload and transient server errors
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504, 529}
+
+def create_session(pool_size=10):
+    """Create a requests session that keeps up to pool_size connections alive."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def backoff_delay(attempt, base=0.5, maximum=30.0, retry_after=None):
+    """Seconds to wait before retry number attempt (full jitter, honouring Retry-After)."""
+    if retry_after:
+        try:
+            return min(float(retry_after), maximum)
+        except ValueError:
+            pass
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
@@ -0,0 +1,69 @@
+"""
+Streaming ingestion of image folders for the scripts.
+Folders of desk camera frames can hold tens of thousands of files.
+scan_files() walks a folder lazily with os.scandir instead of building a
+list of Path objects up front, and prefetch() runs one stage of a pipeline
+(scanning, checking run state, reading) on a background thread that stays
+at most a bounded number of items ahead of the consumer, so memory does not
+grow with the size of the folder.
+"""
+
+import os
+import queue
+import threading
+from pathlib import Path
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff')
+
+def is_source_image(path):
+    """Whether path is a camera frame, as opposed to a non-image or a _processed.jpg output."""
+    return path.suffix.lower() in IMAGE_EXTENSIONS and not path.stem.endswith('_processed')
+
+def scan_files(directory, accept):
+    """Yield the files in directory for which accept(path) is true, in directory order."""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and accept(Path(entry.name)):
+                yield Path(entry.path)
+
+# Marks the end of a prefetched iterable
+_END = object()
+
+def prefetch(iterable, maxsize):
+    """Iterate over iterable on a background thread, staying at most maxsize items ahead.
+
+    Exceptions raised by iterable are re-raised to the consumer. If the
+    consumer stops early, the background thread stops too.
+    """
+    items = queue.Queue(maxsize=max(1, maxsize))
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_END, None))
+        except Exception as e:
+            put((_END, e))
+
+    threading.Thread(target=produce, name='prefetch', daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
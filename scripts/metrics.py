@@ -0,0 +1,144 @@
+"""
+Lightweight stage timing and counter instrumentation for the scripts.
+Stages are timed with the timer() context manager and events such as
+bytes sent, retries and cache hits are tallied with count(). At the end of
+a run the results can be printed as a table or written to a JSONL or
+Prometheus text-format file.
+"""
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+class Metrics:
+    """Thread-safe registry of stage durations and counters.
+
+    Worker processes keep their own registry; drain() hands its contents
+    back to the parent, which folds them in with merge().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the enclosed block as one observation of stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        """Record one duration for stage."""
+        with self._lock:
+            self.timings.setdefault(stage, []).append(seconds)
+
+    def count(self, name, value=1):
+        """Add value to the counter name."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def drain(self):
+        """Return everything recorded so far and reset the registry."""
+        with self._lock:
+            snapshot = {'timings': self.timings, 'counters': self.counters}
+            self.timings = {}
+            self.counters = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        """Fold a snapshot from drain() into this registry."""
+        with self._lock:
+            for stage, durations in snapshot['timings'].items():
+                self.timings.setdefault(stage, []).extend(durations)
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def stage_summaries(self):
+        """Return (stage, count, total, mean, p95, max) for every timed stage, slowest first."""
+        with self._lock:
+            timings = {stage: sorted(durations) for stage, durations in self.timings.items()}
+        rows = []
+        for stage, durations in timings.items():
+            total = sum(durations)
+            p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+            rows.append((stage, len(durations), total, total / len(durations), p95, durations[-1]))
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def print_summary(self):
+        """Print a per-stage timing table followed by the counters."""
+        rows = self.stage_summaries()
+        if rows:
+            width = max(len('stage'), *(len(row[0]) for row in rows))
+            print(f"\n{'stage'.ljust(width)}  {'count':>6}  {'total s':>9}  {'mean ms':>9}  {'p95 ms':>9}  {'max ms':>9}")
+            for stage, count, total, mean, p95, maximum in rows:
+                print(f"{stage.ljust(width)}  {count:>6}  {total:>9.2f}  {mean * 1000:>9.1f}  "
+                      f"{p95 * 1000:>9.1f}  {maximum * 1000:>9.1f}")
+        with self._lock:
+            counters = sorted(self.counters.items())
+        if counters:
+            width = max(len(name) for name, _ in counters)
+            print()
+            for name, value in counters:
+                print(f"{name.ljust(width)}  {value}")
+
+    def write(self, path):
+        """Write the metrics to path: Prometheus text format for .prom, JSONL otherwise."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        rows = self.stage_summaries()
+        with self._lock:
+            counters = sorted(self.counters.items())
+
+        if path.suffix == '.prom':
+            lines = [
+                '# HELP deskmate_stage_seconds Time spent in each pipeline stage.',
+                '# TYPE deskmate_stage_seconds summary'
+            ]
+            for stage, count, total, _, p95, _ in rows:
+                lines.append(f'deskmate_stage_seconds{{stage="{stage}",quantile="0.95"}} {p95:.6f}')
+                lines.append(f'deskmate_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+                lines.append(f'deskmate_stage_seconds_count{{stage="{stage}"}} {count}')
+            for name, value in counters:
+                lines.append(f'# TYPE deskmate_{name}_total counter')
+                lines.append(f'deskmate_{name}_total {value}')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+        else:
+            timestamp = time.time()
+            with open(path, 'a', encoding='utf-8') as f:
+                for stage, count, total, mean, p95, maximum in rows:
+                    f.write(json.dumps({
+                        'ts': timestamp, 'type': 'stage', 'stage': stage, 'count': count,
+                        'total_s': total, 'mean_s': mean, 'p95_s': p95, 'max_s': maximum
+                    }) + '\n')
+                for name, value in counters:
+                    f.write(json.dumps({'ts': timestamp, 'type': 'counter', 'name': name, 'value': value}) + '\n')
+
+# Process-wide registry used by the scripts
+METRICS = Metrics()
+
+def timer(stage):
+    """Time a block of code as one observation of stage in the global registry."""
+    return METRICS.timer(stage)
+
+def observe(stage, seconds):
+    """Record one duration for stage in the global registry."""
+    METRICS.observe(stage, seconds)
+
+def count(name, value=1):
+    """Add value to a counter in the global registry."""
+    METRICS.count(name, value)
+
+def report(profile=False, metrics_file=None):
+    """Print and/or write the global registry at the end of a run."""
+    if profile:
+        METRICS.print_summary()
+    if metrics_file:
+        METRICS.write(metrics_file)
+        print(f"Metrics written to {metrics_file}")
@@ -0,0 +1,170 @@
+"""
+OCR backends used by prepare_images.py.
+Every backend turns encoded image bytes into text through the same
+recognize() call, so the pipeline, the result cache and the benchmarks don't
+care whether OCR runs in the cloud (Google Vision) or locally on the CPU
+(easyocr). Backends are created once per process by get_backend() and
+reused for every image that process handles. Each backend imports its
+client library when it is created, so only the selected one is loaded.
+"""
+
+import os
+from abc import ABC, abstractmethod
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from metrics import timer, count
+
+# backend: key of BACKENDS; languages: tuple of language codes (local
+# backends only); batch_size: tiles per inference batch (local backends only)
+OCROptions = namedtuple('OCROptions', ['backend', 'languages', 'batch_size'])
+
+DEFAULT_OCR = OCROptions('vision', ('en',), 8)
+
+# Pages are cut into horizontal strips about this tall for local inference
+EASYOCR_TILE_HEIGHT = 768
+
+class OCRBackend(ABC):
+    """Base class for OCR backends."""
+
+    name = None
+    # Whether recognize() may be called from several threads at once
+    supports_concurrency = False
+
+    @property
+    def cache_tag(self):
+        """String identifying this backend's output in result cache keys."""
+        return self.name
+
+    def is_available(self):
+        """Whether the backend can run in this environment."""
+        return True
+
+    @abstractmethod
+    def recognize(self, image_bytes):
+        """OCR one encoded image, returning (text, ok)."""
+
+class VisionBackend(OCRBackend):
+    """Google Cloud Vision TEXT_DETECTION over a pooled HTTP session."""
+
+    name = 'vision'
+    supports_concurrency = True
+
+    def __init__(self, options=DEFAULT_OCR):
+        import vision_client
+        from http_utils import create_session
+
+        self.client = vision_client
+        self.session = create_session()
+
+    @property
+    def cache_tag(self):
+        # Kept from before backends were pluggable so existing cache entries stay valid
+        return 'TEXT_DETECTION'
+
+    def is_available(self):
+        return bool(os.getenv('GOOGLE_API_KEY'))
+
+    def recognize(self, image_bytes):
+        api_key = os.getenv('GOOGLE_API_KEY')
+        if not api_key:
+            return "No API key found", False
+
+        with timer('ocr_request'):
+            response = self.session.post(
+                self.client.VISION_API_URL,
+                params={'key': api_key},
+                json=self.client.build_annotate_request([image_bytes])
+            )
+        count('ocr_requests')
+        count('ocr_bytes_sent', len(response.request.body or b''))
+        count('ocr_bytes_received', len(response.content))
+
+        if response.status_code != 200:
+            return f"API Error: {response.status_code} - {response.text}", False
+
+        try:
+            return self.client.parse_annotate_response(response.json()['responses'][0])
+        except (KeyError, IndexError):
+            return "No text found in response", False
+
+def split_into_tiles(gray, tile_height=EASYOCR_TILE_HEIGHT):
+    """Cut a grayscale page into horizontal strips of at most tile_height rows.
+
+    Each cut is placed on the emptiest row in the last quarter of the strip,
+    so lines of handwriting are rarely split. Strips are padded with white
+    at the bottom to a common height so they can be batched.
+    """
+    height = gray.shape[0]
+    if height <= tile_height:
+        return [gray]
+
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    row_ink = ink.sum(axis=1)
+
+    cuts = [0]
+    while height - cuts[-1] > tile_height:
+        low = cuts[-1] + tile_height * 3 // 4
+        high = cuts[-1] + tile_height
+        cuts.append(low + int(np.argmin(row_ink[low:high])))
+    cuts.append(height)
+
+    tiles = []
+    for top, bottom in zip(cuts, cuts[1:]):
+        tile = gray[top:bottom]
+        if tile.shape[0] < tile_height:
+            tile = cv2.copyMakeBorder(tile, 0, tile_height - tile.shape[0], 0, 0,
+                                      cv2.BORDER_CONSTANT, value=255)
+        tiles.append(tile)
+    return tiles
+
+class EasyOCRBackend(OCRBackend):
+    """Local CPU OCR with easyocr.
+
+    The reader (and its detection and recognition models) is loaded once
+    when the backend is created. Each page is cut into equally sized strips
+    that go through the models in batches.
+    """
+
+    name = 'easyocr'
+
+    def __init__(self, options=DEFAULT_OCR):
+        import easyocr
+
+        self.languages = list(options.languages)
+        self.batch_size = max(1, options.batch_size)
+        with timer('ocr_model_load'):
+            self.reader = easyocr.Reader(self.languages, gpu=False, verbose=False)
+
+    @property
+    def cache_tag(self):
+        return f"easyocr:{','.join(self.languages)}:{EASYOCR_TILE_HEIGHT}"
+
+    def recognize(self, image_bytes):
+        gray = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            return "Error decoding image", False
+
+        tiles = split_into_tiles(gray)
+        with timer('ocr_local'):
+            results = self.reader.readtext_batched(tiles, detail=0, paragraph=True,
+                                                   batch_size=self.batch_size)
+        count('ocr_tiles', len(tiles))
+        return '\n'.join(paragraph for tile in results for paragraph in tile), True
+
+BACKENDS = {
+    'vision': VisionBackend,
+    'easyocr': EasyOCRBackend
+}
+
+# One instance per options per process, so models and sessions are reused
+_backends = {}
+
+def get_backend(options=DEFAULT_OCR):
+    """Return this process's backend for options, creating it on first use."""
+    backend = _backends.get(options)
+    if backend is None:
+        backend = _backends[options] = BACKENDS[options.backend](options)
+    return backend
@@ -0,0 +1,87 @@
+"""
+Payload optimisation for images uploaded to the OCR and LLM APIs.
+Phone photos are often 8-12 MB, far more than the APIs actually use.
+Downscaling to a target long edge and re-encoding cuts upload time and,
+for Claude, image tokens.
+"""
+
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+# max_edge of 0 keeps the original resolution
+PayloadOptions = namedtuple('PayloadOptions', ['max_edge', 'format', 'quality'])
+
+# Claude downsizes images with a long edge above ~1568 px anyway
+DEFAULT_LLM_PAYLOAD = PayloadOptions(1568, 'jpeg', 85)
+
+FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('.webp', 'image/webp', cv2.IMWRITE_WEBP_QUALITY)
+}
+
+def resize_to_max_edge(image, max_edge):
+    """Downscale image so its longest side is at most max_edge pixels."""
+    height, width = image.shape[:2]
+    long_edge = max(height, width)
+    if not max_edge or long_edge <= max_edge:
+        return image
+    scale = max_edge / long_edge
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+def encode_payload(image, options):
+    """Resize a decoded image and encode it, returning (bytes, media_type)."""
+    extension, media_type, quality_flag = FORMATS[options.format]
+    resized = resize_to_max_edge(image, options.max_edge)
+    success, encoded = cv2.imencode(extension, resized, [quality_flag, int(options.quality)])
+    if not success:
+        raise ValueError(f"Could not encode image as {options.format}")
+    return encoded.tobytes(), media_type
+
+def optimize_payload(image_bytes, media_type, options, label=None):
+    """Downscale and re-encode an encoded image for upload.
+
+    Returns (bytes, media_type). The original is kept if options is None,
+    the image can't be decoded, or re-encoding would not make it smaller.
+    """
+    if options is None:
+        return image_bytes, media_type
+
+    image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return image_bytes, media_type
+
+    optimized, optimized_type = encode_payload(image, options)
+    if len(optimized) >= len(image_bytes):
+        return image_bytes, media_type
+
+    if label:
+        saved = len(image_bytes) - len(optimized)
+        print(f"Payload {label}: {len(image_bytes) / 1024:.0f} KB -> {len(optimized) / 1024:.0f} KB "
+              f"({saved / len(image_bytes):.0%} saved)")
+    return optimized, optimized_type
+
+def image_dimensions(image_bytes):
+    """(width, height) of encoded image bytes, read from the PNG or JPEG header when possible."""
+    if image_bytes[:8] == b'\x89PNG\r\n\x1a\n':
+        return int.from_bytes(image_bytes[16:20], 'big'), int.from_bytes(image_bytes[20:24], 'big')
+    if image_bytes[:2] == b'\xff\xd8':
+        # Walk the JPEG segments to the start-of-frame marker
+        position = 2
+        while position + 9 < len(image_bytes):
+            if image_bytes[position] != 0xFF:
+                break
+            marker = image_bytes[position + 1]
+            length = int.from_bytes(image_bytes[position + 2:position + 4], 'big')
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height = int.from_bytes(image_bytes[position + 5:position + 7], 'big')
+                width = int.from_bytes(image_bytes[position + 7:position + 9], 'big')
+                return width, height
+            position += 2 + length
+    # Other formats (e.g. WebP) are decoded
+    image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        return None
+    return image.shape[1], image.shape[0]
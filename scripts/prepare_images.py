@@ -5,27 +5,104 @@ This script:
 1. Detects notebook/paper edges
 2. Crops to the detected edges
 3. Enhances contrast and reduces blur
-4. Performs OCR to extract text
+4. Performs OCR to extract text (Google Vision API or local easyocr)
 5. Saves processed images and extracted text
 """
 
 import os
+import time
 import argparse
+import importlib.util
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import cv2
 import numpy as np
-import easyocr
 from pathlib import Path
 from tqdm import tqdm
 from dotenv import load_dotenv
+from result_cache import (ResultCache, make_key, DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_MB,
+                          file_signature, load_run_state, save_run_state, is_unchanged, atomic_write_bytes)
+from checkpoint import Checkpoint
+from ocr_backends import OCROptions, DEFAULT_OCR, BACKENDS, get_backend
+from payload import PayloadOptions, FORMATS, encode_payload, optimize_payload
+from metrics import METRICS, timer, observe, count, report as report_metrics
+from watch import watch_directory, DEFAULT_POLL_INTERVAL
+from ingest import is_source_image, scan_files, prefetch
+from prepared import PREPARED_MANIFEST
+# asyncio, the Vision client (requests) and OCR models are imported only
+# when the run uses them, keeping startup fast for worker processes and
+# --no-ocr runs
 
 # Load environment variables from .env file
 load_dotenv()
 
-def detect_and_crop_edges(image):
-    """Detect edges of notebook/paper and crop the image."""
-    # Convert to grayscale
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+# Bump whenever detect_and_crop_edges/enhance_image change output, so stale
+# cache entries are not reused
+PIPELINE_VERSION = 'crop-enhance-v3'
+
+RUN_STATE_FILE = '.prepare_images_state.json'
+# Also read by generate_guidances.py --prepared (see prepared.py)
+CHECKPOINT_FILE = PREPARED_MANIFEST
+
+# Longest side of the downscaled copy used to search for the page outline
+EDGE_PROXY_MAX_EDGE = 1024
+
+# A contour must cover at least this fraction of the photo to count as a page
+MIN_PAGE_AREA_FRACTION = 0.1
+# Most pages looked for in one photo with detect_pages
+MAX_PAGES = 4
+# approxPolyDP tolerances tried in turn, as fractions of the outline's length
+QUAD_EPSILONS = (0.02, 0.04, 0.06)
+# Regions overlapping a bigger page by more than this fraction of their own
+# area are pieces of that page's outline, not another page
+MAX_PAGE_OVERLAP = 0.5
+# A page this much wider than tall may be a two-page spread...
+SPREAD_MIN_ASPECT = 1.2
+# ...and is split when a column near its middle is this much darker than
+# the typical column: the shadow of the fold, which runs the full height
+GUTTER_MAX_BRIGHTNESS = 0.85
+
+def quad_from_contour(contour):
+    """Four corners approximating an outline.
+    
+    Coarser polygon approximations are tried until one has exactly four
+    corners; a curled or torn page that never does falls back to the
+    smallest rotated rectangle around its outline.
+    """
+    perimeter = cv2.arcLength(contour, True)
+    for fraction in QUAD_EPSILONS:
+        approx = cv2.approxPolyDP(contour, fraction * perimeter, True)
+        if len(approx) == 4:
+            return approx.reshape(4, 2).astype(np.float32)
+    count('page_quad_fallbacks')
+    return cv2.boxPoints(cv2.minAreaRect(contour)).astype(np.float32)
+
+def reading_order(quads):
+    """Indices that sort quads ((N, 4, 2) corners) into reading order.
+    
+    Pages whose vertical centre falls within the span of the row started by
+    the topmost remaining page share that row; rows go top to bottom and
+    pages within a row left to right.
+    """
+    tops, bottoms = quads[:, :, 1].min(axis=1), quads[:, :, 1].max(axis=1)
+    centres = quads.mean(axis=1)
+    remaining = list(np.argsort(tops))
+    order = []
+    while remaining:
+        first = remaining[0]
+        row = [i for i in remaining if tops[first] <= centres[i, 1] <= bottoms[first]] or [first]
+        order.extend(sorted(row, key=lambda i: centres[i, 0]))
+        remaining = [i for i in remaining if i not in row]
+    return order
+
+def find_page_quads(gray, max_pages=MAX_PAGES):
+    """Find the corners of every page in a grayscale image, in reading order.
     
+    Returns an (N, 4, 2) float32 array, empty when no outline covers at
+    least MIN_PAGE_AREA_FRACTION of the image. The outlines of all pages
+    come from a single edge detection and contour pass, biggest first.
+    """
     # Apply Gaussian blur to reduce noise
     blurred = cv2.GaussianBlur(gray, (5, 5), 0)
     
@@ -35,128 +112,263 @@ def detect_and_crop_edges(image):
     # Find contours
     contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     
-    # Find the largest contour (assuming it's the paper)
-    if contours:
-        largest_contour = max(contours, key=cv2.contourArea)
-        
-        # Approximate the contour to get a polygon
-        epsilon = 0.02 * cv2.arcLength(largest_contour, True)
-        approx = cv2.approxPolyDP(largest_contour, epsilon, True)
+    # Measure outlines by their convex hull, which stays meaningful when the
+    # edge detector leaves a gap in a page's border
+    min_area = MIN_PAGE_AREA_FRACTION * gray.shape[0] * gray.shape[1]
+    candidates = sorted(((cv2.contourArea(cv2.convexHull(c)), c) for c in contours),
+                        key=lambda candidate: candidate[0], reverse=True)
+    
+    quads = []
+    boxes = np.empty((0, 4))
+    for area, contour in candidates:
+        if area < min_area or len(quads) == max_pages:
+            break
+        x, y, w, h = cv2.boundingRect(contour)
+        # Overlap of this outline's box with every page kept so far, at once
+        overlap_w = np.minimum(boxes[:, 2], x + w) - np.maximum(boxes[:, 0], x)
+        overlap_h = np.minimum(boxes[:, 3], y + h) - np.maximum(boxes[:, 1], y)
+        overlap = np.clip(overlap_w, 0, None) * np.clip(overlap_h, 0, None)
+        if np.any(overlap > MAX_PAGE_OVERLAP * w * h):
+            continue
+        quads.append(quad_from_contour(contour))
+        boxes = np.vstack([boxes, [x, y, x + w, y + h]])
+    
+    if not quads:
+        return np.empty((0, 4, 2), dtype=np.float32)
+    quads = np.stack(quads)
+    return quads[reading_order(quads)]
+
+def find_page_quad(gray):
+    """Find the four corners of the notebook/paper in a grayscale image, or None."""
+    quads = find_page_quads(gray, max_pages=1)
+    return quads[0] if len(quads) else None
+
+def _search_page_quads(image, proxy_max_edge=EDGE_PROXY_MAX_EDGE, max_pages=MAX_PAGES):
+    """find_page_quads in full-resolution coordinates of a BGR image.
+    
+    The page outlines are searched for on a copy downscaled to
+    proxy_max_edge pixels and the corners are scaled back up, so only the
+    final warp touches the full-resolution image. If the proxy yields no
+    page, the search is repeated at full resolution.
+    """
+    quads = np.empty((0, 4, 2), dtype=np.float32)
+    
+    # Search on a downscaled proxy first
+    scale = proxy_max_edge / max(image.shape[:2]) if proxy_max_edge else 1.0
+    if scale < 1.0:
+        # Linear sampling is several times cheaper than INTER_AREA at this
+        # size, and the Gaussian blur in find_page_quads absorbs its aliasing
+        proxy = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+        quads = find_page_quads(cv2.cvtColor(proxy, cv2.COLOR_BGR2GRAY), max_pages) / scale
+    
+    # Fall back to the full-resolution image
+    if not len(quads):
+        quads = find_page_quads(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), max_pages)
+    if not len(quads):
+        count('page_not_found')
+    return quads
+
+def warp_pages(image, quads):
+    """Warp each quad ((N, 4, 2) corners) of image to an upright rectangle."""
+    rects = order_points(quads)
+    
+    # Width and height of each page from its longer pair of opposite edges
+    edges = np.linalg.norm(rects - np.roll(rects, -1, axis=1), axis=2)  # top, right, bottom, left
+    widths = np.maximum(edges[:, 0], edges[:, 2]).astype(int)
+    heights = np.maximum(edges[:, 1], edges[:, 3]).astype(int)
+    
+    pages = []
+    for rect, width, height in zip(rects, widths, heights):
+        # Define destination points
+        dst = np.array([
+            [0, 0],
+            [width - 1, 0],
+            [width - 1, height - 1],
+            [0, height - 1]
+        ], dtype=np.float32)
         
-        # If we have a quadrilateral (4 points), we can apply perspective transform
-        if len(approx) == 4:
-            # Order points in top-left, top-right, bottom-right, bottom-left order
-            pts = np.array([pt[0] for pt in approx], dtype=np.float32)
-            rect = order_points(pts)
-            
-            # Get width and height of the new image
-            width = max(
-                int(np.linalg.norm(rect[1] - rect[0])),  # Top edge
-                int(np.linalg.norm(rect[3] - rect[2]))   # Bottom edge
-            )
-            height = max(
-                int(np.linalg.norm(rect[3] - rect[0])),  # Left edge
-                int(np.linalg.norm(rect[2] - rect[1]))   # Right edge
-            )
-            
-            # Define destination points
-            dst = np.array([
-                [0, 0],
-                [width - 1, 0],
-                [width - 1, height - 1],
-                [0, height - 1]
-            ], dtype=np.float32)
-            
-            # Apply perspective transform
-            M = cv2.getPerspectiveTransform(rect, dst)
-            warped = cv2.warpPerspective(image, M, (width, height))
-            
-            return warped
+        # Apply perspective transform
+        M = cv2.getPerspectiveTransform(rect, dst)
+        pages.append(cv2.warpPerspective(image, M, (int(width), int(height))))
+    return pages
+
+def detect_and_crop_edges(image, proxy_max_edge=EDGE_PROXY_MAX_EDGE):
+    """Detect edges of notebook/paper and crop the image to the biggest page.
     
-    # If no proper quadrilateral is found, return the original image
-    return image
+    If no page is found, the original image is returned.
+    """
+    quads = _search_page_quads(image, proxy_max_edge, max_pages=1)
+    if not len(quads):
+        return image
+    return warp_pages(image, quads)[0]
+
+def split_spread(page):
+    """Split a warped two-page spread at its fold, or return [page] if it isn't one."""
+    height, width = page.shape[:2]
+    if width < SPREAD_MIN_ASPECT * height:
+        return [page]
+    
+    # The median of each column ignores handwriting, which only covers a
+    # few rows, but not the fold's shadow, which covers all of them
+    small = cv2.resize(page, (400, 100), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    profile = np.convolve(np.median(small, axis=0), np.ones(5) / 5, mode='same')
+    low, high = int(len(profile) * 0.35), int(len(profile) * 0.65)
+    gutter = low + int(np.argmin(profile[low:high]))
+    if profile[gutter] > GUTTER_MAX_BRIGHTNESS * np.median(profile):
+        return [page]
+    
+    count('page_spreads_split')
+    split = gutter * width // len(profile)
+    return [page[:, :split], page[:, split:]]
+
+def detect_pages(image, proxy_max_edge=EDGE_PROXY_MAX_EDGE, max_pages=MAX_PAGES):
+    """Detect every page in a photo and return each one cropped upright, in reading order.
+    
+    Separate sheets are found in one contour pass; two-page spreads, which
+    share one outline, are then split at the fold. If no page is found the
+    original image is returned as the only page.
+    """
+    quads = _search_page_quads(image, proxy_max_edge, max_pages)
+    if not len(quads):
+        return [image]
+    return [half for page in warp_pages(image, quads) for half in split_spread(page)]
 
 def order_points(pts):
-    """Order points in top-left, top-right, bottom-right, bottom-left order."""
-    # Initialize ordered points
-    rect = np.zeros((4, 2), dtype=np.float32)
+    """Order points in top-left, top-right, bottom-right, bottom-left order.
     
-    # Top-left will have the smallest sum, bottom-right will have the largest sum
-    s = pts.sum(axis=1)
-    rect[0] = pts[np.argmin(s)]
-    rect[2] = pts[np.argmax(s)]
+    pts is a (4, 2) array of corners, or an (N, 4, 2) array of N quads which
+    are all ordered at once.
+    """
+    pts = np.asarray(pts, dtype=np.float32)
     
+    # Top-left will have the smallest sum, bottom-right will have the largest sum
+    s = pts.sum(axis=-1)
     # Top-right will have the smallest difference, bottom-left will have the largest difference
-    diff = np.diff(pts, axis=1)
-    rect[1] = pts[np.argmin(diff)]
-    rect[3] = pts[np.argmax(diff)]
-    
-    return rect
+    diff = pts[..., 1] - pts[..., 0]
+    corners = np.stack([s.argmin(axis=-1), diff.argmin(axis=-1), s.argmax(axis=-1), diff.argmax(axis=-1)],
+                       axis=-1)
+    return np.take_along_axis(pts, corners[..., None], axis=-2)
 
-def enhance_image(image):
-    """Enhance image for better LLM processing."""
-    # Keep the color information (don't convert to grayscale)
+# Sharpening kernels for enhance_image (subtle) and enhance_visual (stronger)
+SHARPEN_KERNEL = np.array([[-0.5, -0.5, -0.5],
+                           [-0.5, 5, -0.5],
+                           [-0.5, -0.5, -0.5]])
+VISUAL_SHARPEN_KERNEL = np.array([[-1, -1, -1],
+                                  [-1, 9, -1],
+                                  [-1, -1, -1]])
+
+class ScratchBuffers:
+    """Intermediate images reused from one page to the next.
     
-    # Apply denoising while preserving edges
-    denoised = cv2.fastNlMeansDenoisingColored(image, None, 10, 10, 7, 21)
+    Each named buffer is a flat byte array that only ever grows; get()
+    returns a contiguous view of its start with the requested shape. Pages
+    come out of the perspective warp at slightly different sizes, so this
+    lets them all share the same memory, and OpenCV writes into it through
+    dst= instead of allocating a new array at every step. Peak memory then
+    depends on the largest page seen, not on how many pages are processed.
+    """
     
-    # Convert to LAB color space for better color enhancement
-    lab = cv2.cvtColor(denoised, cv2.COLOR_BGR2LAB)
+    def __init__(self):
+        self._buffers = {}
+        self.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
     
-    # Split the LAB image into L, A, and B channels
-    l, a, b = cv2.split(lab)
+    def get(self, name, shape, dtype=np.uint8):
+        """A scratch array of the given shape; its contents are undefined."""
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.nbytes < nbytes:
+            buffer = self._buffers[name] = np.empty(nbytes, dtype=np.uint8)
+        return buffer[:nbytes].view(dtype).reshape(shape)
+
+# One set per thread, since async OCR runs image processing off the main thread
+_scratch = threading.local()
+
+def scratch_buffers():
+    """This thread's ScratchBuffers."""
+    buffers = getattr(_scratch, 'buffers', None)
+    if buffers is None:
+        buffers = _scratch.buffers = ScratchBuffers()
+    return buffers
+
+def _clahe_lightness(bgr, buffers, denoise_lightness=None):
+    """CLAHE (after denoise_lightness, if given) on the L channel of bgr, back in BGR.
     
-    # Apply CLAHE to L channel to enhance contrast without affecting color
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    cl = clahe.apply(l)
+    Returns a scratch array, valid until the next call on this thread. The
+    denoiser is timed as the denoise stage and the rest as clahe.
+    """
+    lab = buffers.get('lab', bgr.shape)
+    l = buffers.get('l', bgr.shape[:2])
+    l_out = buffers.get('l_out', bgr.shape[:2])
+    started = time.perf_counter()
+    cv2.cvtColor(bgr, cv2.COLOR_BGR2LAB, dst=lab)
+    cv2.extractChannel(lab, 0, dst=l)
+    if denoise_lightness is not None:
+        denoise_started = time.perf_counter()
+        denoise_lightness(l, l_out)
+        l, l_out = l_out, l
+        denoise_seconds = time.perf_counter() - denoise_started
+        observe('denoise', denoise_seconds)
+        started += denoise_seconds
     
-    # Merge the CLAHE enhanced L channel with the original A and B channels
-    merged = cv2.merge((cl, a, b))
+    # Apply CLAHE to L channel to enhance contrast without affecting color,
+    # then put it back next to the original A and B channels
+    buffers.clahe.apply(l, dst=l_out)
+    cv2.insertChannel(l_out, lab, 0)
     
     # Convert back to BGR color space
-    enhanced = cv2.cvtColor(merged, cv2.COLOR_LAB2BGR)
+    enhanced = buffers.get('enhanced', bgr.shape)
+    cv2.cvtColor(lab, cv2.COLOR_LAB2BGR, dst=enhanced)
+    observe('clahe', time.perf_counter() - started)
+    return enhanced
+
+def enhance_image(image, quality='best'):
+    """Enhance image for better LLM processing.
     
-    # Apply subtle sharpening to make text more readable
-    kernel = np.array([[-0.5,-0.5,-0.5], 
-                       [-0.5, 5,-0.5],
-                       [-0.5,-0.5,-0.5]])
-    sharpened = cv2.filter2D(enhanced, -1, kernel)
+    quality selects the denoiser, by far the most expensive step:
+    - best: non-local means on all colour channels (the original behaviour)
+    - balanced: non-local means on the L channel only, with a smaller search window
+    - fast: 3x3 median filter on the L channel
+    
+    Intermediates live in this thread's ScratchBuffers; only the returned
+    image is newly allocated. The denoise, clahe and sharpen steps are timed
+    as stages of their own, inside enhance_<quality>.
+    """
+    # Keep the color information (don't convert to grayscale)
+    buffers = scratch_buffers()
     
-    return sharpened
+    if quality == 'best':
+        # Apply denoising while preserving edges
+        denoised = buffers.get('denoised', image.shape)
+        with timer('denoise'):
+            cv2.fastNlMeansDenoisingColored(image, denoised, 10, 10, 7, 21)
+        enhanced = _clahe_lightness(denoised, buffers)
+    elif quality == 'balanced':
+        # Handwriting lives in the lightness channel, so only denoise that
+        enhanced = _clahe_lightness(image, buffers, lambda l, dst: cv2.fastNlMeansDenoising(l, dst, 10, 7, 11))
+    else:
+        enhanced = _clahe_lightness(image, buffers, lambda l, dst: cv2.medianBlur(l, 3, dst=dst))
+    
+    # Apply subtle sharpening to make text more readable
+    with timer('sharpen'):
+        return cv2.filter2D(enhanced, -1, SHARPEN_KERNEL)
 
 def enhance_visual(image):
     """Enhance image for visual appeal (not for OCR)."""
     # Apply subtle improvements for visual appeal
+    buffers = scratch_buffers()
     
-    # Convert to LAB color space
     if len(image.shape) == 3:
-        lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
-        
-        # Split the LAB image into L, A, and B channels
-        l, a, b = cv2.split(lab)
-        
-        # Apply CLAHE to L channel
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        cl = clahe.apply(l)
-        
-        # Merge the CLAHE enhanced L channel with the original A and B channels
-        merged = cv2.merge((cl, a, b))
-        
-        # Convert back to BGR color space
-        enhanced = cv2.cvtColor(merged, cv2.COLOR_LAB2BGR)
+        enhanced = _clahe_lightness(image, buffers)
         
         # Apply subtle sharpening
-        kernel = np.array([[-1,-1,-1], 
-                           [-1, 9,-1],
-                           [-1,-1,-1]])
-        enhanced = cv2.filter2D(enhanced, -1, kernel)
-        
-        return enhanced
+        return cv2.filter2D(enhanced, -1, VISUAL_SHARPEN_KERNEL)
     else:
         # If already grayscale, just apply CLAHE
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        enhanced = clahe.apply(image)
-        return enhanced
+        return buffers.clahe.apply(image)
+
+QUALITY_TIERS = ['fast', 'balanced', 'best']
 
 def check_google_credentials():
     """Check if Google Cloud credentials are properly set up."""
@@ -178,78 +390,151 @@ def check_google_credentials():
         print(f"\nError with Google Cloud credentials: {e}")
         return False
 
-def perform_ocr(image):
-    """Extract text from image using Google Cloud Vision API with API key."""
+def ocr_cache_key(image_bytes, backend_tag='TEXT_DETECTION'):
+    """Cache key for the OCR result of an encoded image."""
+    return make_key('perform_ocr', backend_tag, image_bytes)
+
+class OCRError(RuntimeError):
+    """Raised when OCR of a processed image failed, so the image is not recorded as done."""
+
+def perform_ocr(image, cache=None, payload_options=None, ocr_options=DEFAULT_OCR):
+    """Extract text from image with the OCR backend selected by ocr_options.
+    
+    image may be a decoded image array or already-encoded JPEG bytes. With
+    payload_options the image is downscaled and re-encoded first. Returns
+    (text, ok); when ok is False, text describes the error.
+    """
     try:
-        # Get API key from environment
-        api_key = os.getenv('GOOGLE_API_KEY')
-        if not api_key:
-            return "No API key found"
-        
-        # Convert the image to base64
-        success, encoded_image = cv2.imencode('.jpg', image)
-        if not success:
-            return "Error encoding image"
-        
-        import base64
-        import requests
-        import json
+        backend = get_backend(ocr_options)
         
-        # Encode image to base64
-        image_content = base64.b64encode(encoded_image.tobytes()).decode('utf-8')
-        
-        # Prepare request to Vision API
-        request_body = {
-            "requests": [
-                {
-                    "image": {
-                        "content": image_content
-                    },
-                    "features": [
-                        {
-                            "type": "TEXT_DETECTION"
-                        }
-                    ]
-                }
-            ]
-        }
-        
-        # Make request to Vision API
-        response = requests.post(
-            f'https://vision.googleapis.com/v1/images:annotate?key={api_key}',
-            json=request_body
-        )
-        
-        # Parse response
-        if response.status_code != 200:
-            return f"API Error: {response.status_code} - {response.text}"
+        # Convert the image to JPEG bytes unless the caller already has them
+        with timer('ocr_payload'):
+            if isinstance(image, (bytes, bytearray)):
+                image_bytes, _ = optimize_payload(bytes(image), 'image/jpeg', payload_options, 'OCR image')
+            elif payload_options is not None:
+                image_bytes, _ = encode_payload(image, payload_options)
+            else:
+                success, encoded_image = cv2.imencode('.jpg', image)
+                if not success:
+                    return "Error encoding image", False
+                image_bytes = encoded_image.tobytes()
         
-        result = response.json()
+        cache_key = ocr_cache_key(image_bytes, backend.cache_tag)
+        if cache is not None:
+            cached_text = cache.get_text(cache_key)
+            if cached_text is not None:
+                count('ocr_cache_hits')
+                return cached_text, True
+            count('ocr_cache_misses')
         
-        # Extract text from response
-        try:
-            text_annotations = result['responses'][0]['textAnnotations']
-            if text_annotations:
-                # The first annotation contains all the text
-                full_text = text_annotations[0]['description']
-                return full_text
-            else:
-                return "No text detected"
-        except KeyError:
-            if 'error' in result['responses'][0]:
-                return f"API Error: {result['responses'][0]['error']['message']}"
-            return "No text found in response"
+        text, ok = backend.recognize(image_bytes)
+        if ok and cache is not None:
+            cache.put_text(cache_key, text)
+        return text, ok
             
     except Exception as e:
         print(f"OCR Error: {e}")
-        return f"OCR ERROR: {str(e)}"
-
-def process_image(image_path, output_dir, skip_ocr=False):
-    """Process a single image and save results."""
-    # Read the image
-    image = cv2.imread(str(image_path))
-    if image is None:
-        print(f"Error: Could not read image {image_path}")
+        return f"OCR ERROR: {str(e)}", False
+
+def save_ocr_text(text_path, text, ok):
+    """Write the OCR text of an image, or raise OCRError if OCR failed.
+    
+    A failed OCR leaves no text file behind (removing one from an earlier
+    run), so nothing downstream mistakes the error message for the page.
+    """
+    if not ok:
+        text_path.unlink(missing_ok=True)
+        count('ocr_failures')
+        raise OCRError(f"OCR failed: {text}")
+    atomic_write_bytes(text_path, text.encode('utf-8'))
+
+async def ocr_and_save(client, processed_path, text_path, cache=None, payload_options=None):
+    """OCR an already processed image with the async client and save its text."""
+    image_bytes, _ = optimize_payload(processed_path.read_bytes(), 'image/jpeg', payload_options,
+                                      processed_path.name)
+    
+    cache_key = ocr_cache_key(image_bytes)
+    text = cache.get_text(cache_key) if cache is not None else None
+    if cache is not None:
+        count('ocr_cache_hits' if text is not None else 'ocr_cache_misses')
+    if text is None:
+        text, ok = await client.annotate(image_bytes)
+        if ok and cache is not None:
+            cache.put_text(cache_key, text)
+    else:
+        ok = True
+    
+    save_ocr_text(text_path, text, ok)
+    return processed_path, text_path
+
+# Gap left between pages laid side by side in a multi-page processed image
+PAGE_GAP = 16
+# Separates the OCR text of consecutive pages
+PAGE_TEXT_SEPARATOR = '\n\n---\n\n'
+
+def compose_pages(pages, gap=PAGE_GAP):
+    """Lay pages out left to right, in reading order, on a white background."""
+    if len(pages) == 1:
+        return pages[0]
+    height = max(page.shape[0] for page in pages)
+    padded = [
+        cv2.copyMakeBorder(page, 0, height - page.shape[0], 0, gap if i < len(pages) - 1 else 0,
+                           cv2.BORDER_CONSTANT, value=(255, 255, 255))
+        for i, page in enumerate(pages)
+    ]
+    return cv2.hconcat(padded)
+
+def pack_blobs(blobs):
+    """Join byte strings into one cache entry."""
+    header = len(blobs).to_bytes(4, 'big') + b''.join(len(blob).to_bytes(8, 'big') for blob in blobs)
+    return header + b''.join(blobs)
+
+def unpack_blobs(data):
+    """Split a pack_blobs cache entry back into its byte strings."""
+    n = int.from_bytes(data[:4], 'big')
+    lengths = [int.from_bytes(data[4 + 8 * i:12 + 8 * i], 'big') for i in range(n)]
+    blobs = []
+    offset = 4 + 8 * n
+    for length in lengths:
+        blobs.append(data[offset:offset + length])
+        offset += length
+    return blobs
+
+def ocr_pages(page_bytes, cache=None, payload_options=None, ocr_options=DEFAULT_OCR):
+    """OCR each page separately and join the texts in reading order.
+    
+    Pages go through backends that support it (remote APIs) concurrently.
+    Returns (text, ok) like perform_ocr; ok only if every page succeeded.
+    """
+    if len(page_bytes) == 1:
+        return perform_ocr(page_bytes[0], cache, payload_options, ocr_options)
+    workers = len(page_bytes) if get_backend(ocr_options).supports_concurrency else 1
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ocr-page') as executor:
+        results = list(executor.map(lambda page: perform_ocr(page, cache, payload_options, ocr_options),
+                                    page_bytes))
+    count('ocr_pages', len(page_bytes))
+    failed = [text for text, ok in results if not ok]
+    if failed:
+        return failed[0], False
+    return PAGE_TEXT_SEPARATOR.join(text for text, _ in results), True
+
+def process_image(image_path, output_dir, skip_ocr=False, cache=None, ocr_payload=None, quality='best',
+                  ocr_options=DEFAULT_OCR, multi_page=False):
+    """Process a single image and save results.
+    
+    With multi_page, every page in the photo (separate sheets, or both
+    halves of a spread) is cropped and enhanced on its own. The processed
+    image shows them side by side in reading order, and each page is OCR'd
+    as a separate tile, with the texts joined in reading order.
+    
+    Raises OCRError if OCR fails, after the processed image is saved.
+    """
+    # Read the raw image bytes (also used as the cache key)
+    try:
+        with timer('read'):
+            raw_bytes = image_path.read_bytes()
+    except OSError as e:
+        print(f"Error: Could not read image {image_path}: {e}")
         return
     
     # Create output paths
@@ -257,33 +542,278 @@ def process_image(image_path, output_dir, skip_ocr=False):
     processed_image_path = output_dir / f"{filename}_processed.jpg"
     text_path = output_dir / f"{filename}_text.txt"
     
-    # Process the image
-    cropped = detect_and_crop_edges(image)
-    enhanced = enhance_image(cropped)
+    # Cached as the processed image followed by each page, when there are several
+    cache_key = make_key('process_image', PIPELINE_VERSION, quality, multi_page, raw_bytes)
+    cached = cache.get(cache_key) if cache is not None else None
+    if cache is not None:
+        count('process_image_cache_hits' if cached is not None else 'process_image_cache_misses')
     
-    # Save the processed image
-    cv2.imwrite(str(processed_image_path), enhanced)
+    if cached is not None:
+        blobs = unpack_blobs(cached)
+    else:
+        with timer('decode'):
+            image = cv2.imdecode(np.frombuffer(raw_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        del raw_bytes
+        if image is None:
+            print(f"Error: Could not read image {image_path}")
+            return
+        
+        # Process the image, letting go of each stage's input once it is used
+        with timer('crop'):
+            pages = detect_pages(image) if multi_page else [detect_and_crop_edges(image)]
+        del image
+        with timer(f'enhance_{quality}'):
+            pages = [enhance_image(page, quality) for page in pages]
+        
+        with timer('jpeg_encode'):
+            outputs = [compose_pages(pages)] + (pages if len(pages) > 1 else [])
+            encoded = [cv2.imencode('.jpg', output) for output in outputs]
+        if not all(success for success, _ in encoded):
+            print(f"Error: Could not encode processed image {image_path}")
+            return
+        blobs = [data.tobytes() for _, data in encoded]
+        if cache is not None:
+            cache.put(cache_key, pack_blobs(blobs))
+    
+    processed_bytes, page_bytes = blobs[0], blobs[1:] or blobs[:1]
+    
+    # Save the processed image; outputs are renamed into place whole, so an
+    # interrupted run never leaves a truncated file behind
+    with timer('write'):
+        atomic_write_bytes(processed_image_path, processed_bytes)
     
     # Perform OCR if not skipped
-    if not skip_ocr and check_google_credentials():
-        text = perform_ocr(enhanced)
-        with open(text_path, 'w', encoding='utf-8') as f:
-            f.write(text)
+    if not skip_ocr and get_backend(ocr_options).is_available():
+        text, ok = ocr_pages(page_bytes, cache, ocr_payload, ocr_options)
+        save_ocr_text(text_path, text, ok)
         return processed_image_path, text_path
     else:
         return processed_image_path, None
 
+def _init_worker(ocr_options=None):
+    """Initialise a pool worker process."""
+    # Each worker handles one image at a time; letting OpenCV spawn its own
+    # threads on top of the process pool only oversubscribes the cores
+    cv2.setNumThreads(1)
+    # Load the OCR backend (and any local model) up front rather than on the first image
+    if ocr_options is not None:
+        get_backend(ocr_options)
+
+def _process_image_safe(image_path, output_dir, skip_ocr=False, cache=None, ocr_payload=None, quality='best',
+                        ocr_options=DEFAULT_OCR, multi_page=False):
+    """Run process_image, capturing any exception so one bad image can't stop the batch."""
+    try:
+        return image_path, process_image(image_path, output_dir, skip_ocr, cache, ocr_payload, quality,
+                                         ocr_options, multi_page), None
+    except Exception as e:
+        return image_path, None, e
+
+def _process_image_pooled(*args):
+    """Run _process_image_safe in a pool worker, returning its result and the worker's metrics."""
+    return _process_image_safe(*args), METRICS.drain()
+
+def _collect_pooled(future):
+    """Unpack a _process_image_pooled result, folding the worker's metrics into this process."""
+    result, worker_metrics = future.result()
+    METRICS.merge(worker_metrics)
+    return result
+
+def iter_processed_images(image_files, output_dir, skip_ocr=False, workers=1, order='preserve', cache=None,
+                          ocr_payload=None, quality='best', ocr_options=DEFAULT_OCR, multi_page=False):
+    """Process images, yielding (image_path, result, error) tuples as they finish.
+
+    With workers > 1 the images are spread over a process pool. At most
+    2 * workers images are in flight at once, so memory stays bounded no
+    matter how many files are queued. With order='preserve' results are
+    yielded in input order; with order='fastest' as soon as they complete.
+    """
+    if workers <= 1:
+        for image_path in image_files:
+            yield _process_image_safe(image_path, output_dir, skip_ocr, cache, ocr_payload, quality, ocr_options,
+                                      multi_page)
+        return
+    
+    max_in_flight = workers * 2
+    pending_files = iter(image_files)
+    
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(None if skip_ocr else ocr_options,)) as executor:
+        def submit_next():
+            image_path = next(pending_files, None)
+            if image_path is None:
+                return None
+            return executor.submit(_process_image_pooled, image_path, output_dir, skip_ocr, cache,
+                                   ocr_payload, quality, ocr_options, multi_page)
+        
+        if order == 'preserve':
+            # Futures are kept in submission order; always wait on the oldest one
+            in_flight = deque()
+            for _ in range(max_in_flight):
+                future = submit_next()
+                if future is None:
+                    break
+                in_flight.append(future)
+            
+            while in_flight:
+                result = _collect_pooled(in_flight.popleft())
+                future = submit_next()
+                if future is not None:
+                    in_flight.append(future)
+                yield result
+        else:
+            in_flight = set()
+            for _ in range(max_in_flight):
+                future = submit_next()
+                if future is None:
+                    break
+                in_flight.add(future)
+            
+            while in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    next_future = submit_next()
+                    if next_future is not None:
+                        in_flight.add(next_future)
+                    yield _collect_pooled(future)
+
+async def process_images_async_ocr(image_files, output_dir, workers, order, cache, client, report,
+                                   ocr_payload=None, quality='best'):
+    """Process images with OCR running concurrently on the async Vision client.
+    
+    Cropping and enhancing still run through iter_processed_images, but each
+    processed image is handed to the client as soon as it is ready, so OCR
+    round-trips overlap with the CPU work on the following images.
+    """
+    import asyncio
+    
+    loop = asyncio.get_running_loop()
+    results = iter_processed_images(image_files, output_dir, True, workers, order, cache, quality=quality)
+    # Keep enough images queued to fill every in-flight batch
+    max_pending = client.max_in_flight * client.batch_size * 2
+    pending = deque()
+    
+    async def ocr_task(image_path, processed_path):
+        text_path = output_dir / f"{image_path.stem}_text.txt"
+        try:
+            return image_path, await ocr_and_save(client, processed_path, text_path, cache, ocr_payload), None
+        except Exception as e:
+            return image_path, None, e
+    
+    def report_finished():
+        # Report everything that is done, keeping input order if requested
+        if order == 'preserve':
+            while pending and pending[0].done():
+                report(*pending.popleft().result())
+        else:
+            for task in [t for t in pending if t.done()]:
+                pending.remove(task)
+                report(*task.result())
+    
+    while True:
+        # Pull the next processed image without blocking the event loop
+        item = await loop.run_in_executor(None, next, results, None)
+        if item is None:
+            break
+        
+        image_path, result, error = item
+        if error is None and result is not None:
+            task = asyncio.ensure_future(ocr_task(image_path, result[0]))
+        else:
+            task = loop.create_future()
+            task.set_result(item)
+        pending.append(task)
+        
+        report_finished()
+        while len(pending) > max_pending:
+            await asyncio.wait(pending if order == 'fastest' else [pending[0]],
+                               return_when=asyncio.FIRST_COMPLETED)
+            report_finished()
+    
+    while pending:
+        await asyncio.wait(pending if order == 'fastest' else [pending[0]],
+                           return_when=asyncio.FIRST_COMPLETED)
+        report_finished()
+
+async def run_async_ocr(image_files, output_dir, workers, order, cache, report, concurrency, rate,
+                        max_retries, batch_size=1, ocr_payload=None, quality='best'):
+    """Create the async Vision client and run process_images_async_ocr with it."""
+    from vision_client import AsyncVisionClient
+    
+    async with AsyncVisionClient(os.getenv('GOOGLE_API_KEY'), max_in_flight=concurrency,
+                                 rate=rate, max_retries=max_retries, batch_size=batch_size) as client:
+        await process_images_async_ocr(image_files, output_dir, workers, order, cache, client, report,
+                                       ocr_payload, quality)
+
 def main():
     parser = argparse.ArgumentParser(description='Process images of handwritten notes for LLM processing.')
     parser.add_argument('input_dir', help='Directory containing images to process')
     parser.add_argument('--output_dir', help='Directory to save processed images and text (defaults to input_dir)')
     parser.add_argument('--no-ocr', action='store_true', help='Skip OCR processing')
+    parser.add_argument('--ocr_backend', choices=sorted(BACKENDS), default='vision',
+                        help='OCR engine: vision (Google Cloud Vision API) or easyocr (local, CPU only)')
+    parser.add_argument('--ocr_languages', default='en', help='Comma-separated language codes for local OCR backends')
+    parser.add_argument('--ocr_tile_batch', type=int, default=8, help='Page strips per inference batch for local OCR backends')
+    parser.add_argument('--profile', action='store_true', help='Print a per-stage timing summary at the end of the run')
+    parser.add_argument('--metrics_file', help='Write stage timings and counters to this file (.prom for Prometheus text format, JSONL otherwise)')
+    parser.add_argument('--quality', choices=QUALITY_TIERS, default='best',
+                        help='Denoising tier: fast (median filter), balanced (luminance-only NL-means) or best (full NL-means)')
+    parser.add_argument('--multi_page', action='store_true',
+                        help='Detect every page in a photo (separate sheets or a two-page spread), crop and OCR each '
+                             'on its own, and lay them out side by side in reading order')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes (0 = one per CPU core, defaults to 1)')
+    parser.add_argument('--order', choices=['preserve', 'fastest'], default='preserve',
+                        help='Report results in input order (preserve) or as soon as they finish (fastest)')
+    parser.add_argument('--cache_dir', default=str(DEFAULT_CACHE_DIR), help='Directory for the persistent result cache')
+    parser.add_argument('--cache_max_mb', type=int, default=DEFAULT_CACHE_MAX_MB, help='Maximum size of the result cache in MB')
+    parser.add_argument('--no-cache', action='store_true', help='Disable the persistent result cache')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and process new images as they are added to input_dir (Ctrl+C to stop)')
+    parser.add_argument('--poll_interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help='Seconds between directory scans with --watch when watchdog is not installed')
+    parser.add_argument('--watch_idle_exit', type=float, default=0,
+                        help='With --watch, stop after this many seconds without new images (0 = run until interrupted)')
+    parser.add_argument('--since-last-run', action='store_true', help='Only process images that are new or changed since the last run')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip images already processed with the same settings, as recorded in the checkpoint '
+                             'manifest, e.g. after an interrupted run')
+    parser.add_argument('--async-ocr', action='store_true', help='Run OCR requests concurrently, overlapping them with image processing')
+    parser.add_argument('--ocr_concurrency', type=int, default=8, help='Maximum number of OCR requests in flight (with --async-ocr)')
+    parser.add_argument('--ocr_rate', type=float, default=10.0, help='Maximum OCR requests per second, 0 for unlimited (with --async-ocr)')
+    parser.add_argument('--ocr_max_retries', type=int, default=5, help='Retries for throttled or failed OCR requests (with --async-ocr)')
+    parser.add_argument('--ocr_batch_size', type=int, default=1,
+                        help='Images per Vision API request, up to 16 (implies --async-ocr when above 1)')
+    parser.add_argument('--ocr_payload_max_edge', type=int, default=0,
+                        help='Downscale OCR uploads to this long edge in pixels (0 = send full resolution)')
+    parser.add_argument('--ocr_payload_format', choices=sorted(FORMATS), default='jpeg', help='Encoding for downscaled OCR uploads')
+    parser.add_argument('--ocr_payload_quality', type=int, default=90, help='Encoder quality for downscaled OCR uploads')
     args = parser.parse_args()
     
-    # Check Google credentials if OCR is not skipped
-    if not args.no_ocr and not check_google_credentials():
+    ocr_options = OCROptions(args.ocr_backend, tuple(args.ocr_languages.split(',')), args.ocr_tile_batch)
+    
+    # Check the OCR backend can run if OCR is not skipped
+    if not args.no_ocr and args.ocr_backend == 'vision' and not check_google_credentials():
         print("Warning: Proceeding without valid Google Cloud credentials. OCR will be skipped.")
         args.no_ocr = True
+    if not args.no_ocr and args.ocr_backend == 'easyocr' and importlib.util.find_spec('easyocr') is None:
+        print("Warning: easyocr is not installed (pip install easyocr). OCR will be skipped.")
+        args.no_ocr = True
+    if args.ocr_backend != 'vision' and (args.async_ocr or args.ocr_batch_size > 1):
+        print(f"Note: --async-ocr and --ocr_batch_size only apply to the vision backend; "
+              f"{args.ocr_backend} runs OCR in the worker processes")
+        args.async_ocr = False
+        args.ocr_batch_size = 1
+    if args.multi_page and (args.async_ocr or args.ocr_batch_size > 1):
+        print("Note: --async-ocr and --ocr_batch_size don't apply with --multi_page; "
+              "each photo's pages are OCR'd concurrently in the worker processes")
+        args.async_ocr = False
+        args.ocr_batch_size = 1
+    if args.watch and (args.async_ocr or args.ocr_batch_size > 1):
+        # The async pipeline only reports a frame once the next one arrives,
+        # and can't be interrupted while it waits on the watcher
+        print("Note: --async-ocr and --ocr_batch_size don't apply with --watch; "
+              "each new image is OCR'd as soon as it is processed")
+        args.async_ocr = False
+        args.ocr_batch_size = 1
     
     input_dir = Path(args.input_dir)
     output_dir = Path(args.output_dir) if args.output_dir else input_dir
@@ -291,28 +821,118 @@ def main():
     # Create output directory if it doesn't exist
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    # Get all image files
-    image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']
-    image_files = [f for f in input_dir.iterdir() if f.suffix.lower() in image_extensions]
+    state_path = output_dir / RUN_STATE_FILE
+    # Loaded whether or not this run skips unchanged images, so images this
+    # run doesn't touch keep their signatures when the state is saved
+    run_state = load_run_state(state_path)
+    cache = None if args.no_cache else ResultCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
     
-    if not image_files:
-        print(f"No image files found in {input_dir}")
-        return
+    ocr_payload = None
+    if args.ocr_payload_max_edge > 0:
+        ocr_payload = PayloadOptions(args.ocr_payload_max_edge, args.ocr_payload_format, args.ocr_payload_quality)
     
-    print(f"Found {len(image_files)} images to process")
+    # Every finished image is recorded as it completes, whether or not this run resumes
+    checkpoint = Checkpoint(output_dir / CHECKPOINT_FILE,
+                            make_key('prepare_images', PIPELINE_VERSION, args.quality, args.multi_page,
+                                     None if args.no_ocr else [ocr_options, ocr_payload]))
     
-    # Process each image
-    for image_path in tqdm(image_files, desc="Processing images"):
-        try:
-            processed_path, text_path = process_image(image_path, output_dir, args.no_ocr)
+    skipped = 0
+    def already_done(path):
+        return (args.since_last_run and is_unchanged(path, run_state)) or (args.resume and checkpoint.is_done(path))
+    
+    if args.watch:
+        # Existing images first, then new ones as they land. Everything runs in
+        # this process so the OCR backend, HTTP pool and cache stay warm
+        image_files = (
+            f for f in watch_directory(input_dir, is_source_image, include_existing=True,
+                                       poll_interval=args.poll_interval, idle_timeout=args.watch_idle_exit)
+            if not already_done(f)
+        )
+        workers = 1
+        if not args.no_ocr:
+            get_backend(ocr_options)
+        progress = tqdm(desc="Processing images", unit='image')
+    else:
+        # Files are streamed from the directory rather than listed up front;
+        # counting them first is a scandir pass that keeps nothing in memory
+        total_files = sum(1 for _ in scan_files(input_dir, is_source_image))
+        if not total_files:
+            print(f"No image files found in {input_dir}")
+            return
+        
+        workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+        workers = min(workers, total_files)
+        
+        print(f"Found {total_files} images")
+        if workers > 1:
+            print(f"Using {workers} worker processes")
+        
+        progress = tqdm(total=total_files, desc="Processing images")
+        
+        def pending_files():
+            # Skip files whose size and mtime match the previous run, or that
+            # a previous run already finished
+            nonlocal skipped
+            for image_path in scan_files(input_dir, is_source_image):
+                if already_done(image_path):
+                    skipped += 1
+                    progress.update(1)
+                    continue
+                yield image_path
+        
+        # Scanning and run-state checks (which may hash a touched file) run on
+        # a background thread, a bounded number of images ahead of the workers
+        image_files = prefetch(pending_files(), workers * 2)
+    
+    def report(image_path, result, error):
+        progress.update(1)
+        if error is not None:
+            print(f"Error processing {image_path.name}: {error}")
+        elif result is None:
+            # process_image already reported why the image was skipped
+            return
+        else:
+            processed_path, text_path = result
+            run_state[image_path.name] = file_signature(image_path)
+            if args.watch:
+                save_run_state(state_path, run_state)
+            # The processed image comes first, and ocr tells whether the text
+            # after it is the page's OCR text; prepared.py relies on both
+            checkpoint.mark_done(image_path, [path for path in result if path], ocr=text_path is not None)
             if text_path:
                 print(f"Processed {image_path.name} -> {processed_path.name}, {text_path.name}")
             else:
                 print(f"Processed {image_path.name} -> {processed_path.name} (OCR skipped)")
-        except Exception as e:
-            print(f"Error processing {image_path.name}: {e}")
+    
+    # Process each image
+    try:
+        if (args.async_ocr or args.ocr_batch_size > 1) and not args.no_ocr:
+            import asyncio
+            asyncio.run(run_async_ocr(image_files, output_dir, workers, args.order, cache, report,
+                                      args.ocr_concurrency, args.ocr_rate, args.ocr_max_retries,
+                                      args.ocr_batch_size, ocr_payload, args.quality))
+        else:
+            for image_path, result, error in iter_processed_images(image_files, output_dir, args.no_ocr,
+                                                                   workers, args.order, cache, ocr_payload,
+                                                                   args.quality, ocr_options,
+                                                                   args.multi_page):
+                report(image_path, result, error)
+    except KeyboardInterrupt:
+        if not args.watch:
+            raise
+        print("\nStopped watching")
+    progress.close()
+    checkpoint.close()
+    if skipped:
+        reason = "already processed" if args.resume else "unchanged since the last run"
+        print(f"Skipped {skipped} images {reason}")
+    
+    save_run_state(state_path, run_state)
+    if cache is not None:
+        cache.evict()
     
     print("Processing complete!")
+    report_metrics(args.profile, args.metrics_file)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,97 @@
+"""
+Handoff from prepare_images.py to generate_guidances.py.
+prepare_images.py records every photo it finishes in a checkpoint manifest
+in its output folder, along with the cropped, enhanced _processed.jpg and
+the OCR _text.txt it wrote. PreparedFrames looks photos up in that manifest
+so guidance generation can send the prepared page instead of the raw photo:
+a small copy of the crop plus its OCR text, or the text alone. Photos that
+haven't been prepared, or have changed since, are sent as before.
+"""
+
+import time
+import threading
+from collections import namedtuple
+from pathlib import Path
+
+from checkpoint import Checkpoint
+from metrics import count, timer
+from result_cache import file_signature
+
+# Written by prepare_images.py next to its outputs
+PREPARED_MANIFEST = '.prepare_images.checkpoint.jsonl'
+
+# image_text: a downscaled crop plus its OCR text; text: the OCR text alone
+# (with the crop only when a page has no text)
+PREPARED_MODES = ('image_text', 'text')
+
+# mode: one of PREPARED_MODES; directory: prepare_images.py's output folder
+# (None = the folder of the photos); max_edge: long edge the crop is
+# downscaled to before it is sent (0 = as sent for photos); wait: seconds a
+# watcher waits for prepare_images.py to finish a new photo
+PreparedOptions = namedtuple('PreparedOptions', ['mode', 'directory', 'max_edge', 'wait'])
+
+# The OCR text carries the writing, so the crop only needs to show the layout
+DEFAULT_PREPARED_MAX_EDGE = 768
+# Enough for the best quality tier and an OCR round-trip on a large photo
+DEFAULT_PREPARED_WAIT = 30
+# Seconds between checks of the manifest while waiting
+PREPARED_POLL_INTERVAL = 0.2
+
+# Paths of a photo's prepared outputs; text is None if there is no OCR text
+PreparedFrame = namedtuple('PreparedFrame', ['image', 'text'])
+
+class PreparedFrames:
+    """Lookup of the prepared outputs of photos in prepare_images.py's manifest.
+
+    The manifest is read again whenever it changes, so photos prepared by a
+    prepare_images.py --watch running alongside are picked up.
+    """
+
+    def __init__(self, directory, options):
+        self.options = options
+        self.checkpoint = Checkpoint(Path(directory) / PREPARED_MANIFEST, read_only=True)
+        self._signature = self._manifest_signature()
+        self._lock = threading.Lock()
+        if self._signature is None:
+            print(f"Warning: {self.checkpoint.path} not found; run prepare_images.py first. "
+                  "Sending the original photos")
+
+    def _manifest_signature(self):
+        try:
+            return file_signature(self.checkpoint.path)
+        except OSError:
+            return None
+
+    def _lookup(self, image_path):
+        with self._lock:
+            signature = self._manifest_signature()
+            if signature != self._signature:
+                self.checkpoint.load()
+                self._signature = signature
+            return self.checkpoint.finished(image_path)
+
+    def get(self, image_path, wait=0):
+        """The PreparedFrame of image_path, or None if it has no up-to-date prepared outputs.
+
+        With wait, a photo that isn't in the manifest yet is waited for, for
+        up to that many seconds, as prepare_images.py may still be working on it.
+        """
+        record = self._lookup(image_path)
+        if record is None and wait > 0:
+            deadline = time.monotonic() + wait
+            with timer('prepared_wait'):
+                while record is None and time.monotonic() < deadline:
+                    time.sleep(PREPARED_POLL_INTERVAL)
+                    record = self._lookup(image_path)
+            if record is None:
+                print(f"{Path(image_path).name} was not prepared within {wait:g}s; sending the photo")
+        if record is None:
+            count('prepared_missing')
+            return None
+        # The processed image is listed first, followed by the text if OCR
+        # succeeded; manifests from before the ocr field may hold error
+        # messages in place of text, so their text isn't trusted
+        outputs = self.checkpoint.outputs(record)
+        texts = [path for path in outputs[1:] if path.suffix == '.txt'] if record.get('ocr') else []
+        count('prepared_frames')
+        return PreparedFrame(outputs[0], texts[0] if texts else None)
@@ -0,0 +1,169 @@
+"""
+Persistent, content-addressed result cache shared by the image scripts.
+Entries are keyed on a hash of everything that determines a result (input
+bytes, pipeline parameters, prompt contents), so re-running a script over
+a folder only pays for the images that actually changed.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+
+DEFAULT_CACHE_DIR = Path.home() / '.cache' / 'deskmate'
+DEFAULT_CACHE_MAX_MB = 2048
+
+def make_key(*parts):
+    """Build a cache key from bytes, strings or JSON-serialisable parts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, (bytes, bytearray, memoryview)):
+            data = bytes(part)
+        elif isinstance(part, str):
+            data = part.encode('utf-8')
+        else:
+            data = json.dumps(part, sort_keys=True).encode('utf-8')
+        # Length-prefix each part so ('ab', 'c') and ('a', 'bc') differ
+        digest.update(len(data).to_bytes(8, 'big'))
+        digest.update(data)
+    return digest.hexdigest()
+
+def atomic_write_bytes(path, data):
+    """Write bytes to path via a temp file and rename, so readers never see partial files."""
+    path = Path(path)
+    # Named per process and thread so concurrent writers never share a temp
+    # file; unlike mkstemp this keeps the usual umask-based permissions
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+class ResultCache:
+    """On-disk cache with size-bounded LRU eviction.
+
+    Each entry is a single file named after its key. A hit refreshes the
+    file's mtime, so eviction can drop the least recently used entries
+    first. Writes are atomic, which makes the cache safe to share between
+    the worker processes of a single run.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_MB * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._bytes_since_evict = 0
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def __getstate__(self):
+        # Only the location and limit travel to worker processes
+        return {'cache_dir': self.cache_dir, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.cache_dir = state['cache_dir']
+        self.max_bytes = state['max_bytes']
+        self._bytes_since_evict = 0
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / key
+
+    def get(self, key):
+        """Return the cached bytes for key, or None on a miss."""
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except OSError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """Store bytes under key."""
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write_bytes(path, data)
+        except OSError as e:
+            print(f"Warning: could not write cache entry {key}: {e}")
+            return
+
+        # Evict opportunistically so a long run can't grow far past the limit
+        self._bytes_since_evict += len(data)
+        if self._bytes_since_evict > self.max_bytes // 10:
+            self.evict()
+
+    def get_text(self, key):
+        """Return the cached string for key, or None on a miss."""
+        data = self.get(key)
+        return data.decode('utf-8') if data is not None else None
+
+    def put_text(self, key, text):
+        """Store a string under key."""
+        self.put(key, text.encode('utf-8'))
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes."""
+        self._bytes_since_evict = 0
+        entries = []
+        total = 0
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+def file_signature(path):
+    """Cheap change signature for a file: size and modification time."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def load_run_state(state_path):
+    """Load the file signatures recorded by the previous run."""
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_run_state(state_path, state):
+    """Persist file signatures for the next --since-last-run invocation."""
+    state_path = Path(state_path)
+    state_path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write_bytes(state_path, json.dumps(state, indent=2, sort_keys=True).encode('utf-8'))
+
+def is_unchanged(path, state):
+    """Check whether a file matches the signature recorded in state."""
+    try:
+        return state.get(Path(path).name) == file_signature(path)
+    except OSError:
+        return False
@@ -0,0 +1,71 @@
+import os
+
+from checkpoint import Checkpoint
+
+def write(path, data):
+    path.write_bytes(data)
+    return path
+
+def test_resumed_checkpoint_knows_finished_items(tmp_path):
+    image = write(tmp_path / 'f00.jpg', b'frame 0')
+    output = write(tmp_path / 'f00_text.txt', b'text')
+    checkpoint = Checkpoint(tmp_path / 'manifest.jsonl', config='v1')
+    checkpoint.mark_done(image, [output], ocr=True)
+    checkpoint.close()
+
+    resumed = Checkpoint(tmp_path / 'manifest.jsonl', config='v1')
+
+    assert resumed.is_done(image)
+    assert resumed.finished(image)['ocr'] is True
+    assert not resumed.is_done(tmp_path / 'f01.jpg')
+
+def test_items_finished_with_other_settings_are_redone(tmp_path):
+    image = write(tmp_path / 'f00.jpg', b'frame 0')
+    checkpoint = Checkpoint(tmp_path / 'manifest.jsonl', config='v1')
+    checkpoint.mark_done(image)
+    checkpoint.close()
+
+    assert not Checkpoint(tmp_path / 'manifest.jsonl', config='v2').is_done(image)
+
+def test_changed_items_and_missing_outputs_are_redone(tmp_path):
+    changed = write(tmp_path / 'f00.jpg', b'frame 0')
+    touched = write(tmp_path / 'f01.jpg', b'frame 1')
+    orphaned = write(tmp_path / 'f02.jpg', b'frame 2')
+    output = write(tmp_path / 'f02_text.txt', b'text')
+    checkpoint = Checkpoint(tmp_path / 'manifest.jsonl')
+    for path in (changed, touched):
+        checkpoint.mark_done(path)
+    checkpoint.mark_done(orphaned, [output])
+    checkpoint.close()
+
+    changed.write_bytes(b'frame 0, edited')
+    stat = touched.stat()
+    os.utime(touched, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    output.unlink()
+    resumed = Checkpoint(tmp_path / 'manifest.jsonl')
+
+    assert not resumed.is_done(changed)
+    # Same contents under a new mtime still count as done
+    assert resumed.is_done(touched)
+    assert not resumed.is_done(orphaned)
+
+def test_line_cut_short_by_a_crash_is_ignored(tmp_path):
+    image = write(tmp_path / 'f00.jpg', b'frame 0')
+    checkpoint = Checkpoint(tmp_path / 'manifest.jsonl')
+    checkpoint.mark_done(image)
+    checkpoint.close()
+    with open(tmp_path / 'manifest.jsonl', 'a', encoding='utf-8') as f:
+        f.write('{"item": "f01.jpg", "si')
+
+    resumed = Checkpoint(tmp_path / 'manifest.jsonl')
+
+    assert resumed.is_done(image)
+    assert set(resumed.entries) == {'f00.jpg'}
+
+def test_forget_drops_items(tmp_path):
+    image = write(tmp_path / 'f00.jpg', b'frame 0')
+    checkpoint = Checkpoint(tmp_path / 'manifest.jsonl')
+    checkpoint.mark_done(image)
+    checkpoint.forget(['f00.jpg'])
+
+    assert not Checkpoint(tmp_path / 'manifest.jsonl').is_done(image)
@@ -0,0 +1,59 @@
+from context_budget import (ContextOptions, DROP_CHUNK, build_context, estimate_text_tokens,
+                            summarise_guidance)
+
+def guidance(i):
+    return f"Image: f{i:02}.jpg\n\nCheck the sign in step {i}. " + "Then carry on with the next line. " * 30
+
+GUIDANCES = [guidance(i) for i in range(10)]
+FULL = estimate_text_tokens(GUIDANCES[0])
+
+def test_unlimited_budget_keeps_everything():
+    context = build_context(GUIDANCES, 500, 300, ContextOptions(0, 3, 160))
+
+    assert context.keep_previous
+    assert context.dropped == 0
+    # Summaries come in whole chunks, so between 3 and 3 + DROP_CHUNK - 1 are verbatim
+    assert context.summarised == (len(GUIDANCES) - 3) // DROP_CHUNK * DROP_CHUNK
+    assert 3 <= context.verbatim < 3 + DROP_CHUNK
+    assert context.guidances[0] == summarise_guidance(GUIDANCES[0])
+    assert context.guidances[-1] == GUIDANCES[-1]
+
+def test_summaries_are_dropped_before_the_previous_frame():
+    unlimited = build_context(GUIDANCES, 500, 300, ContextOptions(0, 3, 160))
+    budget = unlimited.tokens - 1
+
+    context = build_context(GUIDANCES, 500, 300, ContextOptions(budget, 3, 160))
+
+    assert context.keep_previous
+    assert context.dropped == DROP_CHUNK
+    assert context.summarised == 0
+    assert context.guidances == GUIDANCES[DROP_CHUNK:]
+    assert context.tokens <= budget
+
+def test_previous_frame_is_dropped_before_full_guidances():
+    verbatim = GUIDANCES[DROP_CHUNK:]
+    budget = 500 + sum(estimate_text_tokens(g) for g in verbatim) + 100
+
+    context = build_context(GUIDANCES, 500, 300, ContextOptions(budget, 3, 160))
+
+    assert not context.keep_previous
+    assert context.guidances == verbatim
+    assert context.tokens <= budget
+
+def test_full_guidances_are_shortened_then_dropped_oldest_first():
+    budget = 500 + FULL + 30
+
+    context = build_context(GUIDANCES, 500, 300, ContextOptions(budget, 3, 160))
+
+    assert not context.keep_previous
+    assert context.tokens <= budget
+    assert context.guidances[-1] == summarise_guidance(GUIDANCES[-1])
+    assert context.dropped + len(context.guidances) == len(GUIDANCES)
+    assert context.verbatim == 0
+
+def test_fixed_cost_over_budget_sends_no_history():
+    context = build_context(GUIDANCES, 5000, 300, ContextOptions(4000, 3, 160))
+
+    assert context.guidances == []
+    assert not context.keep_previous
+    assert context.dropped == len(GUIDANCES)
@@ -0,0 +1,160 @@
+import json
+import time
+
+import pytest
+
+import generate_guidances
+from generate_guidances import (EncodedImage, GuidanceError, TransientGuidanceError, call_claude_api,
+                                iter_sse_events, read_message_stream)
+from result_cache import ResultCache
+
+# The Messages API rejects requests with more cache breakpoints than this
+MAX_CACHE_BREAKPOINTS = 4
+
+class FakeResponse:
+    def __init__(self, body, status_code=200):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = {}
+        self.content = json.dumps(body).encode('utf-8')
+        self.text = self.content.decode('utf-8')
+        self.request = type('Request', (), {'body': b''})()
+        self._body = body
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+class StreamResponse(FakeResponse):
+    """A streamed response carrying events as server-sent events."""
+
+    def __init__(self, events):
+        super().__init__({})
+        self.lines = []
+        for event in events:
+            self.lines += [f"event: {event['type']}", f"data: {json.dumps(event)}", '']
+
+    def iter_lines(self, decode_unicode=False):
+        return iter(self.lines)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+def message_events(*texts, stop=True):
+    """Events of a streamed message made of texts, cut off before its end unless stop."""
+    events = [{'type': 'message_start', 'message': {'usage': {'input_tokens': 120}}},
+              {'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}}]
+    events += [{'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': text}}
+               for text in texts]
+    if stop:
+        events += [{'type': 'content_block_stop', 'index': 0},
+                   {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': 9}},
+                   {'type': 'message_stop'}]
+    return events
+
+class FakeSession:
+    """Records the JSON body of each request and answers with a fixed guidance, or with events if given."""
+
+    def __init__(self, events=None):
+        self.requests = []
+        self.events = events
+
+    def post(self, url, headers=None, json=None, stream=False):
+        self.requests.append(json)
+        if self.events is not None:
+            return StreamResponse(self.events)
+        return FakeResponse({'content': [{'type': 'text', 'text': 'Keep going.'}], 'usage': {}})
+
+def count_cache_breakpoints(value):
+    if isinstance(value, dict):
+        return ('cache_control' in value) + sum(count_cache_breakpoints(item) for item in value.values())
+    if isinstance(value, list):
+        return sum(count_cache_breakpoints(item) for item in value)
+    return 0
+
+@pytest.fixture
+def session(monkeypatch):
+    monkeypatch.setenv('ANTHROPIC_API_KEY', 'test-key')
+    fake = FakeSession()
+    monkeypatch.setattr(generate_guidances, '_http_session', fake)
+    return fake
+
+@pytest.mark.parametrize('summarised', [0, 1, 4, 7, 8])
+def test_request_has_at_most_four_cache_breakpoints(session, summarised):
+    image = EncodedImage('image/jpeg', 'AAAA', (10, 10))
+    guidances = [f"Image: f{i:02}.jpg\n\nGuidance {i}." for i in range(8)]
+
+    guidance = call_claude_api('System prompt', [image, image], guidances, reference_image=image,
+                               frame_texts=['OCR text of the latest frame:\n\nx = 7'], summarised=summarised)
+
+    assert guidance == 'Keep going.'
+    breakpoints = count_cache_breakpoints(session.requests[0])
+    assert breakpoints <= MAX_CACHE_BREAKPOINTS
+    # System prompt, reference image and the end of the history, plus the
+    # end of the summaries when it isn't the end of the history
+    assert breakpoints == (4 if 0 < summarised < len(guidances) else 3)
+
+def test_request_without_prompt_cache_has_no_breakpoints(session):
+    image = EncodedImage('image/jpeg', 'AAAA', (10, 10))
+
+    call_claude_api('System prompt', [image], ['Image: f00.jpg\n\nGuidance.'], reference_image=image,
+                    prompt_cache=False)
+
+    assert count_cache_breakpoints(session.requests[0]) == 0
+
+def test_iter_sse_events_joins_multi_line_data():
+    response = StreamResponse([])
+    response.lines = [': keep-alive', 'event: ping', 'data: {"type":', 'data: "ping"}', '', 'data: {"type": "x"}']
+
+    assert list(iter_sse_events(response)) == [{'type': 'ping'}, {'type': 'x'}]
+
+def test_read_message_stream_collects_text_and_usage():
+    pieces = []
+    stats = {}
+
+    text, usage = read_message_stream(StreamResponse(message_events('Check ', 'the sign.')), time.perf_counter(),
+                                      pieces.append, stats)
+
+    assert text == 'Check the sign.'
+    assert pieces == ['Check ', 'the sign.']
+    assert usage == {'input_tokens': 120, 'output_tokens': 9}
+    assert stats['ttft'] >= 0
+
+def test_read_message_stream_rejects_a_truncated_stream():
+    with pytest.raises(TransientGuidanceError):
+        read_message_stream(StreamResponse(message_events('Check ', stop=False)), time.perf_counter())
+
+def test_read_message_stream_needs_a_stop_reason():
+    events = [event for event in message_events('Check the sign.') if event['type'] != 'message_delta']
+
+    with pytest.raises(TransientGuidanceError):
+        read_message_stream(StreamResponse(events), time.perf_counter())
+
+@pytest.mark.parametrize('error_type, transient', [('overloaded_error', True), ('invalid_request_error', False)])
+def test_read_message_stream_error_events(error_type, transient):
+    events = message_events('Check ', stop=False) + [
+        {'type': 'error', 'error': {'type': error_type, 'message': 'Something went wrong'}}]
+
+    with pytest.raises(GuidanceError) as error:
+        read_message_stream(StreamResponse(events), time.perf_counter())
+    assert isinstance(error.value, TransientGuidanceError) == transient
+
+def test_truncated_stream_is_not_cached(monkeypatch, tmp_path):
+    monkeypatch.setenv('ANTHROPIC_API_KEY', 'test-key')
+    monkeypatch.setattr(generate_guidances, '_http_session', FakeSession(message_events('Check ', stop=False)))
+    cache = ResultCache(tmp_path)
+    received = []
+
+    with pytest.raises(TransientGuidanceError):
+        call_claude_api('System prompt', [], [], cache=cache, stream=True, on_text=received.append)
+
+    assert received == ['Check ']
+    assert not any(path.is_file() for path in tmp_path.rglob('*'))
@@ -0,0 +1,42 @@
+import os
+
+from result_cache import ResultCache, make_key
+
+def test_make_key_separates_parts():
+    assert make_key('ab', 'c') != make_key('a', 'bc')
+    assert make_key('a', [1, 2]) == make_key('a', [1, 2])
+
+def test_round_trip(tmp_path):
+    cache = ResultCache(tmp_path)
+    key = make_key('ocr', b'image bytes')
+
+    assert cache.get_text(key) is None
+    cache.put_text(key, 'x = 7')
+    assert cache.get_text(key) == 'x = 7'
+
+def test_evict_drops_least_recently_used_entries(tmp_path):
+    cache = ResultCache(tmp_path, max_bytes=10 ** 6)
+    keys = [make_key('entry', i) for i in range(3)]
+    for age, key in enumerate(keys):
+        cache.put(key, b'x' * 100)
+        # Oldest first: keys[0] was used longest ago
+        os.utime(cache._path(key), (1000 + age, 1000 + age))
+    # A hit makes keys[0] the most recently used
+    assert cache.get(keys[0]) is not None
+
+    cache.max_bytes = 250
+    cache.evict()
+
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[2]) is not None
+
+def test_evict_keeps_everything_within_the_limit(tmp_path):
+    cache = ResultCache(tmp_path, max_bytes=1000)
+    keys = [make_key('entry', i) for i in range(3)]
+    for key in keys:
+        cache.put(key, b'x' * 100)
+
+    cache.evict()
+
+    assert all(cache.get(key) is not None for key in keys)
@@ -0,0 +1,42 @@
+import asyncio
+import time
+
+from vision_client import TokenBucket, parse_annotate_response
+
+def test_parse_annotate_response_returns_full_text():
+    entry = {'textAnnotations': [{'description': 'x = 7\ny = 2'}, {'description': 'x'}]}
+
+    assert parse_annotate_response(entry) == ('x = 7\ny = 2', True)
+
+def test_parse_annotate_response_page_without_text():
+    assert parse_annotate_response({}) == ('', True)
+
+def test_parse_annotate_response_error():
+    text, ok = parse_annotate_response({'error': {'code': 3, 'message': 'Bad image data.'}})
+
+    assert not ok
+    assert 'Bad image data.' in text
+
+def acquire_times(bucket, count):
+    async def run():
+        started = time.monotonic()
+        times = []
+        for _ in range(count):
+            await bucket.acquire()
+            times.append(time.monotonic() - started)
+        return times
+    return asyncio.run(run())
+
+def test_token_bucket_allows_a_burst_then_paces_requests():
+    times = acquire_times(TokenBucket(rate=20, capacity=3), 5)
+
+    # The first three tokens are already in the bucket
+    assert times[2] < 0.03
+    # The rest arrive at 20 per second
+    assert times[3] >= 0.04
+    assert times[4] >= 0.09
+
+def test_token_bucket_without_rate_never_waits():
+    times = acquire_times(TokenBucket(rate=0), 50)
+
+    assert times[-1] < 0.05
@@ -0,0 +1,255 @@
+"""
+Google Cloud Vision OCR client used by prepare_images.py.
+Provides the request/response helpers shared by the synchronous and
+asynchronous code paths, plus an asyncio client that keeps a single pooled
+HTTP session, limits in-flight requests, rate-limits with a token bucket,
+retries 429/5xx responses with jittered exponential backoff and can batch
+several images into one annotate call.
+"""
+
+import os
+import time
+import base64
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from http_utils import RETRY_STATUS_CODES, create_session, backoff_delay
+from metrics import timer, count
+
+# Overridable so the client can be pointed at a local stub server
+VISION_API_URL = os.getenv('VISION_API_URL', 'https://vision.googleapis.com/v1/images:annotate')
+
+# images:annotate accepts at most 16 images and ~10 MB of JSON per call
+MAX_BATCH_SIZE = 16
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+
+class VisionAPIError(Exception):
+    """The Vision API rejected a request with a non-retryable status."""
+
+def build_annotate_request(images):
+    """Build an images:annotate request body for a list of JPEG byte strings."""
+    return {
+        "requests": [
+            {
+                "image": {
+                    "content": base64.b64encode(image_bytes).decode('utf-8')
+                },
+                "features": [
+                    {
+                        "type": "TEXT_DETECTION"
+                    }
+                ]
+            }
+            for image_bytes in images
+        ]
+    }
+
+def parse_annotate_response(entry):
+    """Extract the full text from a single entry of an images:annotate response.
+
+    Returns (text, ok) where ok is False if the entry has no usable result.
+    A page without text comes back as an empty entry, giving ('', True).
+    """
+    if 'error' in entry:
+        return f"API Error: {entry['error'].get('message', 'Unknown error')}", False
+
+    text_annotations = entry.get('textAnnotations')
+    if text_annotations:
+        # The first annotation contains all the text
+        return text_annotations[0]['description'], True
+    return '', True
+
+def ocr_error_result(error):
+    """The (text, ok) result of an image whose request failed with error."""
+    if isinstance(error, VisionAPIError):
+        return str(error), False
+    return f"OCR ERROR: {str(error)}", False
+
+class TokenBucket:
+    """Asyncio token bucket allowing rate requests per second with bursts up to capacity."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a token is available and take it."""
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def encoded_size(image_bytes):
+    """Size of an image once base64-encoded into a request body."""
+    return (len(image_bytes) + 2) // 3 * 4
+
+class AsyncVisionClient:
+    """Concurrent Vision API client for use from an asyncio event loop.
+
+    All requests share one pooled requests.Session. The blocking calls run
+    on a dedicated thread pool sized to max_in_flight, so network round-trips
+    overlap with whatever the event loop is doing meanwhile.
+
+    With batch_size > 1, annotate() calls are gathered into batches bounded
+    by batch_size images and max_batch_bytes of encoded payload. A batch is
+    sent once it is full or batch_linger seconds after its first image
+    arrived. If a whole batch fails, its images are retried one by one.
+    """
+
+    def __init__(self, api_key, endpoint=None, max_in_flight=8, rate=10.0,
+                 max_retries=5, timeout=60, batch_size=1,
+                 max_batch_bytes=MAX_BATCH_BYTES, batch_linger=0.2):
+        self.api_key = api_key
+        self.endpoint = endpoint or VISION_API_URL
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.max_batch_bytes = max_batch_bytes
+        self.batch_linger = batch_linger
+        self.session = create_session(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='vision')
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._bucket = TokenBucket(rate)
+        self._batch = []
+        self._batch_bytes = 0
+        self._linger_handle = None
+        self._batch_tasks = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._flush_batch()
+        if self._batch_tasks:
+            await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+        self.close()
+
+    def close(self):
+        """Release the thread pool and pooled connections."""
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+    def _send(self, body):
+        with timer('ocr_request'):
+            response = self.session.post(
+                self.endpoint,
+                params={'key': self.api_key},
+                json=body,
+                timeout=self.timeout
+            )
+        count('ocr_requests')
+        count('ocr_bytes_sent', len(response.request.body or b''))
+        count('ocr_bytes_received', len(response.content))
+        return response
+
+    async def post(self, body):
+        """POST an annotate request, retrying throttled and failed attempts.
+
+        Returns the parsed JSON response. Raises on a non-retryable HTTP
+        error or once retries are exhausted.
+        """
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            await self._bucket.acquire()
+            retry_after = None
+            try:
+                async with self._semaphore:
+                    response = await loop.run_in_executor(self._executor, self._send, body)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                error = e
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    raise VisionAPIError(f"API Error: {response.status_code} - {response.text}")
+                error = f"HTTP {response.status_code}"
+                retry_after = response.headers.get('Retry-After')
+
+            delay = backoff_delay(attempt, retry_after=retry_after)
+            count('ocr_retries')
+            print(f"OCR request failed ({error}), retrying in {delay:.1f}s")
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def annotate(self, image_bytes):
+        """Run TEXT_DETECTION on one JPEG image, returning (text, ok)."""
+        if self.batch_size <= 1:
+            return await self._annotate_single(image_bytes)
+
+        size = encoded_size(image_bytes)
+        if self._batch and self._batch_bytes + size > self.max_batch_bytes:
+            self._flush_batch()
+
+        future = asyncio.get_running_loop().create_future()
+        self._batch.append((image_bytes, future))
+        self._batch_bytes += size
+
+        if len(self._batch) >= self.batch_size:
+            self._flush_batch()
+        elif self._linger_handle is None:
+            self._linger_handle = asyncio.get_running_loop().call_later(self.batch_linger, self._flush_batch)
+
+        return await future
+
+    def _flush_batch(self):
+        """Send the images gathered so far as one batch."""
+        if self._linger_handle is not None:
+            self._linger_handle.cancel()
+            self._linger_handle = None
+        if not self._batch:
+            return
+
+        batch = self._batch
+        self._batch = []
+        self._batch_bytes = 0
+        task = asyncio.ensure_future(self._send_batch(batch))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _send_batch(self, batch):
+        """Annotate a batch and resolve each image's future with its own result."""
+        try:
+            result = await self.post(build_annotate_request([image_bytes for image_bytes, _ in batch]))
+            responses = result['responses']
+            if len(responses) != len(batch):
+                raise ValueError(f"expected {len(batch)} responses, got {len(responses)}")
+            results = [parse_annotate_response(entry) for entry in responses]
+        except Exception as e:
+            if len(batch) == 1:
+                # post has already retried; sending the image again on its
+                # own would just repeat the same request
+                results = [ocr_error_result(e)]
+            else:
+                print(f"OCR batch of {len(batch)} images failed ({e}), retrying individually")
+                results = await asyncio.gather(*(self._annotate_single(image_bytes) for image_bytes, _ in batch))
+
+        for (_, future), entry_result in zip(batch, results):
+            if not future.done():
+                future.set_result(entry_result)
+
+    async def _annotate_single(self, image_bytes):
+        """Annotate one image in its own request."""
+        try:
+            result = await self.post(build_annotate_request([image_bytes]))
+        except Exception as e:
+            return ocr_error_result(e)
+        try:
+            return parse_annotate_response(result['responses'][0])
+        except (KeyError, IndexError):
+            return "No text found in response", False
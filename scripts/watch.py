@@ -0,0 +1,130 @@
+"""
+Directory watching for the --watch modes of the scripts.
+During a live study session the desk camera keeps dropping frames into a
+folder. watch_directory() yields each new image once it has finished being
+written, so the caller can keep its warm state (prompts, HTTP sessions,
+models, guidance history) in memory between frames. Filesystem events from
+the optional watchdog package (inotify on Linux) are used when it is
+installed; otherwise the directory is polled with os.scandir.
+"""
+
+import os
+import time
+import queue
+from pathlib import Path
+
+from ingest import scan_files
+
+# A file is handed over once its size and mtime have been stable this long,
+# so half-written camera frames are never read
+DEFAULT_SETTLE_SECONDS = 0.5
+DEFAULT_POLL_INTERVAL = 1.0
+
+def _signature(path):
+    """(size, mtime_ns) of path, or None if it has disappeared."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def _start_observer(directory, accept, events):
+    """Start a watchdog observer feeding paths into events, or return None without watchdog."""
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        return None
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.is_directory:
+                return
+            path = Path(getattr(event, 'dest_path', '') or event.src_path)
+            if path.parent == directory and accept(path):
+                events.put(path)
+
+    observer = Observer()
+    observer.schedule(Handler(), str(directory), recursive=False)
+    observer.daemon = True
+    observer.start()
+    return observer
+
+def watch_directory(directory, accept, include_existing=False, poll_interval=DEFAULT_POLL_INTERVAL,
+                    settle=DEFAULT_SETTLE_SECONDS, idle_timeout=0):
+    """Yield files added to directory, in name order, as they finish being written.
+
+    accept(path) decides which files are of interest. With include_existing
+    the files already present are yielded first. A file is yielded again if
+    it is later rewritten. With idle_timeout > 0 the generator stops after
+    that many seconds without a new file; otherwise it runs until the caller
+    stops iterating (e.g. on KeyboardInterrupt).
+    """
+    directory = Path(directory).resolve()
+    events = queue.Queue()
+    observer = _start_observer(directory, accept, events)
+    if observer is None:
+        print(f"Watching {directory} by polling every {poll_interval:g}s (install watchdog for filesystem events)")
+    else:
+        print(f"Watching {directory} for new images")
+
+    # path -> signature last yielded; path -> (signature, time first seen unchanged)
+    seen = {}
+    pending = {}
+    if not include_existing:
+        for path in scan_files(directory, accept):
+            seen[path] = _signature(path)
+
+    last_activity = time.monotonic()
+    next_scan = 0
+    try:
+        while True:
+            now = time.monotonic()
+            candidates = []
+            # Polling is the fallback, and a periodic safety net with events
+            # in case the observer misses something (e.g. on network shares)
+            if now >= next_scan:
+                candidates.extend(scan_files(directory, accept))
+                next_scan = now + (poll_interval if observer is None else max(poll_interval, 10.0))
+            try:
+                while True:
+                    candidates.append(events.get_nowait())
+            except queue.Empty:
+                pass
+
+            for path in candidates:
+                signature = _signature(path)
+                if signature is None or seen.get(path) == signature:
+                    continue
+                if path not in pending or pending[path][0] != signature:
+                    pending[path] = (signature, now)
+
+            ready = []
+            for path, (signature, since) in list(pending.items()):
+                current = _signature(path)
+                if current is None:
+                    del pending[path]
+                elif current != signature:
+                    pending[path] = (current, now)
+                elif now - since >= settle:
+                    del pending[path]
+                    seen[path] = signature
+                    ready.append(path)
+
+            for path in sorted(ready):
+                yield path
+            if ready or pending:
+                last_activity = time.monotonic()
+            elif idle_timeout and time.monotonic() - last_activity >= idle_timeout:
+                return
+
+            # Wake up for the next event, the next settle check or the next scan
+            wait = min(settle if pending else poll_interval, max(0.0, next_scan - time.monotonic()))
+            try:
+                path = events.get(timeout=max(wait, 0.05))
+                events.put(path)
+            except queue.Empty:
+                pass
+    finally:
+        if observer is not None:
+            observer.stop()